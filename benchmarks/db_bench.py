@@ -0,0 +1,341 @@
+# Микробенчмарк функций database/db.py и страниц админки на синтетической базе (100k–5M пользователей)
+# с реалистичным распределением подписок, журналом операций, оплатами и неоплаченными ссылками.
+# Результаты пишутся в JSON; с --baseline сравниваются с сохранённым прогоном (код возврата 1,
+# если p50 какой-либо операции вырос больше чем на --max-regression)
+# Запуск:
+#   python -m benchmarks.db_bench --users 1000000 --db /tmp/vpnbot-1m.db --output before.json
+#   python -m benchmarks.db_bench --users 1000000 --db /tmp/vpnbot-1m.db --baseline before.json --max-regression 0.3
+# Заполненная база (--db) переиспользуется между прогонами; пишущие операции добавляют в неё сотни строк
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from benchmarks.e2e_load import percentile
+from benchmarks.user_search import FIRST_NAMES, random_username
+
+DAY = 86400
+BATCH_SIZE = 50000
+# Изменения p50 меньше этого порога — шум таймера, а не регрессия
+NOISE_FLOOR_MS = 0.1
+# Текст строк, которые пишут операции бенчмарка: по нему они удаляются после прогона
+MARKER = "bench"
+
+def day_key(timestamp):
+    moment = datetime.fromtimestamp(timestamp)
+    return moment.year * 10000 + moment.month * 100 + moment.day
+
+# Подписка пользователя: треть не покупала ни разу, около 40% активны, остальные истекли —
+# большинство недавно (попадают в автопродление и чистку), часть давно
+def subscription(rng, now):
+    kind = rng.random()
+    if kind < 0.35:
+        return None, None
+    subscription_type = "month" if rng.random() < 0.8 else "year"
+    length = 30 if subscription_type == "month" else 365
+    if kind < 0.75:
+        return subscription_type, now + rng.randint(DAY // 24, length * DAY)
+    if kind < 0.9:
+        return subscription_type, now - rng.randint(60, 30 * DAY)
+    return subscription_type, now - rng.randint(30 * DAY, 720 * DAY)
+
+def seed(conn, users, transactions_per_user, pending_share, rng):
+    now = int(time.time())
+    user_rows, ledger_rows, transaction_rows, pending_rows = [], [], [], []
+    revenue = {}
+    counts = {"users": 0, "payments": 0, "transactions": 0, "pending_payments": 0}
+
+    def flush(force=False):
+        for query, rows in (
+            ('''INSERT INTO users (telegram_id, first_name, username, subscription_type, subscription_end,
+                                   payment_method_id, subscription_url, marzban_panel) VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', user_rows),
+            ('''INSERT INTO payments_ledger (payment_id, telegram_id, subscription_type, amount, source, paid_at)
+                VALUES (?, ?, ?, ?, ?, ?)''', ledger_rows),
+            ("INSERT INTO transactions (telegram_id, status, message, timestamp) VALUES (?, ?, ?, ?)", transaction_rows),
+            ('''INSERT INTO pending_payments (telegram_id, payment_id, subscription_type, amount, confirmation_url,
+                                              created_at, next_check_at) VALUES (?, ?, ?, ?, ?, ?, ?)''', pending_rows),
+        ):
+            if rows and (force or len(rows) >= BATCH_SIZE):
+                conn.executemany(query, rows)
+                rows.clear()
+
+    for i in range(users):
+        telegram_id = str(100000000 + i)
+        username = random_username(rng)
+        subscription_type, subscription_end = subscription(rng, now)
+        payment_method_id = subscription_url = panel = None
+        if subscription_type:
+            payment_method_id = f"pm-{i}" if rng.random() < 0.6 else None
+            subscription_url = f"https://vpn.example/sub/{username or telegram_id}"
+            panel = "default"
+            price = 300 if subscription_type == "month" else 3650
+            for _ in range(rng.randint(1, 3)):
+                paid_at = now - rng.randint(0, 720 * DAY)
+                ledger_rows.append((str(uuid.UUID(int=rng.getrandbits(128))), telegram_id, subscription_type,
+                                    price, "webhook", paid_at))
+                day_revenue, day_payments = revenue.get(day_key(paid_at), (0, 0))
+                revenue[day_key(paid_at)] = (day_revenue + price, day_payments + 1)
+                counts["payments"] += 1
+        user_rows.append((telegram_id, f"{rng.choice(FIRST_NAMES)}{rng.randint(0, 99)}", username,
+                          subscription_type, subscription_end, payment_method_id, subscription_url, panel))
+
+        for _ in range(rng.randint(0, 2 * transactions_per_user)):
+            status = rng.choices(("success", "error", "processing"), (8, 1, 1))[0]
+            transaction_rows.append((telegram_id, status, f"Синтетическая запись ({status})", now - rng.randint(0, 720 * DAY)))
+
+        if rng.random() < pending_share:
+            created_at = now - rng.randint(0, 2 * 3600)
+            payment_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            pending_rows.append((telegram_id, payment_id, "month", 300,
+                                 f"https://yoomoney.example/checkout/{payment_id}", created_at, created_at + 15))
+            counts["pending_payments"] += 1
+        flush()
+    flush(force=True)
+    conn.executemany("INSERT OR REPLACE INTO revenue_daily (day, revenue, payments) VALUES (?, ?, ?)",
+                     [(day, amount, payments) for day, (amount, payments) in revenue.items()])
+    counts["users"] = users
+    counts["transactions"] = conn.execute("SELECT value FROM meta WHERE key = 'transactions_count'").fetchone()[0]
+    return counts
+
+def measure(func, repeat, max_seconds):
+    latencies = []
+    deadline = time.perf_counter() + max_seconds
+    for i in range(repeat):
+        started = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - started)
+        if started > deadline:
+            break
+    total = sum(latencies)
+    return {
+        "calls": len(latencies),
+        "ops_per_sec": round(len(latencies) / total, 1) if total else 0.0,
+        "mean_ms": round(total / len(latencies) * 1000, 4),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 4),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 4),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 4),
+    }
+
+# Операции: (имя, функция от номера вызова, тяжёлая). Тяжёлые читают всю таблицу или пишут
+# тысячи строк и повторяются --heavy-repeat раз. Имя до «(» — функция db.py, которую покрывает случай
+def db_cases(db, users, rng, repeat):
+    now = datetime.now()
+    sample = [str(100000000 + rng.randrange(users)) for _ in range(repeat)]
+    new_ids = [f"bench-{uuid.uuid4().hex[:12]}" for _ in range(repeat)]
+    middle_user = users // 2
+    payment_ids = [row[0] for row in db.get_connection().execute(
+        "SELECT payment_id FROM payments_ledger ORDER BY id DESC LIMIT ?", (repeat,))]
+    payment_ids = payment_ids or ["missing"]
+
+    def user(i):
+        return sample[i % len(sample)]
+
+    return [
+        ("get_stats(all)", lambda i: db.get_stats("all"), False),
+        ("get_stats(month)", lambda i: db.get_stats("month"), False),
+        ("count_users", lambda i: db.count_users(), False),
+        ("count_transactions", lambda i: db.count_transactions(), False),
+        ("get_users_page(первая)", lambda i: db.get_users_page(), False),
+        ("get_users_page(середина)", lambda i: db.get_users_page(after=middle_user), False),
+        ("get_transactions_page", lambda i: db.get_transactions_page(), False),
+        ("get_transactions(100)", lambda i: db.get_transactions(100), False),
+        ("search_users(имя)", lambda i: db.search_users("иван"), False),
+        ("search_users(telegram_id)", lambda i: db.search_users(user(i)), False),
+        ("get_user_state", lambda i: db.get_user_state(user(i)), False),
+        ("get_user_subscription", lambda i: db.get_user_subscription(user(i)), False),
+        ("has_active_subscription", lambda i: db.has_active_subscription(user(i)), False),
+        ("get_subscription_url", lambda i: db.get_subscription_url(user(i)), False),
+        ("get_marzban_username", lambda i: db.get_marzban_username(user(i)), False),
+        ("get_marzban_panel", lambda i: db.get_marzban_panel(user(i)), False),
+        ("count_users_by_panel", lambda i: db.count_users_by_panel(), True),
+        ("get_panel_users(100)", lambda i: db.get_panel_users("default", 100, i * 100), False),
+        ("get_pending_payment", lambda i: db.get_pending_payment(user(i)), False),
+        ("get_tariff_price", lambda i: db.get_tariff_price("month"), False),
+        ("get_tariffs_version", lambda i: db.get_tariffs_version(), False),
+        ("get_admin", lambda i: db.get_admin("admin"), False),
+        ("get_or_create_setting", lambda i: db.get_or_create_setting("bench", lambda: "value"), False),
+        ("is_payment_recorded", lambda i: db.is_payment_recorded(payment_ids[i % len(payment_ids)]), False),
+        ("get_settlement", lambda i: db.get_settlement(payment_ids[i % len(payment_ids)]), False),
+        ("get_purge_candidates(500)", lambda i: db.get_purge_candidates(now - timedelta(days=3), 500), False),
+        ("get_due_pending_payments(100)", lambda i: db.get_due_pending_payments(100), False),
+        ("count_due_renewals", lambda i: db.count_due_renewals(), False),
+        ("count_pending_payments", lambda i: db.count_pending_payments(), False),
+        ("get_webhook_inbox_stats", lambda i: db.get_webhook_inbox_stats(), False),
+        ("get_failed_webhook_events", lambda i: db.get_failed_webhook_events(), False),
+        ("get_outbox_stats", lambda i: db.get_outbox_stats(), False),
+        ("get_broadcasts", lambda i: db.get_broadcasts(), False),
+        ("get_last_message", lambda i: db.get_last_message(int(user(i))), False),
+        ("check_expired_subscriptions", lambda i: db.check_expired_subscriptions(), True),
+        ("get_expired_users", lambda i: db.get_expired_users(now - timedelta(days=3)), True),
+        ("get_users", lambda i: db.get_users(), True),
+        ("get_transactions(все)", lambda i: db.get_transactions(), True),
+        # Запись
+        ("add_user", lambda i: db.add_user(new_ids[i % len(new_ids)], "Bench", None), False),
+        ("log_transaction", lambda i: db.log_transaction(user(i), "success", MARKER), False),
+        ("update_user_subscription", lambda i: db.update_user_subscription(new_ids[i % len(new_ids)], "month", 30), False),
+        ("set_subscription_url", lambda i: db.set_subscription_url(new_ids[i % len(new_ids)], "https://vpn.example/sub/bench"), False),
+        ("set_marzban_placement", lambda i: db.set_marzban_placement(new_ids[i % len(new_ids)], "default", "https://vpn.example/sub/bench"), False),
+        ("add_pending_payment", lambda i: db.add_pending_payment(new_ids[i % len(new_ids)], f"bench-{i}", "month", 300, "https://yoomoney.example", 15), False),
+        ("remove_pending_payment", lambda i: db.remove_pending_payment(new_ids[i % len(new_ids)], f"bench-{i}"), False),
+        ("record_payment", lambda i: db.record_payment(f"bench-{uuid.uuid4()}", user(i), "month", 300, "bench"), False),
+        ("update_tariff_price", lambda i: db.update_tariff_price("month", 300), False),
+        ("enqueue_message", lambda i: db.enqueue_message(user(i), MARKER), False),
+        ("save_last_messages", lambda i: db.save_last_messages([(int(user(i)), i + 1, int(time.time()))]), False),
+        ("reschedule_pending_payment", lambda i: db.reschedule_pending_payment(user(i), "missing", 60), False),
+        ("reset_subscription", lambda i: db.reset_subscription(new_ids[i % len(new_ids)]), False),
+        ("acquire_lease", lambda i: db.acquire_lease("bench", "bench", 60), False),
+        ("release_lease", lambda i: db.release_lease("bench", "bench"), False),
+        ("add_webhook_event", lambda i: db.add_webhook_event(f"bench-{uuid.uuid4()}", "payment.succeeded", "{}"), False),
+        ("claim_webhook_events(100)", lambda i: db.claim_webhook_events(100, 300), False),
+        ("prune_last_messages", lambda i: db.prune_last_messages(0), False),
+        ("delete_user", lambda i: db.delete_user(new_ids[i % len(new_ids)]), False),
+        ("enqueue_due_renewals", lambda i: db.enqueue_due_renewals(), True),
+        ("claim_renewal_jobs(100)", lambda i: db.claim_renewal_jobs(100, 600), False),
+        ("enqueue_broadcast(active)", lambda i: db.enqueue_broadcast("active", MARKER), True),
+        ("claim_outbox_messages(100)", lambda i: db.claim_outbox_messages(100, 600), False),
+    ]
+
+# Страницы админки целиком: запросы, которые делает представление, и рендер шаблона.
+# Идут после пишущих операций, то есть пока в outbox лежит рассылка по активным пользователям
+def web_cases(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['admin'] = 'admin'
+
+    def get(path):
+        def request(i):
+            response = client.get(path)
+            assert response.status_code == 200, (path, response.status_code)
+        return request
+
+    return [(f"web {path}", get(path), False) for path in (
+        "/dashboard", "/dashboard?period=month", "/users", "/users?search=иван",
+        "/edit_tariffs", "/broadcast", "/metrics")]
+
+# Удаляет строки, оставленные пишущими операциями, чтобы повторный прогон на той же базе (--db)
+# мерил те же объёмы, что и базовый: иначе каждая рассылка добавляет в outbox сотни тысяч строк
+def cleanup(conn, started):
+    revenue = {}
+    for amount, paid_at in conn.execute("SELECT amount, paid_at FROM payments_ledger WHERE payment_id LIKE 'bench-%'"):
+        day_revenue, day_payments = revenue.get(day_key(paid_at), (0, 0))
+        revenue[day_key(paid_at)] = (day_revenue + amount, day_payments + 1)
+    conn.executemany("UPDATE revenue_daily SET revenue = revenue - ?, payments = payments - ? WHERE day = ?",
+                     [(amount, payments, day) for day, (amount, payments) in revenue.items()])
+    conn.execute("DELETE FROM payments_ledger WHERE payment_id LIKE 'bench-%'")
+    conn.execute("DELETE FROM webhook_inbox WHERE payment_id LIKE 'bench-%'")
+    conn.execute("DELETE FROM outbox WHERE text = ?", (MARKER,))
+    conn.execute("DELETE FROM broadcasts WHERE text = ?", (MARKER,))
+    conn.execute("DELETE FROM transactions WHERE message = ?", (MARKER,))
+    conn.execute("DELETE FROM settings WHERE key = ?", (MARKER,))
+    conn.execute("DELETE FROM renewal_jobs WHERE updated_at >= ?", (started,))
+    conn.execute("DELETE FROM last_messages WHERE sent_at >= ?", (started,))
+
+def uncovered(db, names):
+    covered = {name.split("(")[0] for name in names} | {"init_db", "to_epoch", "format_timestamp"}
+    return sorted(name for name, value in vars(db).items()
+                  if not name.startswith("_") and callable(value) and not isinstance(value, type)
+                  and getattr(value, "__module__", None) == db.__name__ and name not in covered)
+
+def compare(results, baseline, max_regression):
+    regressions = []
+    print(f"\n{'операция':<34} {'было p50, мс':>13} {'стало p50, мс':>14} {'изменение':>10}")
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:<34} {'—':>13} {result['p50_ms']:>14.3f} {'новая':>10}")
+            continue
+        change = (result["p50_ms"] - before["p50_ms"]) / before["p50_ms"] if before["p50_ms"] else 0.0
+        slower = change > max_regression and result["p50_ms"] - before["p50_ms"] > NOISE_FLOOR_MS
+        if slower:
+            regressions.append(name)
+        print(f"{name:<34} {before['p50_ms']:>13.3f} {result['p50_ms']:>14.3f} {change:>+9.0%}{' !' if slower else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--transactions-per-user', type=int, default=3, help="в среднем записей журнала на пользователя")
+    parser.add_argument('--pending-share', type=float, default=0.02, help="доля пользователей с неоплаченной ссылкой")
+    parser.add_argument('--db', help="путь к базе; существующая заполненная база используется как есть")
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--heavy-repeat', type=int, default=3)
+    parser.add_argument('--max-seconds', type=float, default=5, help="предел времени на одну операцию, с")
+    parser.add_argument('--output', help="JSON с результатами")
+    parser.add_argument('--baseline', help="JSON прошлого прогона для сравнения")
+    parser.add_argument('--max-regression', type=float, default=0.3, help="допустимый рост p50, доля")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix='vpnbot-dbbench-'), 'users.db')
+    os.environ['DATABASE_PATH'] = path
+    os.environ.setdefault('VITE_BASE_API', 'http://127.0.0.1:9/api')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    from database import db
+    from database.connection import transaction
+    from web.app import create_app
+    db.init_db()
+
+    rng = random.Random(args.seed)
+    existing = db.count_users()
+    if existing:
+        print(f"База {path}: {existing} пользователей, заполнение пропущено")
+        counts = {"users": existing, "transactions": db.count_transactions(), "pending_payments": db.count_pending_payments()}
+    else:
+        started = time.perf_counter()
+        with transaction(immediate=True) as conn:
+            counts = seed(conn, args.users, args.transactions_per_user, args.pending_share, rng)
+        db.get_connection().execute("ANALYZE")
+        print(f"База {path} заполнена за {time.perf_counter() - started:.1f} с: {counts}")
+
+    app = create_app()
+    cases = db_cases(db, counts["users"], rng, args.repeat) + web_cases(app)
+    results = {}
+    run_started = int(time.time())
+    print(f"{'операция':<34} {'вызовов':>8} {'в сек':>10} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    try:
+        for name, func, heavy in cases:
+            result = measure(func, args.heavy_repeat if heavy else args.repeat, args.max_seconds)
+            results[name] = result
+            print(f"{name:<34} {result['calls']:>8} {result['ops_per_sec']:>10.0f} {result['p50_ms']:>9.3f} "
+                  f"{result['p95_ms']:>9.3f} {result['p99_ms']:>9.3f}")
+    finally:
+        with transaction(immediate=True) as conn:
+            cleanup(conn, run_started)
+    missing = uncovered(db, results)
+    if missing:
+        print(f"Не измерены: {', '.join(missing)}")
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().strftime(db.DATE_FORMAT),
+            "database": path,
+            **counts,
+            "repeat": args.repeat,
+            "sqlite": sqlite3.sqlite_version,
+            "python": platform.python_version(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("users") != counts["users"]:
+            print(f"Внимание: в базовом прогоне {baseline['meta'].get('users')} пользователей, сейчас {counts['users']}")
+        regressions = compare(results, baseline["results"], args.max_regression)
+        if regressions:
+            print(f"FAIL: p50 вырос больше чем на {args.max_regression:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
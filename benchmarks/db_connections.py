@@ -0,0 +1,92 @@
+# Сравнение старой схемы "connect/close на каждый вызов" с пулом соединений database.connection
+# Запуск: python -m benchmarks.db_connections --ops 20000
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+def legacy_add_user(path, telegram_id):
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute("INSERT OR IGNORE INTO users (telegram_id, first_name, username) VALUES (?, ?, ?)",
+              (telegram_id, "Bench", None))
+    conn.commit()
+    conn.close()
+
+def legacy_get_tariff_price(path, tariff_type):
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute("SELECT price FROM tariffs WHERE type = ?", (tariff_type,))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def legacy_get_user_subscription(path, telegram_id):
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute("SELECT subscription_type, subscription_end FROM users WHERE telegram_id = ?", (telegram_id,))
+    row = c.fetchone()
+    conn.close()
+    return row
+
+def legacy_log_transaction(path, telegram_id):
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute("INSERT INTO transactions (telegram_id, status, message, timestamp) VALUES (?, ?, ?, ?)",
+              (telegram_id, "success", "bench", datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    conn.commit()
+    conn.close()
+
+def measure(name, ops, func):
+    started = time.perf_counter()
+    for i in range(ops):
+        func(i)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<40} {ops / elapsed:>12.0f} ops/s")
+    return ops / elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ops', type=int, default=20000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='vpnbot-bench-')
+    path = os.path.join(workdir, 'users.db')
+    os.environ['DATABASE_PATH'] = path
+
+    from database import db
+    db.init_db()
+
+    # Старый вариант: rollback-журнал, как у базы, созданной до перехода на WAL
+    legacy_path = os.path.join(workdir, 'legacy.db')
+    conn = sqlite3.connect(legacy_path)
+    conn.execute("PRAGMA journal_mode = DELETE")
+    conn.executescript(
+        "CREATE TABLE users (id INTEGER PRIMARY KEY, telegram_id TEXT UNIQUE, first_name TEXT, username TEXT,"
+        " subscription_type TEXT, subscription_end TEXT, payment_method_id TEXT);"
+        "CREATE TABLE transactions (id INTEGER PRIMARY KEY, telegram_id TEXT, status TEXT, message TEXT, timestamp TEXT);"
+        "CREATE TABLE tariffs (type TEXT PRIMARY KEY, price REAL NOT NULL);"
+        "INSERT INTO tariffs VALUES ('month', 300), ('year', 3650);"
+    )
+    conn.close()
+
+    ops = args.ops
+    results = {}
+    for label, legacy, pooled in (
+        ("add_user", lambda i: legacy_add_user(legacy_path, str(i)), lambda i: db.add_user(str(i), "Bench", None)),
+        ("get_tariff_price", lambda i: legacy_get_tariff_price(legacy_path, 'month'), lambda i: db.get_tariff_price('month')),
+        ("get_user_subscription", lambda i: legacy_get_user_subscription(legacy_path, str(i)), lambda i: db.get_user_subscription(str(i))),
+        ("log_transaction", lambda i: legacy_log_transaction(legacy_path, str(i)), lambda i: db.log_transaction(str(i), "success", "bench")),
+    ):
+        before = measure(f"{label} (connect на вызов)", ops, legacy)
+        after = measure(f"{label} (пул соединений)", ops, pooled)
+        results[label] = after / before
+
+    print()
+    for label, speedup in results.items():
+        print(f"{label:<40} x{speedup:.1f}")
+
+if __name__ == '__main__':
+    main()
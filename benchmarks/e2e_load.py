@@ -0,0 +1,253 @@
+# Сквозной нагрузочный тест бота: поддельные Marzban, ЮKassa и Bot API поднимаются в процессе
+# как HTTP-серверы с заданной задержкой, настоящие хендлеры бота, SDK ЮKassa и клиент Marzban
+# ходят в них по сети. N пользователей одновременно проходят путь
+# /start → «Купить подписку» → «1 месяц» → «Проверить платёж» → «Личный кабинет»
+# Запуск: python -m benchmarks.e2e_load --users 500 --concurrency 100 --latency 0.05 --max-p99 2
+# (код возврата 1, если p99 какого-либо шага выше --max-p99 или были ошибки)
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from benchmarks.webhook_load import free_port, fake_bot_api
+
+STEPS = ("start_command", "process_buy_subscription", "process_payment", "check_payment", "process_profile")
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def fake_marzban(latency, requests):
+    from aiohttp import web
+    users = {}
+
+    def user_response(username):
+        return {**users[username], "subscription_url": f"https://vpn.example/sub/{username}"}
+
+    async def token(request):
+        requests["marzban token"] += 1
+        await asyncio.sleep(latency)
+        return web.json_response({"access_token": "bench-token", "token_type": "bearer"})
+
+    async def create_user(request):
+        requests["marzban create"] += 1
+        await asyncio.sleep(latency)
+        payload = await request.json()
+        username = payload["username"]
+        if username in users:
+            return web.json_response({"detail": "User already exists"}, status=409)
+        users[username] = {"username": username, "expire": payload["expire"], "data_limit": payload["data_limit"]}
+        return web.json_response(user_response(username))
+
+    async def user(request):
+        requests[f"marzban {request.method.lower()}"] += 1
+        await asyncio.sleep(latency)
+        username = request.match_info["username"]
+        if username not in users:
+            return web.json_response({"detail": "User not found"}, status=404)
+        if request.method == "DELETE":
+            del users[username]
+            return web.json_response({})
+        if request.method == "PUT":
+            payload = await request.json()
+            users[username].update(expire=payload["expire"], data_limit=payload["data_limit"])
+        return web.json_response(user_response(username))
+
+    async def system(request):
+        requests["marzban system"] += 1
+        await asyncio.sleep(latency)
+        return web.json_response({"total_user": len(users), "users_active": len(users)})
+
+    app = web.Application()
+    app.router.add_post("/api/admin/token", token)
+    app.router.add_get("/api/system", system)
+    app.router.add_post("/api/user", create_user)
+    app.router.add_route("*", "/api/user/{username}", user)
+    return app
+
+# Платёж создаётся в статусе pending; к нажатию «Проверить платёж» пользователь уже «оплатил»,
+# поэтому find_one отдаёт succeeded с сохранённым способом оплаты
+def fake_yookassa(latency, requests):
+    from aiohttp import web
+    payments = {}
+
+    def payment_response(payment):
+        return {key: value for key, value in payment.items() if key != "params"}
+
+    async def create(request):
+        requests["yookassa create"] += 1
+        await asyncio.sleep(latency)
+        params = await request.json()
+        idempotency_key = request.headers.get("Idempotence-Key")
+        if idempotency_key in payments:
+            return web.json_response(payment_response(payments[idempotency_key]))
+        payment_id = str(uuid.uuid4())
+        payment = {
+            "id": payment_id,
+            "status": "pending",
+            "paid": False,
+            "amount": params["amount"],
+            "description": params.get("description"),
+            "metadata": params.get("metadata", {}),
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://yoomoney.example/checkout/{payment_id}"},
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+            "test": True,
+            "refundable": False,
+        }
+        payments[payment_id] = payments[idempotency_key] = payment
+        return web.json_response(payment_response(payment))
+
+    async def find_one(request):
+        requests["yookassa find_one"] += 1
+        await asyncio.sleep(latency)
+        payment = payments.get(request.match_info["payment_id"])
+        if payment is None:
+            return web.json_response({"type": "error", "code": "not_found"}, status=404)
+        payment.update(status="succeeded", paid=True,
+                       payment_method={"type": "bank_card", "id": f"pm-{payment['id']}", "saved": True})
+        return web.json_response(payment_response(payment))
+
+    app = web.Application()
+    app.router.add_post("/v3/payments", create)
+    app.router.add_get("/v3/payments/{payment_id}", find_one)
+    return app
+
+def counting(app, requests, prefix):
+    from aiohttp import web
+
+    @web.middleware
+    async def count(request, handler):
+        requests[f"{prefix} {request.match_info.get('method', request.path).lower()}"] += 1
+        return await handler(request)
+
+    app.middlewares.append(count)
+    return app
+
+async def start_server(app):
+    from aiohttp import web
+    port = free_port()
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, f"http://127.0.0.1:{port}"
+
+def message_update(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user_{user_id}"}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+               "from": user, "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+def callback_update(update_id, user_id, data):
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user_{user_id}"}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user, "chat_instance": "1", "data": data,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}}}}
+
+async def run(args):
+    requests = Counter()
+    runners = []
+    runner, telegram_url = await start_server(counting(fake_bot_api(args.latency), requests, "telegram"))
+    runners.append(runner)
+    runner, marzban_url = await start_server(fake_marzban(args.latency, requests))
+    runners.append(runner)
+    runner, yookassa_url = await start_server(fake_yookassa(args.latency, requests))
+    runners.append(runner)
+
+    os.environ['TELEGRAM_API_SERVER'] = telegram_url
+    os.environ['VITE_BASE_API'] = f"{marzban_url}/api"
+    from aiogram import Bot, Dispatcher, types
+    from yookassa.client import ApiClient
+    from database.db import init_db, get_pending_payment
+    from bot.bot import dp, bot, throttling, last_messages
+    from bot.marzban import marzban, _sync
+    from database.connection import fetchone
+    ApiClient.endpoint = f"{yookassa_url}/v3"
+    init_db()
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+
+    update_ids = itertools.count(1)
+    timings = {step: [] for step in STEPS}
+    errors = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def step(name, update):
+        started = time.perf_counter()
+        try:
+            await dp.process_update(types.Update(**update))
+        except Exception as e:
+            errors[f"{name}: {type(e).__name__}"] += 1
+        timings[name].append(time.perf_counter() - started)
+        if args.think:
+            await asyncio.sleep(args.think)
+
+    async def user_flow(user_id):
+        async with semaphore:
+            await step("start_command", message_update(next(update_ids), user_id, "/start"))
+            await step("process_buy_subscription", callback_update(next(update_ids), user_id, "buy_subscription"))
+            await step("process_payment", callback_update(next(update_ids), user_id, "buy_month"))
+            pending_payment = get_pending_payment(str(user_id))
+            if pending_payment is None:
+                errors["process_payment: нет платежа"] += 1
+                return
+            await step("check_payment", callback_update(next(update_ids), user_id, f"check_payment_{pending_payment[0]}"))
+            await step("process_profile", callback_update(next(update_ids), user_id, "profile"))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_flow(100000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    activated = fetchone("SELECT COUNT(*) FROM users WHERE subscription_end IS NOT NULL")[0]
+    print(f"{args.users} пользователей, {args.concurrency} одновременно, задержка внешних API {args.latency * 1000:.0f} мс")
+    print(f"сценариев: {args.users / elapsed:.1f}/с, {elapsed:.2f} с; подписок активировано {activated}/{args.users}")
+    print(f"{'шаг':<26} {'вызовов':>8} {'в сек':>8} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for name in STEPS:
+        values = timings[name]
+        print(f"{name:<26} {len(values):>8} {len(values) / elapsed:>8.1f} {percentile(values, 0.5) * 1000:>9.1f} "
+              f"{percentile(values, 0.95) * 1000:>9.1f} {percentile(values, 0.99) * 1000:>9.1f}")
+    print("запросы к поддельным API: " + ", ".join(f"{name} {count}" for name, count in sorted(requests.items())))
+    print(f"троттлинг: {throttling.stats()['counters']}")
+    if errors:
+        print(f"ошибки: {dict(errors)}")
+
+    await last_messages.flush()
+    await marzban.close()
+    _sync.run(_sync.client.close())
+    await (await bot.get_session()).close()
+    for runner in runners:
+        await runner.cleanup()
+
+    slow = [name for name in STEPS if args.max_p99 and percentile(timings[name], 0.99) > args.max_p99]
+    if errors or activated != args.users or slow:
+        print(f"FAIL: ошибок {sum(errors.values())}, активировано {activated}/{args.users}, p99 выше {args.max_p99} с: {slow}")
+        return 1
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=100, help="сколько пользователей проходят сценарий одновременно")
+    parser.add_argument('--latency', type=float, default=0.05, help="задержка ответа поддельных Marzban, ЮKassa и Bot API, с")
+    parser.add_argument('--think', type=float, default=0.0, help="пауза пользователя между шагами, с")
+    parser.add_argument('--max-p99', type=float, default=0.0, help="порог p99 шага, с (0 — не проверять)")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='vpnbot-e2e-'), 'users.db')
+    os.environ.setdefault('TELEGRAM_TOKEN', '123456789:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+    os.environ.setdefault('SHOP_ID', 'bench')
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ.setdefault('MARZBAN_USERNAME', 'bench')
+    os.environ.setdefault('MARZBAN_PASSWORD', 'bench')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.exit(asyncio.run(run(args)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# Проверка EXPLAIN QUERY PLAN: каждый горячий запрос должен идти по индексу, без полного скана и сортировки,
+# а запросы из EXPECTED_INDEXES — именно по указанному индексу
+# Запуск: python -m benchmarks.query_plans (код возврата 1, если какой-то запрос сканирует таблицу)
+import os
+import re
+import sys
+import tempfile
+
+HOT_QUERIES = {
+    "check_expired_subscriptions":
+        ("SELECT telegram_id, subscription_type, payment_method_id FROM users WHERE subscription_end < ? AND payment_method_id IS NOT NULL", (0,)),
+    "get_expired_users":
+        ("SELECT telegram_id, subscription_end FROM users WHERE subscription_end < ? AND subscription_end IS NOT NULL", (0,)),
+    "get_stats: active":
+        ("SELECT COUNT(*) FROM users WHERE subscription_end > ?", (0,)),
+    "get_stats: expired":
+        ("SELECT COUNT(*) FROM users WHERE subscription_end < ? AND subscription_end IS NOT NULL", (0,)),
+    "get_transactions":
+        ("SELECT * FROM transactions ORDER BY timestamp DESC LIMIT ?", (10,)),
+    "get_transactions_page: first":
+        ("SELECT * FROM transactions ORDER BY timestamp DESC, id DESC LIMIT ?", (11,)),
+    "get_transactions_page: after":
+        ("SELECT * FROM transactions WHERE (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?", (0, 0, 11)),
+    "get_transactions_page: before":
+        ("SELECT * FROM transactions WHERE (timestamp, id) > (?, ?) ORDER BY timestamp ASC, id ASC LIMIT ?", (0, 0, 11)),
+    "get_users_page: after":
+        ("SELECT * FROM users WHERE id > ? ORDER BY id ASC LIMIT ?", (0, 11)),
+    "get_users_page: before":
+        ("SELECT * FROM users WHERE id < ? ORDER BY id DESC LIMIT ?", (0, 11)),
+    "enqueue_due_renewals":
+        ("SELECT telegram_id, subscription_type, payment_method_id, subscription_end FROM users WHERE subscription_end < :now AND payment_method_id IS NOT NULL",
+         {"now": 0}),
+    "transactions by user":
+        ("SELECT * FROM transactions WHERE telegram_id = ?", ("1",)),
+    "get_pending_payment":
+        ("SELECT payment_id, subscription_type, amount, confirmation_url FROM pending_payments WHERE telegram_id = ? AND created_at >= ? ORDER BY created_at DESC LIMIT 1", ("1", 0)),
+    "claim_renewal_jobs":
+        ("SELECT id FROM renewal_jobs WHERE status IN ('pending', 'running') AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?", (0, 10)),
+    "get_due_pending_payments":
+        ("SELECT telegram_id, payment_id, created_at, checks FROM pending_payments WHERE next_check_at <= ? ORDER BY next_check_at LIMIT ?", (0, 10)),
+    "claim_webhook_events":
+        ("SELECT id FROM webhook_inbox WHERE status IN ('pending', 'processing') AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?", (0, 10)),
+    "claim_outbox_messages":
+        ("SELECT id FROM outbox WHERE status IN ('pending', 'sending') AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?", (0, 10)),
+    "get_broadcasts":
+        ("SELECT status, COUNT(*) FROM outbox WHERE broadcast_id = ? GROUP BY status", (1,)),
+}
+
+# Запросы, для которых мало «какого-нибудь индекса»: keyset-страницы должны искать диапазон
+# по ключу страницы, поиск продлений — идти по частичному индексу пользователей с картой
+EXPECTED_INDEXES = {
+    "check_expired_subscriptions": "idx_users_payment_method_end",
+    "enqueue_due_renewals": "idx_users_payment_method_end",
+    "get_transactions_page: first": "idx_transactions_timestamp",
+    "get_transactions_page: after": "idx_transactions_timestamp",
+    "get_transactions_page: before": "idx_transactions_timestamp",
+    "get_users_page: after": "INTEGER PRIMARY KEY",
+    "get_users_page: before": "INTEGER PRIMARY KEY",
+}
+
+FULL_SCAN = re.compile(r"^SCAN \w+$")
+
+def check_plans(conn, queries=HOT_QUERIES, expected=EXPECTED_INDEXES):
+    failures = []
+    for name, (query, params) in queries.items():
+        plan = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()]
+        bad = [step for step in plan if FULL_SCAN.match(step) or "TEMP B-TREE" in step]
+        if name in expected and not any(expected[name] in step for step in plan):
+            bad.append(f"нет {expected[name]}")
+        status = "FAIL" if bad else "ok"
+        print(f"[{status:>4}] {name}: {' | '.join(plan)}")
+        if bad:
+            failures.append(name)
+    return failures
+
+def main():
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='vpnbot-plans-'), 'users.db')
+
+    from database import db
+    from database.connection import get_connection
+    db.init_db()
+
+    failures = check_plans(get_connection())
+    if failures:
+        print(f"Запросы без индекса: {', '.join(failures)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
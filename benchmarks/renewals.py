@@ -0,0 +1,118 @@
+# Автопродление: 10k просроченных подписок через RenewalEngine с фейковыми ЮKassa и Marzban,
+# у которых задана задержка ответа. Часть карт отклоняется — это не должно тормозить остальных.
+# Отдельный прогон: ЮKassa создаёт платёж, но ответ теряется (таймаут) — повтор не должен списать второй раз
+# Запуск: python -m benchmarks.renewals --users 10000 --max-seconds 60 (код возврата 1 при превышении)
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from types import SimpleNamespace
+
+# Каждый вызов create — новое списание, если только ЮKassa не узнаёт Idempotence-Key уже созданного
+# платежа (так работает настоящий API). lost_rate — доля списаний, ответ на которые не доходит до бота
+class FakeGateway:
+    def __init__(self, latency, decline_rate, lost_rate=0.0, seed=0):
+        self.latency = latency
+        self.decline_rate = decline_rate
+        self.lost_rate = lost_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.payments = {}
+        self.by_key = {}
+        self.charges = Counter()
+
+    def create_payment_sync(self, params, idempotency_key=None, timeout=None):
+        time.sleep(self.latency)
+        with self._lock:
+            known = self.by_key.get(idempotency_key) if idempotency_key else None
+            if known is not None:
+                return known
+            status = "canceled" if self._rng.random() < self.decline_rate else "succeeded"
+            payment = SimpleNamespace(id=str(uuid.uuid4()), status=status, metadata=params["metadata"],
+                                      amount=SimpleNamespace(value=params["amount"]["value"]),
+                                      payment_method=SimpleNamespace(id=params["payment_method_id"]))
+            if idempotency_key:
+                self.by_key[idempotency_key] = payment
+            self.payments[payment.id] = payment
+            self.charges[params["metadata"]["user_id"]] += 1
+            lost = self._rng.random() < self.lost_rate
+        if lost:
+            raise TimeoutError("ЮKassa не ответила")
+        return payment
+
+    def find_payment_sync(self, payment_id, timeout=None):
+        time.sleep(self.latency)
+        return self.payments[payment_id]
+
+def seed(conn, count, first=0):
+    expired = int(time.time()) - 3600
+    conn.executemany('''INSERT INTO users (telegram_id, first_name, username, subscription_type, subscription_end, payment_method_id)
+                        VALUES (?, ?, ?, 'month', ?, ?)''',
+                     [(str(100000000 + i), f"user{i}", f"user_{i}", expired, f"pm-{i}") for i in range(first, first + count)])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.02, help="задержка фейковых ЮKassa и Marzban, с")
+    parser.add_argument('--decline-rate', type=float, default=0.05)
+    parser.add_argument('--max-seconds', type=float, default=60)
+    parser.add_argument('--lost-users', type=int, default=200, help="продлений, ответ на первое списание которых теряется")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='vpnbot-renewals-'), 'users.db')
+    os.environ.setdefault('VITE_BASE_API', 'http://127.0.0.1:9/api')
+    from database import db
+    from database.connection import transaction, fetchall
+    from bot.settlement import SettlementService
+    from worker.renewals import RenewalEngine
+    db.init_db()
+    with transaction() as conn:
+        seed(conn, args.users)
+
+    gateway = FakeGateway(args.latency, args.decline_rate)
+    marzban = lambda username, expire: time.sleep(args.latency)
+    notify = lambda telegram_id, message: None
+    engine = RenewalEngine(gateway, SettlementService(gateway, marzban, marzban), notify,
+                           workers=args.workers, retry_delay=300)
+    outcome = engine.run_once()
+    statuses = dict(fetchall("SELECT status, COUNT(*) FROM renewal_jobs GROUP BY status"))
+    print(f"{args.users} продлений, {args.workers} воркеров, задержка {args.latency * 1000:.0f} мс: {outcome}")
+    print(f"Задачи по статусам: {statuses}")
+
+    # Каждая задача обработана за один проход: успешные завершены, отклонённые отложены, а не ждут в потоке
+    processed = outcome.get("done", 0) + outcome.get("retry", 0)
+    serial_seconds = args.users * args.latency * 2
+    print(f"Последовательно заняло бы не меньше {serial_seconds:.0f} с без учёта sleep(300) после отказов")
+    failed = False
+    if processed != args.users or outcome["seconds"] > args.max_seconds:
+        print(f"FAIL: обработано {processed}/{args.users} за {outcome['seconds']} с (лимит {args.max_seconds} с)")
+        failed = True
+    double = [user_id for user_id, count in gateway.charges.items() if count > 1]
+    if double:
+        print(f"FAIL: повторное списание у {len(double)} пользователей")
+        failed = True
+
+    # Платёж создан, ответ потерян: задача повторяется сразу (retry_delay=0) и должна получить тот же платёж
+    if args.lost_users:
+        with transaction() as conn:
+            seed(conn, args.lost_users, first=args.users)
+        lost_gateway = FakeGateway(0, 0, lost_rate=1.0)
+        lost_engine = RenewalEngine(lost_gateway, SettlementService(lost_gateway, marzban, marzban), notify,
+                                    workers=args.workers, retry_delay=0)
+        lost_outcome = lost_engine.run_once()
+        charges = Counter(lost_gateway.charges.values())
+        print(f"{args.lost_users} продлений с потерянным ответом ЮKassa: {lost_outcome}, списаний на пользователя: {dict(charges)}")
+        if charges != Counter({1: args.lost_users}) or lost_outcome.get("done", 0) != args.lost_users:
+            print("FAIL: повтор после потерянного ответа списал деньги ещё раз или не завершил продление")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# Пропускная способность записи при одновременных add_user + log_transaction: прямые вызовы
+# database.db из потоков и из цикла событий против очереди единственного пишущего потока
+# (database/repository.py), который фиксирует накопившиеся записи одной транзакцией.
+# Для режимов из цикла событий печатается и максимальная задержка цикла: столько ждали все
+# остальные обновления бота, пока корутина держала его на запросе к SQLite.
+# Запуск: python -m benchmarks.repository_writes --ops 2000 --concurrency 64 --synchronous FULL
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.e2e_load import percentile
+
+MODES = ("threads-direct", "threads-sync-repository", "loop-direct", "loop-repository")
+
+def user_id(mode, worker, i):
+    return f"{MODES.index(mode)}{worker:04d}{i:06d}"
+
+def run_threads(mode, write, workers, ops):
+    latencies = [[] for _ in range(workers)]
+    errors = []
+
+    def worker(number):
+        try:
+            for i in range(ops):
+                telegram_id = user_id(mode, number, i)
+                started = time.perf_counter()
+                write("add_user", telegram_id, f"bench{number}", None)
+                write("log_transaction", telegram_id, "success", "bench")
+                latencies[number].append(time.perf_counter() - started)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, sum(latencies, []), 0.0, errors
+
+async def run_loop(mode, write, workers, ops):
+    latencies = []
+    errors = []
+    lag = 0.0
+    done = asyncio.Event()
+
+    # Сколько цикл событий не успевал разбудить задачу, спящую 1 мс
+    async def watch_lag():
+        nonlocal lag
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lag = max(lag, time.perf_counter() - started - 0.001)
+
+    async def worker(number):
+        for i in range(ops):
+            telegram_id = user_id(mode, number, i)
+            started = time.perf_counter()
+            try:
+                await write("add_user", telegram_id, f"bench{number}", None)
+                await write("log_transaction", telegram_id, "success", "bench")
+            except Exception as e:
+                errors.append(e)
+                return
+            latencies.append(time.perf_counter() - started)
+
+    watcher = asyncio.ensure_future(watch_lag())
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(number) for number in range(workers)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await watcher
+    return elapsed, latencies, lag, errors
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ops', type=int, default=1000, help="пар add_user + log_transaction на одного писателя")
+    parser.add_argument('--concurrency', type=int, default=32, help="одновременных писателей (потоков или корутин)")
+    parser.add_argument('--synchronous', choices=("NORMAL", "FULL"), default="NORMAL",
+                        help="PRAGMA synchronous: FULL — fsync на каждый COMMIT")
+    parser.add_argument('--mode', choices=MODES, action='append', help="только указанные режимы")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='vpnbot-bench-'), 'users.db')
+    os.environ['DATABASE_SYNCHRONOUS'] = args.synchronous
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    from database import db
+    from database.repository import repository, sync_repository
+    db.init_db()
+
+    def direct(name, *params):
+        return getattr(db, name)(*params)
+
+    def sync_write(name, *params):
+        return getattr(sync_repository, name)(*params)
+
+    async def loop_direct(name, *params):
+        return getattr(db, name)(*params)
+
+    async def loop_repository(name, *params):
+        return await getattr(repository, name)(*params)
+
+    modes = {
+        "threads-direct": lambda: run_threads("threads-direct", direct, args.concurrency, args.ops),
+        "threads-sync-repository": lambda: run_threads("threads-sync-repository", sync_write, args.concurrency, args.ops),
+        "loop-direct": lambda: asyncio.run(run_loop("loop-direct", loop_direct, args.concurrency, args.ops)),
+        "loop-repository": lambda: asyncio.run(run_loop("loop-repository", loop_repository, args.concurrency, args.ops)),
+    }
+    writes = args.concurrency * args.ops * 2
+    print(f"{args.concurrency} писателей × {args.ops} пар add_user + log_transaction, synchronous={args.synchronous}")
+    print(f"{'режим':<26} {'записей/с':>10} {'p50, мс':>9} {'p99, мс':>9} {'лаг цикла, мс':>14} {'пачка':>7}")
+    failed = False
+    for mode in args.mode or MODES:
+        before = dict(repository.writer.counters)
+        elapsed, latencies, lag, errors = modes[mode]()
+        batches = repository.writer.counters["batches"] - before.get("batches", 0)
+        batched = repository.writer.counters["writes"] - before.get("writes", 0)
+        print(f"{mode:<26} {writes / elapsed:>10.0f} {percentile(latencies, 0.5) * 1000:>9.2f} "
+              f"{percentile(latencies, 0.99) * 1000:>9.2f} {lag * 1000 if mode.startswith('loop') else 0:>14.1f} "
+              f"{batched / batches if batches else 1:>7.1f}")
+        if errors:
+            failed = True
+            print(f"  ошибки: {len(errors)}, первая: {errors[0]!r}")
+    repository.close()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
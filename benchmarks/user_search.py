@@ -0,0 +1,71 @@
+# Поиск пользователей: старый линейный проход по get_users() в Python против FTS5-индекса
+# Запуск: python -m benchmarks.user_search --users 100000 1000000
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+
+FIRST_NAMES = ["Иван", "Пётр", "Анна", "Мария", "Алексей", "Ольга", "Дмитрий", "Елена", "Сергей", "Наталья",
+               "Alex", "John", "Maria", "Kate", "Max", "Nick", "Olga", "Sam", "Tom", "Eva"]
+
+def random_username(rng):
+    if rng.random() < 0.3:
+        return None
+    return ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10))) + str(rng.randint(0, 999))
+
+def seed(conn, count, rng):
+    batch = []
+    for i in range(count):
+        batch.append((str(100000000 + i), f"{rng.choice(FIRST_NAMES)}{rng.randint(0, 99)}", random_username(rng)))
+        if len(batch) == 10000:
+            conn.executemany("INSERT INTO users (telegram_id, first_name, username) VALUES (?, ?, ?)", batch)
+            batch.clear()
+    if batch:
+        conn.executemany("INSERT INTO users (telegram_id, first_name, username) VALUES (?, ?, ?)", batch)
+
+# Старая реализация из web/app.py: все пользователи в память и фильтр в list comprehension
+def linear_search(get_users, query, page=1, per_page=10):
+    query = query.lower()
+    found = [u for u in get_users() if query in (u[1].lower() + (u[2] or '').lower() + (u[3] or '').lower())]
+    start = (page - 1) * per_page
+    return found[start:start + per_page], len(found)
+
+def timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - started) / repeat * 1000, result
+
+def run(size, queries, repeat):
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='vpnbot-search-'), 'users.db')
+    from database import connection
+    connection.DATABASE_PATH = os.environ['DATABASE_PATH']
+    connection.close_all_connections()
+
+    from database import db
+    db._search_index_available = None
+    db.init_db()
+
+    started = time.perf_counter()
+    with connection.transaction() as conn:
+        seed(conn, size, random.Random(size))
+    print(f"\n{size} пользователей, заполнение {time.perf_counter() - started:.1f} с")
+    print(f"{'запрос':<16}{'линейно, мс':>14}{'FTS5, мс':>12}{'найдено':>10}")
+    for query in queries:
+        linear_ms, (_, linear_total) = timed(lambda: linear_search(db.get_users, query), 1)
+        index_ms, (_, index_total) = timed(lambda: db.search_users(query), repeat)
+        print(f"{query:<16}{linear_ms:>14.1f}{index_ms:>12.2f}{index_total:>10}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    queries = ["100000042", "иван", "ann", "alex1", "@kate", "мар"]
+    for size in args.users:
+        run(size, queries, args.repeat)
+
+if __name__ == '__main__':
+    main()
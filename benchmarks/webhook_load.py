@@ -0,0 +1,115 @@
+# Нагрузочный стенд webhook-режима: поддельный Bot API (TELEGRAM_API_SERVER) с задержкой ответа,
+# настоящий Dispatcher бота и TelegramWebhook; синтетические Update отправляются POST-запросами
+# Запуск: python -m benchmarks.webhook_load --updates 5000 --senders 50 --concurrency 64 --api-latency 0.05
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import socket
+import tempfile
+import time
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def fake_bot_api(latency):
+    from aiohttp import web
+    message_ids = itertools.count(1)
+
+    async def method(request):
+        await asyncio.sleep(latency)
+        name = request.match_info["method"].lower()
+        if name in ("sendmessage", "editmessagetext"):
+            data = await request.post()
+            result = {"message_id": next(message_ids), "date": int(time.time()),
+                      "chat": {"id": int(data.get("chat_id", 1)), "type": "private"}, "text": data.get("text", "")}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", method)
+    return app
+
+def synthetic_update(update_id, users, rng):
+    user_id = rng.randrange(users) + 100000
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    kind = rng.random()
+    if kind < 0.3:
+        return {"update_id": update_id, "message": {"message_id": update_id, "date": int(time.time()), "chat": chat,
+                                                    "from": user, "text": "/start",
+                                                    "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}
+    if kind < 0.4:
+        return {"update_id": update_id, "message": {"message_id": update_id, "date": int(time.time()), "chat": chat,
+                                                    "from": user, "text": "привет"}}
+    data = rng.choice(["profile", "back_to_main", "buy_subscription"])
+    return {"update_id": update_id, "callback_query": {"id": str(update_id), "from": user, "chat_instance": "1", "data": data,
+                                                       "message": {"message_id": 1, "date": int(time.time()), "chat": chat}}}
+
+async def run(args):
+    from aiohttp import web, ClientSession
+    api_port, server_port = free_port(), free_port()
+    api_runner = web.AppRunner(fake_bot_api(args.api_latency))
+    await api_runner.setup()
+    await web.TCPSite(api_runner, "127.0.0.1", api_port).start()
+    os.environ['TELEGRAM_API_SERVER'] = f"http://127.0.0.1:{api_port}"
+
+    from database.db import init_db
+    from bot.bot import dp, bot
+    from bot.webhook import TelegramWebhook, create_server
+    init_db()
+    telegram_webhook = TelegramWebhook(dp, secret="bench", concurrency=args.concurrency)
+    runner = web.AppRunner(create_server(telegram_webhook, path="/telegram"))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", server_port).start()
+
+    rng = random.Random(0)
+    updates = [synthetic_update(i + 1, args.users, rng) for i in range(args.updates)]
+    queue = iter(updates)
+    url = f"http://127.0.0.1:{server_port}/telegram"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": "bench"}
+
+    async def sender(session):
+        for update in queue:
+            async with session.post(url, json=update, headers=headers) as response:
+                assert response.status == 200, response.status
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(sender(session) for _ in range(args.senders)))
+    accepted = time.perf_counter() - started
+    await telegram_webhook.drain()
+    elapsed = time.perf_counter() - started
+
+    stats = telegram_webhook.stats()
+    print(f"{args.updates} обновлений, {args.senders} отправителей, HANDLER_CONCURRENCY={args.concurrency}, "
+          f"задержка Bot API {args.api_latency * 1000:.0f} мс")
+    print(f"приём: {args.updates / accepted:.0f} обновл./с, обработка: {stats['processed'] / elapsed:.0f} обновл./с")
+    print(f"хендлер: p50 {stats['handler_p50_seconds'] * 1000:.1f} мс, p99 {stats['handler_p99_seconds'] * 1000:.1f} мс; "
+          f"с ожиданием в очереди: p50 {stats['p50_seconds'] * 1000:.1f} мс, p99 {stats['p99_seconds'] * 1000:.1f} мс; "
+          f"ошибок {stats['errors']}")
+
+    await runner.cleanup()
+    await (await bot.get_session()).close()
+    await api_runner.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--senders', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--api-latency', type=float, default=0.05, help="задержка ответа поддельного Bot API, с")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='vpnbot-webhook-'), 'users.db')
+    os.environ.setdefault('TELEGRAM_TOKEN', '123456789:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+    os.environ.setdefault('VITE_BASE_API', 'http://127.0.0.1:9/api')
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,38 @@
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
 from aiogram.utils import executor
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
-from database.db import add_user, update_user_subscription, get_tariff_price, get_marzban_username, add_pending_payment, get_pending_payment, remove_pending_payment
+from aiogram.utils.exceptions import MessageNotModified
+from database.repository import repository
 from dotenv import load_dotenv
+import asyncio
 import os
-from yookassa import Configuration, Payment
-from bot.marzban import create_marzban_subscription, get_marzban_subscription_url
+from bot.payments import gateway, PaymentGatewayTimeout
+from bot.settlement import settlement
+from bot.outbox import create_bot
+from bot.message_store import MessageStore
+from bot.throttling import ThrottlingMiddleware
+from monitoring.handlers import instrument_handlers
+from monitoring.log import get_logger
+from worker.poller import POLLER_FIRST_DELAY
+from bot.marzban import marzban
 from datetime import datetime
-import sqlite3
-from collections import defaultdict
 
 load_dotenv()
 
-bot = Bot(token=os.getenv('TELEGRAM_TOKEN'))
-dp = Dispatcher(bot)
-
-Configuration.account_id = os.getenv('SHOP_ID')
-Configuration.secret_key = os.getenv('SECRET_KEY')
+logger = get_logger(__name__)
 
-# Хранилище ID последнего сообщения для каждого чата
-last_message_ids = defaultdict(lambda: None)
+bot = create_bot()
+dp = Dispatcher(bot)
+throttling = ThrottlingMiddleware()
+dp.middleware.setup(throttling)
 
-# Функция проверки активной подписки
-def has_active_subscription(telegram_id):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT subscription_end FROM users WHERE telegram_id = ?", (telegram_id,))
-    user = c.fetchone()
-    conn.close()
-    return user and user[0] and user[0] > datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+# ID последнего сообщения для каждого чата: ограниченный LRU, сохраняется в базе
+last_messages = MessageStore()
 
 # Динамическое главное меню
-def get_main_menu(telegram_id):
+async def get_main_menu(telegram_id):
     main_menu = InlineKeyboardMarkup(row_width=2)
-    if not has_active_subscription(telegram_id):
+    if not await repository.has_active_subscription(telegram_id):
         main_menu.add(
             InlineKeyboardButton("Купить подписку", callback_data="buy_subscription")
         )
@@ -42,30 +41,34 @@ def get_main_menu(telegram_id):
     )
     return main_menu
 
-# Меню подписки с динамическими целыми ценами
-def get_subscription_menu():
-    month_price = int(get_tariff_price('month') or 300)
-    year_price = int(get_tariff_price('year') or 3650)
+# Меню подписки с динамическими целыми ценами; клавиатура собирается заново только при смене цен
+_subscription_menu_cache = {"version": None, "markup": None}
+
+async def get_subscription_menu():
+    version = await repository.get_tariffs_version()
+    if _subscription_menu_cache["version"] == version:
+        return _subscription_menu_cache["markup"]
+    month_price = int(await repository.get_tariff_price('month') or 300)
+    year_price = int(await repository.get_tariff_price('year') or 3650)
     subscription_menu = InlineKeyboardMarkup(row_width=1)
     subscription_menu.add(
         InlineKeyboardButton(f"1 месяц - {month_price} руб.", callback_data="buy_month"),
         InlineKeyboardButton(f"1 год - {year_price} руб.", callback_data="buy_year"),
         InlineKeyboardButton("Назад", callback_data="back_to_main")
     )
+    _subscription_menu_cache.update(version=version, markup=subscription_menu)
     return subscription_menu
 
 # Меню личного кабинета
-def profile_menu(telegram_id):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT subscription_type, subscription_end FROM users WHERE telegram_id = ?", (telegram_id,))
-    user = c.fetchone()
-    conn.close()
-    
+async def profile_menu(telegram_id):
+    user = await repository.get_user_subscription(telegram_id)
+
     menu = InlineKeyboardMarkup(row_width=1)
     if user and user[1] and user[1] > datetime.now().strftime('%Y-%m-%d %H:%M:%S'):
-        username = get_marzban_username(telegram_id)
-        subscription_url = get_marzban_subscription_url(username)
+        # Ссылка хранится в базе; в Marzban идём только для пользователей, у которых её ещё нет
+        subscription_url = await repository.get_subscription_url(telegram_id)
+        if not subscription_url:
+            subscription_url = await marzban.get_subscription_url(await repository.get_marzban_username(telegram_id))
         menu.add(
             InlineKeyboardButton("Открыть подписку", url=subscription_url),
             InlineKeyboardButton("Назад", callback_data="back_to_main")
@@ -87,56 +90,59 @@ def get_payment_menu(confirmation_url, payment_id):
     )
     return payment_menu
 
+# Редактирует последнее сообщение чата, а если его нет или оно старше 48 часов (Telegram
+# такое редактировать не даст) — сразу отправляет новое, без заведомо неудачного запроса
 async def update_message(chat_id, text, reply_markup=None):
-    last_message_id = last_message_ids[chat_id]
-    try:
-        if last_message_id:
+    last_message_id = await last_messages.get(chat_id)
+    if last_message_id:
+        try:
             await bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=last_message_id,
                 text=text,
                 reply_markup=reply_markup
             )
-        else:
-            sent_message = await bot.send_message(chat_id, text, reply_markup=reply_markup)
-            last_message_ids[chat_id] = sent_message.message_id
-    except Exception:
-        sent_message = await bot.send_message(chat_id, text, reply_markup=reply_markup)
-        last_message_ids[chat_id] = sent_message.message_id
+            return
+        except MessageNotModified:
+            return
+        except Exception:
+            pass
+    sent_message = await bot.send_message(chat_id, text, reply_markup=reply_markup)
+    await last_messages.set(chat_id, sent_message.message_id)
 
 @dp.message_handler(commands=['start'])
 async def start_command(message: types.Message):
     user_id = str(message.from_user.id)
     first_name = message.from_user.first_name
     username = message.from_user.username
-    add_user(user_id, first_name, username)
+    await repository.add_user(user_id, first_name, username)
     
     welcome_text = (
         "Добро пожаловать в Rafaello VPN!\n\n"
         "Мы предоставляем надежный и быстрый VPN-сервис для вашей безопасности и свободы в интернете."
     )
-    await update_message(message.chat.id, welcome_text, reply_markup=get_main_menu(user_id))
+    await update_message(message.chat.id, welcome_text, reply_markup=await get_main_menu(user_id))
 
 @dp.callback_query_handler(lambda c: c.data == "buy_subscription")
 async def process_buy_subscription(callback_query: types.CallbackQuery):
     chat_id = callback_query.message.chat.id
     await bot.answer_callback_query(callback_query.id)
-    await update_message(chat_id, "Выберите тариф:", reply_markup=get_subscription_menu())
+    await update_message(chat_id, "Выберите тариф:", reply_markup=await get_subscription_menu())
 
 @dp.callback_query_handler(lambda c: c.data in ["buy_month", "buy_year"])
 async def process_payment(callback_query: types.CallbackQuery):
     user_id = str(callback_query.from_user.id)
     chat_id = callback_query.message.chat.id
     
-    month_price = int(get_tariff_price('month') or 300)
-    year_price = int(get_tariff_price('year') or 3650)
+    month_price = int(await repository.get_tariff_price('month') or 300)
+    year_price = int(await repository.get_tariff_price('year') or 3650)
     
     amount = month_price if callback_query.data == "buy_month" else year_price
     days = 30 if callback_query.data == "buy_month" else 365
     subscription_type = "month" if callback_query.data == "buy_month" else "year"
 
     # Проверяем, есть ли незавершённый платёж
-    pending_payment = get_pending_payment(user_id)
+    pending_payment = await repository.get_pending_payment(user_id)
     if pending_payment:
         payment_id, existing_type, existing_amount, confirmation_url = pending_payment
         payment_text = f"Оплатите подписку ({existing_type}):"
@@ -145,16 +151,20 @@ async def process_payment(callback_query: types.CallbackQuery):
         return
 
     # Создаём новый платёж
-    payment = Payment.create({
-        "amount": {"value": str(amount), "currency": "RUB"},
-        "confirmation": {"type": "redirect", "return_url": "https://t.me/your_bot_username"},
-        "capture": True,
-        "description": f"Подписка {subscription_type} для {user_id}",
-        "metadata": {"user_id": user_id},
-        "save_payment_method": True
-    })
-
-    add_pending_payment(user_id, payment.id, subscription_type, amount, payment.confirmation.confirmation_url)
+    try:
+        payment = await gateway.create_payment({
+            "amount": {"value": str(amount), "currency": "RUB"},
+            "confirmation": {"type": "redirect", "return_url": "https://t.me/your_bot_username"},
+            "capture": True,
+            "description": f"Подписка {subscription_type} для {user_id}",
+            "metadata": {"user_id": user_id, "subscription_type": subscription_type},
+            "save_payment_method": True
+        })
+    except PaymentGatewayTimeout:
+        await bot.answer_callback_query(callback_query.id, text="Платёжный сервис не отвечает. Попробуйте позже.")
+        return
+
+    await repository.add_pending_payment(user_id, payment.id, subscription_type, amount, payment.confirmation.confirmation_url, POLLER_FIRST_DELAY)
     payment_text = f"Оплатите подписку ({subscription_type}):"
     await update_message(chat_id, payment_text, reply_markup=get_payment_menu(payment.confirmation.confirmation_url, payment.id))
     await bot.answer_callback_query(callback_query.id)
@@ -165,30 +175,32 @@ async def check_payment(callback_query: types.CallbackQuery):
     chat_id = callback_query.message.chat.id
     payment_id = callback_query.data.split("_")[2]
 
-    pending_payment = get_pending_payment(user_id)
+    pending_payment = await repository.get_pending_payment(user_id)
     if not pending_payment or pending_payment[0] != payment_id:
         await bot.answer_callback_query(callback_query.id, text="Этот платёж не найден или уже обработан.")
-        await update_message(chat_id, "Главное меню:", reply_markup=get_main_menu(user_id))
+        await update_message(chat_id, "Главное меню:", reply_markup=await get_main_menu(user_id))
         return
 
-    payment = Payment.find_one(payment_id)
-    if payment.status == "succeeded":
-        # Используем subscription_type из pending_payment, а не вычисляем заново
-        payment_id, subscription_type, amount, confirmation_url = pending_payment
-        days = 30 if subscription_type == "month" else 365
-        
-        username = get_marzban_username(user_id)
-        subscription_url = create_marzban_subscription(username, days)
-        end_date = update_user_subscription(user_id, subscription_type, days, payment.payment_method.id)
-        remove_pending_payment(user_id, payment_id)
-        
+    # Повторные нажатия и одновременный webhook склеиваются в одну выдачу (bot/settlement.py)
+    try:
+        result = await settlement.settle_async(payment_id, "check_payment")
+    except PaymentGatewayTimeout:
+        await bot.answer_callback_query(callback_query.id, text="Платёжный сервис не отвечает. Попробуйте позже.")
+        return
+    except Exception:
+        await bot.answer_callback_query(callback_query.id, text="Не удалось активировать подписку. Попробуйте позже.")
+        return
+    if result.state == "settled":
+        subscription_type, end_date = await repository.get_user_subscription(user_id) or (result.subscription_type, result.end_date)
         profile_text = (
             f"Ваш личный кабинет:\n"
             f"Тариф: {subscription_type}\n"
             f"Дата окончания: {end_date}"
         )
         await bot.answer_callback_query(callback_query.id, text="Платёж подтверждён!")
-        await update_message(chat_id, profile_text, reply_markup=profile_menu(user_id))
+        await update_message(chat_id, profile_text, reply_markup=await profile_menu(user_id))
+    elif result.state == "settling":
+        await bot.answer_callback_query(callback_query.id, text="Платёж обрабатывается, подписка скоро будет активна.")
     else:
         await bot.answer_callback_query(callback_query.id, text="Платёж ещё не подтверждён. Попробуйте позже.")
         payment_text = f"Оплатите подписку ({pending_payment[1]}):"
@@ -198,11 +210,7 @@ async def check_payment(callback_query: types.CallbackQuery):
 async def process_profile(callback_query: types.CallbackQuery):
     user_id = str(callback_query.from_user.id)
     chat_id = callback_query.message.chat.id
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT subscription_type, subscription_end FROM users WHERE telegram_id = ?", (user_id,))
-    user = c.fetchone()
-    conn.close()
+    user = await repository.get_user_subscription(user_id)
 
     if user and user[1] and user[1] > datetime.now().strftime('%Y-%m-%d %H:%M:%S'):
         subscription_type = user[0]
@@ -218,23 +226,33 @@ async def process_profile(callback_query: types.CallbackQuery):
         profile_text = "У вас нет активной подписки. Купите подписку, чтобы получить доступ к VPN!"
     
     await bot.answer_callback_query(callback_query.id)
-    await update_message(chat_id, profile_text, reply_markup=profile_menu(user_id))
+    await update_message(chat_id, profile_text, reply_markup=await profile_menu(user_id))
 
 @dp.callback_query_handler(lambda c: c.data == "back_to_main")
 async def process_back_to_main(callback_query: types.CallbackQuery):
     user_id = str(callback_query.from_user.id)
     chat_id = callback_query.message.chat.id
     await bot.answer_callback_query(callback_query.id)
-    await update_message(chat_id, "Главное меню:", reply_markup=get_main_menu(user_id))
+    await update_message(chat_id, "Главное меню:", reply_markup=await get_main_menu(user_id))
 
 @dp.message_handler()
 async def handle_any_message(message: types.Message):
     user_id = str(message.from_user.id)
     error_text = "Пожалуйста, используйте команды или кнопки для взаимодействия с ботом."
-    await update_message(message.chat.id, error_text, reply_markup=get_main_menu(user_id))
+    await update_message(message.chat.id, error_text, reply_markup=await get_main_menu(user_id))
+
+# Метрики хендлеров: после регистрации всех хендлеров выше
+instrument_handlers(dp)
 
 async def on_startup(_):
-    print("Бот запущен")
+    marzban.start_probes()
+    logger.info("Бот запущен")
+
+async def on_shutdown(_):
+    await last_messages.flush()
+    await marzban.close()
+    # Дописать записи, ещё стоящие в очереди
+    await asyncio.get_running_loop().run_in_executor(None, repository.close)
 
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file
@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from database.repository import repository
+from monitoring.log import get_logger
+
+MESSAGE_STORE_SIZE = int(os.getenv('MESSAGE_STORE_SIZE', 10000))
+MESSAGE_STORE_FLUSH_SIZE = int(os.getenv('MESSAGE_STORE_FLUSH_SIZE', 100))
+MESSAGE_STORE_FLUSH_INTERVAL = float(os.getenv('MESSAGE_STORE_FLUSH_INTERVAL', 5))
+# Telegram не даёт редактировать сообщения старше 48 часов
+MESSAGE_EDIT_WINDOW = int(os.getenv('MESSAGE_EDIT_WINDOW', 48 * 3600))
+PRUNE_INTERVAL = 3600
+
+logger = get_logger(__name__)
+
+# Последнее сообщение бота в каждом чате: (message_id, sent_at в epoch-секундах).
+# В памяти — LRU на MESSAGE_STORE_SIZE чатов, вытесненные и новые после перезапуска чаты
+# дочитываются из таблицы last_messages. Запись в базу отложенная: изменения копятся и уходят
+# одной транзакцией, когда их набралось MESSAGE_STORE_FLUSH_SIZE или прошло MESSAGE_STORE_FLUSH_INTERVAL.
+# В базу ходит только через repository — цикл событий не ждёт SQLite
+class MessageStore:
+    def __init__(self, max_size=MESSAGE_STORE_SIZE, flush_size=MESSAGE_STORE_FLUSH_SIZE,
+                 flush_interval=MESSAGE_STORE_FLUSH_INTERVAL, edit_window=MESSAGE_EDIT_WINDOW):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.edit_window = edit_window
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._dirty = {}
+        self._flushed_at = time.monotonic()
+        self._pruned_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def _remember(self, chat_id, entry):
+        self._entries[chat_id] = entry
+        self._entries.move_to_end(chat_id)
+        # Несохранённая запись вытесненного чата остаётся в _dirty до ближайшего flush
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    # ID сообщения, которое ещё можно отредактировать, иначе None (нового чата нет и в базе —
+    # это тоже запоминается, чтобы не ходить в базу на каждое нажатие)
+    async def get(self, chat_id):
+        with self._lock:
+            found = chat_id in self._entries
+            if found:
+                self._entries.move_to_end(chat_id)
+                entry = self._entries[chat_id]
+                self.hits += 1
+            elif chat_id in self._dirty:
+                found = True
+                entry = self._dirty[chat_id]
+                self._remember(chat_id, entry)
+                self.hits += 1
+        if not found:
+            entry = await repository.get_last_message(chat_id)
+            with self._lock:
+                self.misses += 1
+                if chat_id not in self._entries:
+                    self._remember(chat_id, entry)
+        if entry is None:
+            return None
+        message_id, sent_at = entry
+        if time.time() - sent_at >= self.edit_window:
+            with self._lock:
+                self.stale += 1
+            return None
+        return message_id
+
+    async def set(self, chat_id, message_id, sent_at=None):
+        entry = (message_id, int(sent_at if sent_at is not None else time.time()))
+        with self._lock:
+            self._remember(chat_id, entry)
+            self._dirty[chat_id] = entry
+            due = len(self._dirty) >= self.flush_size or time.monotonic() - self._flushed_at >= self.flush_interval
+        if due:
+            await self.flush()
+
+    async def flush(self):
+        with self._lock:
+            entries = [(chat_id, message_id, sent_at) for chat_id, (message_id, sent_at) in self._dirty.items()]
+            self._dirty.clear()
+            self._flushed_at = time.monotonic()
+            prune = self._flushed_at - self._pruned_at >= PRUNE_INTERVAL
+            if prune:
+                self._pruned_at = self._flushed_at
+        if entries:
+            try:
+                await repository.save_last_messages(entries)
+            except Exception:
+                logger.exception(f"Не удалось сохранить {len(entries)} последних сообщений")
+                # Вернуть в очередь на запись всё, что не перезаписано новыми сообщениями
+                with self._lock:
+                    for chat_id, message_id, sent_at in entries:
+                        self._dirty.setdefault(chat_id, (message_id, sent_at))
+        if prune:
+            await repository.prune_last_messages(int(time.time()) - self.edit_window)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "pending_writes": len(self._dirty),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale
+            }
@@ -0,0 +1,193 @@
+from aiogram import Bot
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from aiogram.utils.exceptions import (RetryAfter, BotBlocked, BotKicked, ChatNotFound, UserDeactivated,
+                                      CantInitiateConversation, CantTalkWithBots)
+from collections import Counter
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from bot.ratelimit import TokenBucket
+from database.db import enqueue_message, claim_outbox_messages, finish_outbox_messages, get_outbox_stats, log_transaction
+from database.repository import sync_repository
+
+load_dotenv()
+
+TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+# TELEGRAM_API_SERVER — свой Bot API сервер (telegram-bot-api) вместо api.telegram.org
+TELEGRAM_API_SERVER = os.getenv('TELEGRAM_API_SERVER')
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и не больше одного в секунду в один чат
+OUTBOX_RATE = float(os.getenv('OUTBOX_RATE', 25))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 1))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 100))
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', 20))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_RETRY_DELAY = int(os.getenv('OUTBOX_RETRY_DELAY', 30))
+OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', 300))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 2))
+
+# Пользователь заблокировал бота или удалил аккаунт: повторять бессмысленно
+UNDELIVERABLE = (BotBlocked, BotKicked, ChatNotFound, UserDeactivated, CantInitiateConversation, CantTalkWithBots)
+
+def create_bot():
+    server = TelegramAPIServer.from_base(TELEGRAM_API_SERVER) if TELEGRAM_API_SERVER else TELEGRAM_PRODUCTION
+    return Bot(token=TELEGRAM_TOKEN, server=server)
+
+_wake = threading.Event()
+
+# Отправка сообщения из любого потока и процесса (админка, планировщик): сообщение записывается
+# в таблицу outbox и уходит из OutboxSender планировщика. Возвращает id записи в очереди
+def submit(telegram_id, text, reply_markup=None):
+    if reply_markup is not None and not isinstance(reply_markup, str):
+        reply_markup = reply_markup.as_json()
+    message_id = sync_repository.write(enqueue_message, telegram_id, text, reply_markup)
+    _wake.set()
+    return message_id
+
+def notify_user(telegram_id, message, reply_markup=None):
+    return submit(telegram_id, message, reply_markup)
+
+# Итоги пачки отправки одной записью в очереди BatchWriter
+def _record_results(sent, retries, failed):
+    finish_outbox_messages(sent, retries, [(message.id, error) for message, error in failed])
+    # Недоставленные сообщения рассылок в журнал не пишем: заблокировавшие бота пользователи засорили бы его
+    for message, error in failed:
+        if message.broadcast_id is None:
+            log_transaction(message.telegram_id, "error", f"Ошибка отправки сообщения: {error}")
+
+# Разбор очереди outbox с соблюдением лимитов Telegram. Работает в планировщике — единственном
+# владельце аренды, поэтому общий лимит OUTBOX_RATE действует на весь бот, а не на процесс.
+# Сообщения одного чата в пачке уходят по очереди с интервалом 1/OUTBOX_CHAT_RATE; RetryAfter
+# приостанавливает всю отправку на указанное Telegram время, а сообщение возвращается в очередь
+class OutboxSender:
+    def __init__(self, bot_factory=create_bot, rate=OUTBOX_RATE, chat_rate=OUTBOX_CHAT_RATE, batch_size=OUTBOX_BATCH_SIZE,
+                 concurrency=OUTBOX_CONCURRENCY, max_attempts=OUTBOX_MAX_ATTEMPTS, retry_delay=OUTBOX_RETRY_DELAY,
+                 lease_seconds=OUTBOX_LEASE_SECONDS, poll_interval=OUTBOX_POLL_INTERVAL):
+        self.bot_factory = bot_factory
+        # Без запаса токенов: лимит Telegram считается по секундам, пачка сверх rate в первую секунду недопустима
+        self.bucket = TokenBucket(rate, capacity=1)
+        self.chat_interval = 1 / chat_rate
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.outcomes = Counter()
+        self._outcomes_lock = threading.Lock()
+        self._last_sent = {}
+        self._paused_until = 0.0
+        self._loop = None
+        self._bot = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._bot = self.bot_factory()
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="outbox", daemon=True).start()
+            return self._loop
+
+    async def _acquire(self, chat_id):
+        wait = self._last_sent.get(chat_id, 0.0) + self.chat_interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        while True:
+            pause = self._paused_until - time.monotonic()
+            wait = pause if pause > 0 else self.bucket.try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def _send(self, message):
+        try:
+            await self._bot.send_message(message.telegram_id, message.text, reply_markup=message.reply_markup)
+            return "sent", None
+        except RetryAfter as e:
+            self._paused_until = max(self._paused_until, time.monotonic() + e.timeout)
+            return "flood", e
+        except UNDELIVERABLE as e:
+            return "undeliverable", e
+        except Exception as e:
+            return "error", e
+
+    async def _send_chat(self, semaphore, messages):
+        results = []
+        async with semaphore:
+            for message in messages:
+                await self._acquire(message.telegram_id)
+                results.append((message, *await self._send(message)))
+                self._last_sent[message.telegram_id] = time.monotonic()
+        return results
+
+    async def _send_batch(self, messages):
+        chats = {}
+        for message in messages:
+            chats.setdefault(message.telegram_id, []).append(message)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        groups = await asyncio.gather(*(self._send_chat(semaphore, chat_messages) for chat_messages in chats.values()))
+        now = time.monotonic()
+        self._last_sent = {chat_id: sent_at for chat_id, sent_at in self._last_sent.items()
+                           if sent_at + self.chat_interval > now}
+        return [result for group in groups for result in group]
+
+    def _finish(self, results):
+        sent, retries, failed, outcomes = [], [], [], Counter()
+        for message, outcome, error in results:
+            if outcome == "sent":
+                sent.append(message.id)
+            elif outcome == "flood":
+                retries.append((message.id, error.timeout, str(error), False))
+            elif outcome == "error" and message.attempts < self.max_attempts:
+                retries.append((message.id, self.retry_delay * message.attempts, str(error), True))
+                outcome = "retry"
+            else:
+                failed.append((message, str(error)))
+                outcome = "failed" if outcome == "error" else outcome
+            outcomes[outcome] += 1
+        sync_repository.write(_record_results, sent, retries, failed)
+        with self._outcomes_lock:
+            self.outcomes.update(outcomes)
+
+    def run_once(self):
+        processed = 0
+        while True:
+            messages = sync_repository.write(claim_outbox_messages, self.batch_size, self.lease_seconds)
+            if not messages:
+                return processed
+            results = asyncio.run_coroutine_threadsafe(self._send_batch(messages), self._get_loop()).result()
+            self._finish(results)
+            processed += len(messages)
+
+    # Пауза между проходами: submit() в этом же процессе будит отправку сразу,
+    # сообщения из других процессов подбираются по таймеру
+    def wait(self):
+        _wake.wait(self.poll_interval)
+        _wake.clear()
+
+    def stats(self):
+        with self._outcomes_lock:
+            outcomes = dict(self.outcomes)
+        return {"outcomes": outcomes, "outbox": get_outbox_stats()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Очередь исходящих сообщений Telegram")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('stats', help="состояние очереди")
+    commands.add_parser('drain', help="отправить очередь один раз и выйти")
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        print(json.dumps(get_outbox_stats(), ensure_ascii=False))
+    else:
+        sender = OutboxSender()
+        print(f"Отправлено из очереди: {sender.run_once()}")
+        print(json.dumps(sender.stats(), ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,134 @@
 from yookassa import Configuration, Payment
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import asyncio
+import threading
+import time
 import os
+from monitoring.metrics import yookassa_seconds
 
 load_dotenv()
 
-Configuration.account_id = os.getenv('YOOKASSA_SHOP_ID')
-Configuration.secret_key = os.getenv('YOOKASSA_SECRET_KEY')
+# Единая конфигурация ЮKassa для бота, админки и автопродления.
+# YOOKASSA_* оставлены для совместимости со старыми .env
+YOOKASSA_SHOP_ID = os.getenv('SHOP_ID') or os.getenv('YOOKASSA_SHOP_ID')
+YOOKASSA_SECRET_KEY = os.getenv('SECRET_KEY') or os.getenv('YOOKASSA_SECRET_KEY')
+YOOKASSA_MAX_CONCURRENCY = int(os.getenv('YOOKASSA_MAX_CONCURRENCY', 8))
+YOOKASSA_TIMEOUT = float(os.getenv('YOOKASSA_TIMEOUT', 20))
+YOOKASSA_MAX_ATTEMPTS = int(os.getenv('YOOKASSA_MAX_ATTEMPTS', 3))
+
+class PaymentGatewayError(Exception):
+    pass
+
+class PaymentGatewayTimeout(PaymentGatewayError):
+    pass
+
+class LatencyStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def observe(self, seconds, error=False, timeout=False):
+        with self._lock:
+            self.calls += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            if error:
+                self.errors += 1
+            if timeout:
+                self.timeouts += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "avg_seconds": self.total_seconds / self.calls if self.calls else 0.0,
+                "max_seconds": self.max_seconds
+            }
+
+# SDK ЮKassa синхронный: каждый вызов — полный HTTPS round-trip. Шлюз выполняет вызовы
+# в ограниченном пуле потоков, чтобы не блокировать цикл aiogram, ограничивает число
+# одновременных запросов и время ожидания одного вызова
+class YooKassaGateway:
+    def __init__(self, account_id, secret_key, max_concurrency=YOOKASSA_MAX_CONCURRENCY,
+                 timeout=YOOKASSA_TIMEOUT, max_attempts=YOOKASSA_MAX_ATTEMPTS, payment_api=Payment):
+        Configuration.configure(account_id, secret_key, max_attempts=max_attempts)
+        self.timeout = timeout
+        self.payment_api = payment_api
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="yookassa")
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _observe(self, operation, seconds, error=False, timeout=False):
+        with self._stats_lock:
+            stats = self._stats.setdefault(operation, LatencyStats())
+        stats.observe(seconds, error, timeout)
+        yookassa_seconds.observe(seconds, operation=operation, outcome="timeout" if timeout else "error" if error else "ok")
+
+    def _timed(self, operation, func, *args):
+        started = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception:
+            self._observe(operation, time.perf_counter() - started, error=True)
+            raise
+        self._observe(operation, time.perf_counter() - started)
+        return result
+
+    def _submit(self, operation, func, *args):
+        return self._executor.submit(self._timed, operation, func, *args)
+
+    def _wait(self, operation, future, timeout):
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self._observe(operation, timeout, error=True, timeout=True)
+            raise PaymentGatewayTimeout(f"ЮKassa не ответила за {timeout} с ({operation})")
+
+    async def _call(self, operation, func, *args, timeout=None):
+        timeout = timeout or self.timeout
+        future = asyncio.wrap_future(self._submit(operation, func, *args))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._observe(operation, timeout, error=True, timeout=True)
+            raise PaymentGatewayTimeout(f"ЮKassa не ответила за {timeout} с ({operation})")
+
+    # Асинхронный API для хендлеров бота
+    async def create_payment(self, params, idempotency_key=None, timeout=None):
+        return await self._call("create", self.payment_api.create, params, idempotency_key, timeout=timeout)
+
+    async def find_payment(self, payment_id, timeout=None):
+        return await self._call("find_one", self.payment_api.find_one, payment_id, timeout=timeout)
+
+    # Синхронный API для Flask и фоновых потоков: тот же пул и те же ограничения
+    def create_payment_sync(self, params, idempotency_key=None, timeout=None):
+        return self._wait("create", self._submit("create", self.payment_api.create, params, idempotency_key),
+                          timeout or self.timeout)
+
+    def find_payment_sync(self, payment_id, timeout=None):
+        return self._wait("find_one", self._submit("find_one", self.payment_api.find_one, payment_id),
+                          timeout or self.timeout)
+
+    def stats(self):
+        with self._stats_lock:
+            operations = list(self._stats.items())
+        return {operation: stats.snapshot() for operation, stats in operations}
+
+gateway = YooKassaGateway(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
 
 def create_payment(amount, user_id):
-    payment = Payment.create({
+    payment = gateway.create_payment_sync({
         "amount": {"value": str(amount), "currency": "RUB"},
         "confirmation": {"type": "redirect", "return_url": "https://your-site.com/success"},
         "description": f"Подписка для Telegram ID {user_id}",
         "metadata": {"user_id": str(user_id)}
     })
-    return payment.confirmation.confirmation_url
\ No newline at end of file
+    return payment.confirmation.confirmation_url
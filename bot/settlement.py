@@ -0,0 +1,174 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import Counter
+import asyncio
+import os
+import threading
+from datetime import datetime, timedelta
+from bot.marzban import MarzbanError, create_marzban_user, set_marzban_expire
+from bot.payments import gateway
+from database.db import (Settlement, get_settlement, note_pending_settlement, claim_settlement, plan_settlement,
+                         skip_settlement, finish_settlement, is_payment_recorded, get_pending_payment, remove_pending_payment,
+                         get_tariff_price, get_user_state, get_marzban_username, update_user_subscription,
+                         record_payment, log_transaction, to_epoch)
+from database.repository import sync_repository
+from monitoring.log import get_logger
+
+SETTLEMENT_LEASE_SECONDS = int(os.getenv('SETTLEMENT_LEASE_SECONDS', 300))
+SETTLEMENT_WORKERS = int(os.getenv('SETTLEMENT_WORKERS', 8))
+
+logger = get_logger(__name__)
+
+# Единая выдача подписки по успешному платежу для «Проверить платёж», webhook и автопродления.
+# Внутри процесса одновременные вызовы по одному payment_id склеиваются: удалённые вызовы
+# делает только первый, остальные ждут его результат. Между процессами (бот, админка)
+# выдачу защищает атомарный захват строки settlements. create_user(username, expire) и
+# set_expire(username, expire) получают дату окончания, зафиксированную за платежом.
+# Записи идут через общую очередь sync_repository, чтения — напрямую из потока выдачи
+class SettlementService:
+    def __init__(self, gateway, create_user, set_expire,
+                 lease_seconds=SETTLEMENT_LEASE_SECONDS, workers=SETTLEMENT_WORKERS):
+        self.gateway = gateway
+        self.create_user = create_user
+        self.set_expire = set_expire
+        self.lease_seconds = lease_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="settlement")
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._counters = Counter()
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _join(self, payment_id):
+        with self._lock:
+            future = self._in_flight.get(payment_id)
+            if future is not None:
+                self._counters["coalesced"] += 1
+                return future, False
+            future = Future()
+            self._in_flight[payment_id] = future
+            return future, True
+
+    def _lead(self, future, payment_id, source, payment):
+        try:
+            future.set_result(self._settle(payment_id, source, payment))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._in_flight.pop(payment_id, None)
+
+    # Синхронный вход для потоков админки, воркеров очереди и автопродления.
+    # payment — уже полученный объект платежа, если он есть: тогда find_one не вызывается
+    def settle(self, payment_id, source, payment=None):
+        future, leader = self._join(payment_id)
+        if leader:
+            self._lead(future, payment_id, source, payment)
+        return future.result()
+
+    # Асинхронный вход для хендлеров бота: ожидающие не занимают потоков пула
+    async def settle_async(self, payment_id, source, payment=None):
+        future, leader = self._join(payment_id)
+        if leader:
+            self._executor.submit(self._lead, future, payment_id, source, payment)
+        return await asyncio.wrap_future(future)
+
+    def _settle(self, payment_id, source, payment):
+        settlement = get_settlement(payment_id)
+        if settlement and settlement.state == "settled":
+            self._count("already_settled")
+            return settlement
+        if settlement and settlement.state == "skipped":
+            return settlement
+        # Платёж, выданный до появления settlements, уже есть в журнале оплат
+        if settlement is None and is_payment_recorded(payment_id):
+            self._count("already_settled")
+            return Settlement(payment_id, "settled", None, None)
+
+        if payment is None:
+            self._count("find_payment")
+            payment = self.gateway.find_payment_sync(payment_id)
+        metadata = payment.metadata or {}
+        if not metadata.get("user_id"):
+            # Иначе подписка выдалась бы пользователю "None"
+            self._count("skipped")
+            logger.warning(f"Платёж {payment_id} без user_id в metadata: подписка не выдаётся")
+            sync_repository.write(skip_settlement, payment_id, source, "нет user_id в metadata")
+            return Settlement(payment_id, "skipped", None, None)
+        telegram_id = str(metadata["user_id"])
+        if payment.status != "succeeded":
+            sync_repository.write(note_pending_settlement, payment_id, telegram_id, source)
+            return Settlement(payment_id, "pending", None, None)
+
+        claimed, settlement = sync_repository.write(claim_settlement, payment_id, telegram_id, source, self.lease_seconds)
+        if not claimed:
+            self._count("claimed_elsewhere")
+            return settlement
+
+        try:
+            subscription_type, end_date = self._provision(payment, telegram_id, metadata, source)
+        except Exception as e:
+            sync_repository.write(_fail, payment_id, telegram_id, str(e))
+            raise
+        sync_repository.write(finish_settlement, payment_id, "settled", subscription_type, end_date)
+        self._count("settled")
+        return Settlement(payment_id, "settled", subscription_type, end_date)
+
+    def _provision(self, payment, telegram_id, metadata, source):
+        # Автоплатёж продлевает текущую подписку, покупка создаёт пользователя в Marzban
+        extend = "renewal_job" in metadata
+        pending_payment = get_pending_payment(telegram_id)
+        if pending_payment and pending_payment[0] == payment.id:
+            subscription_type = pending_payment[1]
+        elif metadata.get("subscription_type"):
+            subscription_type = metadata["subscription_type"]
+        else:
+            # Если записи нет, используем сумму для определения типа подписки (запасной вариант)
+            subscription_type = "month" if float(payment.amount.value) == get_tariff_price('month') else "year"
+        days = 30 if subscription_type == "month" else 365
+        payment_method_id = payment.payment_method.id if payment.payment_method else None
+        # Дата окончания считается один раз и сохраняется за платежом: повтор после сбоя на любом шаге
+        # ниже или после истёкшей аренды ставит ту же дату, а не добавляет дни ещё раз
+        state = get_user_state(telegram_id)
+        start = max(datetime.now(), datetime.fromtimestamp(state.subscription_end)) if state and state.subscription_end else datetime.now()
+        expire = sync_repository.write(_plan, payment, telegram_id, to_epoch(start + timedelta(days=days)))
+        username = get_marzban_username(telegram_id)
+        self._count("marzban")
+        if extend:
+            self.set_expire(username, expire)
+        else:
+            try:
+                self.create_user(username, expire)
+            except MarzbanError as e:
+                # Пользователь уже есть в Marzban (старая подписка ещё не удалена или повтор выдачи)
+                if e.status != 409:
+                    raise
+                self.set_expire(username, expire)
+        end_date = sync_repository.write(_activate, payment, telegram_id, subscription_type, days, payment_method_id,
+                                         expire, source)
+        return subscription_type, end_date
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, in_flight=len(self._in_flight))
+
+# Операции записи выдачи: каждая — одна запись в очереди BatchWriter и одна точка сохранения
+def _plan(payment, telegram_id, expire):
+    expire = plan_settlement(payment.id, expire)
+    log_transaction(telegram_id, "processing", f"Обработка платежа на {payment.amount.value} руб.")
+    return expire
+
+def _fail(payment_id, telegram_id, error):
+    finish_settlement(payment_id, "failed", error=error)
+    log_transaction(telegram_id, "error", f"Ошибка активации подписки по платежу {payment_id}: {error}")
+
+def _activate(payment, telegram_id, subscription_type, days, payment_method_id, expire, source):
+    end_date = update_user_subscription(telegram_id, subscription_type, days, payment_method_id,
+                                        until=datetime.fromtimestamp(expire))
+    record_payment(payment.id, telegram_id, subscription_type, payment.amount.value, source)
+    remove_pending_payment(telegram_id, payment.id)
+    log_transaction(telegram_id, "success", f"Подписка {subscription_type} активирована до {end_date} ({source})")
+    return end_date
+
+settlement = SettlementService(gateway, create_marzban_user, set_marzban_expire)
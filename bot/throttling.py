@@ -0,0 +1,117 @@
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from collections import Counter, OrderedDict
+import math
+import os
+import time
+
+# Общий лимит на пользователя: THROTTLE_RATE действий в секунду, не больше THROTTLE_BURST подряд
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', 1))
+THROTTLE_BURST = int(os.getenv('THROTTLE_BURST', 5))
+# Действия, которые ходят в ЮKassa и Marzban, ограничены отдельно: нажатий в минуту и запас подряд
+THROTTLE_PAYMENT_PER_MINUTE = float(os.getenv('THROTTLE_PAYMENT_PER_MINUTE', 6))
+THROTTLE_CHECK_PER_MINUTE = float(os.getenv('THROTTLE_CHECK_PER_MINUTE', 12))
+THROTTLE_MAX_KEYS = int(os.getenv('THROTTLE_MAX_KEYS', 100000))
+
+ACTION_LIMITS = {
+    "create_payment": (THROTTLE_PAYMENT_PER_MINUTE / 60, 2),
+    "check_payment": (THROTTLE_CHECK_PER_MINUTE / 60, 3),
+}
+
+def callback_action(data):
+    if data in ("buy_month", "buy_year"):
+        return "create_payment"
+    if data and data.startswith("check_payment_"):
+        return "check_payment"
+    return None
+
+# Защита от частых нажатий до фильтров и хендлеров:
+# - повторное нажатие, пока первое ещё обрабатывается, не запускает хендлер второй раз —
+#   пользователь увидит результат первого (для дорогих действий ключ — действие, а не кнопка:
+#   «1 месяц» и «1 год» подряд не создадут два платежа);
+# - сверх общего или своего лимита действия callback отвечается коротким всплывающим текстом,
+#   а сообщения просто пропускаются.
+# Состояние лимитов — в LRU на THROTTLE_MAX_KEYS ключей (пользователь, действие)
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, rate=THROTTLE_RATE, burst=THROTTLE_BURST, action_limits=ACTION_LIMITS, max_keys=THROTTLE_MAX_KEYS):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.action_limits = action_limits
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._in_flight = set()
+        self.counters = Counter()
+        self.actions = Counter()
+
+    # Токен-бакет на ключ: (токены, время обновления). Возвращает 0, если действие разрешено,
+    # иначе сколько секунд ждать
+    def _take(self, key, rate, burst):
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def _check(self, user_id, action):
+        wait = self._take((user_id, None), self.rate, self.burst)
+        if wait:
+            return "throttled_user", wait
+        if action in self.action_limits:
+            wait = self._take((user_id, action), *self.action_limits[action])
+            if wait:
+                return "throttled_action", wait
+        return None, 0.0
+
+    # Ответ на отброшенное нажатие только убирает «часики» у кнопки; устаревший callback не ошибка
+    async def _answer(self, callback_query, text):
+        try:
+            await callback_query.answer(text)
+        except Exception:
+            pass
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        outcome, _ = self._check(message.from_user.id, None)
+        if outcome:
+            self.counters[outcome] += 1
+            raise CancelHandler()
+        self.counters["passed"] += 1
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        user_id = callback_query.from_user.id
+        action = callback_action(callback_query.data)
+        self.actions[action or "other"] += 1
+        key = (user_id, action or callback_query.data)
+        if key in self._in_flight:
+            self.counters["duplicate"] += 1
+            await self._answer(callback_query, "Запрос уже обрабатывается…")
+            raise CancelHandler()
+        outcome, wait = self._check(user_id, action)
+        if outcome:
+            self.counters[outcome] += 1
+            await self._answer(callback_query, f"Слишком часто. Попробуйте через {math.ceil(wait)} с.")
+            raise CancelHandler()
+        self.counters["passed"] += 1
+        self._in_flight.add(key)
+        data["throttling_key"] = key
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        key = data.get("throttling_key")
+        if key is not None:
+            self._in_flight.discard(key)
+
+    def stats(self):
+        return {
+            "counters": dict(self.counters),
+            "actions": dict(self.actions),
+            "in_flight": len(self._in_flight),
+            "tracked_keys": len(self._buckets)
+        }
@@ -0,0 +1,108 @@
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+from collections import deque
+import asyncio
+import hmac
+import os
+import time
+from monitoring.log import get_logger
+
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+HANDLER_CONCURRENCY = int(os.getenv('HANDLER_CONCURRENCY', 64))
+
+logger = get_logger(__name__)
+
+# Приём обновлений Telegram по webhook: обновление принимается и сразу подтверждается 200,
+# обработка идёт в фоне, одновременно не больше HANDLER_CONCURRENCY хендлеров.
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token сверяется с WEBHOOK_SECRET
+class TelegramWebhook:
+    def __init__(self, dispatcher, secret=WEBHOOK_SECRET, concurrency=HANDLER_CONCURRENCY, latency_window=10000):
+        self.dispatcher = dispatcher
+        self.secret = secret
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._tasks = set()
+        self.received = 0
+        self.processed = 0
+        self.errors = 0
+        # latencies — от приёма до конца обработки (с ожиданием в очереди), handler_latencies — только хендлер
+        self.latencies = deque(maxlen=latency_window)
+        self.handler_latencies = deque(maxlen=latency_window)
+
+    async def handle(self, request):
+        if self.secret and not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.secret):
+            return web.Response(status=403)
+        try:
+            update = types.Update(**await request.json())
+        except ValueError:
+            return web.Response(status=400)
+        self.received += 1
+        task = asyncio.ensure_future(self._process(update, time.perf_counter()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update, received_at):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            Bot.set_current(self.dispatcher.bot)
+            Dispatcher.set_current(self.dispatcher)
+            started = time.perf_counter()
+            try:
+                await self.dispatcher.process_update(update)
+            except Exception as e:
+                self.errors += 1
+                logger.exception(f"Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                finished = time.perf_counter()
+                self.processed += 1
+                self.latencies.append(finished - received_at)
+                self.handler_latencies.append(finished - started)
+
+    # Дождаться обработки уже принятых обновлений (остановка сервера, нагрузочный тест)
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    @staticmethod
+    def percentile(latencies, q):
+        values = sorted(latencies)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "processed": self.processed,
+            "errors": self.errors,
+            "in_flight": len(self._tasks),
+            "p50_seconds": self.percentile(self.latencies, 0.5),
+            "p99_seconds": self.percentile(self.latencies, 0.99),
+            "handler_p50_seconds": self.percentile(self.handler_latencies, 0.5),
+            "handler_p99_seconds": self.percentile(self.handler_latencies, 0.99),
+        }
+
+# Один aiohttp-сервер для бота и админки: WEBHOOK_PATH — обновления Telegram,
+# остальные пути (админка, /webhook ЮKassa) уходят в WSGI-приложение Flask
+def create_server(telegram_webhook, wsgi_handler=None, path=WEBHOOK_PATH):
+    app = web.Application()
+    app.router.add_post(path, telegram_webhook.handle)
+    if wsgi_handler is not None:
+        app.router.add_route("*", "/{tail:.*}", wsgi_handler)
+
+    async def on_cleanup(_):
+        await telegram_webhook.drain()
+
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+async def register_webhook(bot, host=WEBHOOK_HOST, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                           max_connections=HANDLER_CONCURRENCY):
+    if not host:
+        raise ValueError("WEBHOOK_HOST не задан в .env: нужен публичный https-адрес сервера")
+    await bot.set_webhook(f"{host.rstrip('/')}{path}", secret_token=secret,
+                          max_connections=min(max_connections, 100))
@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from database.connection import get_connection
+
+TARIFF_VERSION_CHECK_INTERVAL = float(os.getenv('TARIFF_VERSION_CHECK_INTERVAL', 2))
+
+# Тарифы меняются редко (раз в месяц через /edit_tariffs), поэтому вся таблица держится в памяти.
+# Изменения из других процессов замечаем по строке meta.tariffs_version, которую увеличивают
+# триггеры на tariffs; проверка версии — не чаще раза в TARIFF_VERSION_CHECK_INTERVAL секунд
+class TariffCache:
+    def __init__(self, check_interval=TARIFF_VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._prices = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def _read_version(self, conn):
+        row = conn.execute("SELECT value FROM meta WHERE key = 'tariffs_version'").fetchone()
+        return row[0] if row else 0
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._prices is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if self._prices is not None and now - self._checked_at < self.check_interval:
+                return
+            conn = get_connection()
+            version = self._read_version(conn)
+            if self._prices is None or version != self._version:
+                self._prices = dict(conn.execute("SELECT type, price FROM tariffs").fetchall())
+                self._version = version
+            self._checked_at = now
+
+    def get(self, tariff_type):
+        self._refresh()
+        return self._prices.get(tariff_type)
+
+    def all(self):
+        self._refresh()
+        return dict(self._prices)
+
+    def version(self):
+        self._refresh()
+        return self._version
+
+    def invalidate(self):
+        with self._lock:
+            self._prices = None
+            self._checked_at = 0.0
+
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 60))
+USER_CHANGES_CHECK_INTERVAL = float(os.getenv('USER_CHANGES_CHECK_INTERVAL', 2))
+
+_MISSING = object()
+
+# LRU-кэш строк пользователей по telegram_id. Запись живёт не дольше USER_CACHE_TTL
+# и не переживает момент окончания подписки, чтобы переход subscription_end через "сейчас"
+# сразу перечитывался из базы. Изменения из других процессов (админка под gunicorn, воркеры)
+# приходят через журнал user_changes, который пишут триггеры на users: не реже раза
+# в USER_CHANGES_CHECK_INTERVAL секунд изменённые с тех пор ключи выбрасываются из кэша.
+# Строка, прочитанная из базы, кладётся с поколением, взятым до SELECT: если ключ за это время
+# изменили (update/invalidate/put после записи), устаревшая строка не затирает новую
+class UserStateCache:
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, check_interval=USER_CHANGES_CHECK_INTERVAL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # telegram_id -> поколение последнего изменения; вытесненные отсюда ключи считаются
+        # изменёнными в поколении _floor
+        self._generation = 0
+        self._changed = OrderedDict()
+        self._floor = 0
+        self._check_lock = threading.Lock()
+        self._checked_at = 0.0
+        self._seen_change = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expires_at(self, state):
+        now = time.time()
+        expires_at = now + self.ttl
+        subscription_end = getattr(state, 'subscription_end', None)
+        if isinstance(subscription_end, int) and now < subscription_end < expires_at:
+            expires_at = subscription_end
+        return expires_at
+
+    def _bump(self, telegram_id):
+        self._generation += 1
+        self._changed[telegram_id] = self._generation
+        self._changed.move_to_end(telegram_id)
+        while len(self._changed) > self.max_size:
+            self._floor = self._changed.popitem(last=False)[1]
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    # Журнал user_changes читается вне self._lock и только одним потоком; если журнал успели
+    # обрезать дальше прочитанного (процесс долго не заглядывал в кэш), кэш очищается целиком
+    def _sync_changes(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval or not self._check_lock.acquire(blocking=False):
+            return
+        try:
+            conn = get_connection()
+            if self._seen_change is None:
+                self._seen_change = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM user_changes").fetchone()[0]
+            else:
+                rows = conn.execute("SELECT seq, telegram_id FROM user_changes WHERE seq > ? ORDER BY seq",
+                                    (self._seen_change,)).fetchall()
+                if rows and rows[0][0] != self._seen_change + 1:
+                    self.invalidate()
+                else:
+                    with self._lock:
+                        for _, telegram_id in rows:
+                            self._entries.pop(telegram_id, None)
+                            self._bump(telegram_id)
+                if rows:
+                    self._seen_change = rows[-1][0]
+            self._checked_at = now
+        finally:
+            self._check_lock.release()
+
+    def get(self, telegram_id):
+        self._sync_changes()
+        with self._lock:
+            entry = self._entries.get(telegram_id)
+            if entry is None:
+                self.misses += 1
+                return _MISSING
+            state, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[telegram_id]
+                self.expirations += 1
+                self.misses += 1
+                return _MISSING
+            self._entries.move_to_end(telegram_id)
+            self.hits += 1
+            return state
+
+    # generation — значение generation() до чтения строки из базы; без него put — запись после
+    # изменения в базе и сама считается изменением ключа
+    def put(self, telegram_id, state, generation=None):
+        with self._lock:
+            if generation is None:
+                self._bump(telegram_id)
+            elif generation < self._floor or self._changed.get(telegram_id, 0) > generation:
+                return
+            self._entries[telegram_id] = (state, self._expires_at(state))
+            self._entries.move_to_end(telegram_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # Write-through: обновляем поля закэшированной записи, если она есть
+    def update(self, telegram_id, **fields):
+        with self._lock:
+            self._bump(telegram_id)
+            entry = self._entries.get(telegram_id)
+            if entry is None or entry[0] is None:
+                self._entries.pop(telegram_id, None)
+                return
+            state = entry[0]._replace(**fields)
+            self._entries[telegram_id] = (state, self._expires_at(state))
+
+    def invalidate(self, telegram_id=None):
+        with self._lock:
+            if telegram_id is None:
+                self._entries.clear()
+                self._changed.clear()
+                self._generation += 1
+                self._floor = self._generation
+            else:
+                self._entries.pop(telegram_id, None)
+                self._bump(telegram_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
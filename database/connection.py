@@ -0,0 +1,129 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_PATH = os.getenv('DATABASE_PATH') or 'users.db'
+BUSY_TIMEOUT_MS = int(os.getenv('DATABASE_BUSY_TIMEOUT_MS', 30000))
+CACHED_STATEMENTS = int(os.getenv('DATABASE_CACHED_STATEMENTS', 256))
+# NORMAL: в режиме WAL COMMIT не ждёт fsync; FULL — fsync на каждый COMMIT (последние транзакции переживают сбой питания)
+SYNCHRONOUS = os.getenv('DATABASE_SYNCHRONOUS', 'NORMAL')
+
+# Одно долгоживущее соединение на поток: цикл aiogram, потоки Flask и фоновые задачи
+# не мешают друг другу, а подготовленные выражения переиспользуются между вызовами
+_local = threading.local()
+_connections = {}
+_connections_lock = threading.Lock()
+
+def _configure(conn):
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -16000")
+
+def connect(path=None):
+    # isolation_level=None: одиночные запросы коммитятся сразу,
+    # явные транзакции открываются только через transaction()
+    conn = sqlite3.connect(
+        path or DATABASE_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=CACHED_STATEMENTS
+    )
+    _configure(conn)
+    return conn
+
+def _prune_dead_threads():
+    # Потоки Flask живут недолго: соединения завершившихся потоков закрываем сразу
+    dead = [thread for thread in _connections if not thread.is_alive()]
+    for thread in dead:
+        _connections.pop(thread).close()
+
+def get_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = connect()
+        _local.conn = conn
+        with _connections_lock:
+            _prune_dead_threads()
+            _connections[threading.current_thread()] = conn
+    return conn
+
+def close_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        with _connections_lock:
+            _connections.pop(threading.current_thread(), None)
+        conn.close()
+
+def close_all_connections():
+    with _connections_lock:
+        connections = list(_connections.values())
+        _connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.ProgrammingError:
+            pass
+    _local.conn = None
+
+# Действие после COMMIT текущей транзакции потока (обновление кэшей в памяти): при откате
+# транзакции или точки сохранения оно отбрасывается. Вне транзакции выполняется сразу
+def on_commit(callback):
+    if not get_connection().in_transaction:
+        callback()
+        return
+    _local.after_commit.append(callback)
+
+@contextmanager
+def transaction(immediate=False):
+    conn = get_connection()
+    # Вложенный вызов присоединяется к уже открытой транзакции
+    if conn.in_transaction:
+        yield conn
+        return
+    _local.after_commit = []
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        # Не удавшийся COMMIT (например, SQLITE_BUSY) оставляет транзакцию открытой
+        conn.rollback()
+        _local.after_commit = []
+        raise
+    callbacks, _local.after_commit = _local.after_commit, []
+    for callback in callbacks:
+        callback()
+
+# Точка сохранения внутри transaction(): исключение откатывает только её изменения
+# и её действия on_commit, транзакция продолжается
+@contextmanager
+def savepoint(name="savepoint"):
+    conn = get_connection()
+    mark = len(_local.after_commit)
+    conn.execute(f"SAVEPOINT {name}")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute(f"ROLLBACK TO {name}")
+        conn.execute(f"RELEASE {name}")
+        del _local.after_commit[mark:]
+        raise
+    conn.execute(f"RELEASE {name}")
+
+def execute(query, params=()):
+    return get_connection().execute(query, params)
+
+def fetchone(query, params=()):
+    return get_connection().execute(query, params).fetchone()
+
+def fetchall(query, params=()):
+    return get_connection().execute(query, params).fetchall()
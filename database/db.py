@@ -1,145 +1,316 @@
-import sqlite3
 from datetime import datetime, timedelta
+from collections import namedtuple
 import hashlib
+import os
+import re
+from database.connection import get_connection, transaction, on_commit
+from database.migrations import migrate
+from database.cache import TariffCache, UserStateCache, _MISSING
+from monitoring.log import get_logger
+from monitoring.metrics import db_seconds, instrument_module
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Ссылка на оплату старше этого срока считается брошенной: пользователю не показывается, поллер её удаляет
+PENDING_PAYMENT_TTL = int(os.getenv('PENDING_PAYMENT_TTL', 3600))
+
+logger = get_logger(__name__)
+
+tariff_cache = TariffCache()
+user_cache = UserStateCache()
+
+# subscription_end здесь — epoch-секунды (int) или None
+# Страница keyset-пагинации: курсоры указывают на границы страницы, None — страницы нет
+Page = namedtuple('Page', 'items next_cursor prev_cursor')
+
+UserState = namedtuple('UserState', 'telegram_id first_name username subscription_type subscription_end payment_method_id subscription_url')
+
+# Даты хранятся как epoch-секунды (INTEGER), наружу по-прежнему отдаются строки DATE_FORMAT
+def to_epoch(moment):
+    return int(moment.timestamp())
+
+def format_timestamp(value):
+    if value is None or isinstance(value, str):
+        return value
+    return datetime.fromtimestamp(value).strftime(DATE_FORMAT)
+
+def _user_row(row):
+    if row is None:
+        return None
+    return row[:5] + (format_timestamp(row[5]),) + row[6:]
+
+def _transaction_row(row):
+    return row[:4] + (format_timestamp(row[4]),) + row[5:]
 
 def init_db():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS users 
-                 (id INTEGER PRIMARY KEY, telegram_id TEXT UNIQUE, first_name TEXT, username TEXT, 
-                  subscription_type TEXT, subscription_end TEXT, payment_method_id TEXT)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS admins 
-                 (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS transactions 
-                 (id INTEGER PRIMARY KEY, telegram_id TEXT, status TEXT, message TEXT, timestamp TEXT)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS tariffs 
-                 (type TEXT PRIMARY KEY, price REAL NOT NULL)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS pending_payments 
-                 (id INTEGER PRIMARY KEY, telegram_id TEXT, payment_id TEXT, subscription_type TEXT, 
-                  amount REAL, confirmation_url TEXT, created_at TEXT, UNIQUE(telegram_id, payment_id))''')
+    migrate()
+    with transaction(immediate=True) as conn:
+        c = conn.cursor()
 
-    default_admin_username = "admin"
-    default_admin_password = "admin"
-    hashed_password = hashlib.sha256(default_admin_password.encode()).hexdigest()
-    
-    c.execute("SELECT * FROM admins WHERE username = ?", (default_admin_username,))
-    if not c.fetchone():
-        c.execute("INSERT INTO admins (username, password) VALUES (?, ?)", 
-                  (default_admin_username, hashed_password))
-        print(f"Администратор '{default_admin_username}' создан с паролем '{default_admin_password}' (хеширован).")
-
-    c.execute("INSERT OR IGNORE INTO tariffs (type, price) VALUES (?, ?)", ("month", 300))
-    c.execute("INSERT OR IGNORE INTO tariffs (type, price) VALUES (?, ?)", ("year", 3650))
-    
-    conn.commit()
-    conn.close()
+        default_admin_username = "admin"
+        default_admin_password = "admin"
+        hashed_password = hashlib.sha256(default_admin_password.encode()).hexdigest()
+
+        c.execute("SELECT * FROM admins WHERE username = ?", (default_admin_username,))
+        if not c.fetchone():
+            c.execute("INSERT INTO admins (username, password) VALUES (?, ?)", 
+                      (default_admin_username, hashed_password))
+            logger.warning(f"Администратор '{default_admin_username}' создан с паролем '{default_admin_password}' (хеширован).")
+
+        c.execute("INSERT OR IGNORE INTO tariffs (type, price) VALUES (?, ?)", ("month", 300))
+        c.execute("INSERT OR IGNORE INTO tariffs (type, price) VALUES (?, ?)", ("year", 3650))
+    on_commit(tariff_cache.invalidate)
+
+# Значение общей настройки; при первом обращении создаётся через factory — одно на все процессы
+def get_or_create_setting(key, factory):
+    with transaction(immediate=True) as conn:
+        row = conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        if row:
+            return row[0]
+        value = factory()
+        conn.execute("INSERT INTO settings (key, value) VALUES (?, ?)", (key, value))
+        return value
+
+# Берёт или продлевает аренду: успешно, если она свободна, истекла или уже принадлежит owner
+def acquire_lease(name, owner, ttl_seconds):
+    now = to_epoch(datetime.now())
+    c = get_connection().cursor()
+    c.execute('''INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                 ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                 WHERE leases.owner = excluded.owner OR leases.expires_at <= ?''',
+              (name, owner, now + ttl_seconds, now))
+    return c.rowcount == 1
+
+def release_lease(name, owner):
+    get_connection().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
 
 def add_user(telegram_id, first_name, username):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+    c = get_connection().cursor()
     c.execute("INSERT OR IGNORE INTO users (telegram_id, first_name, username) VALUES (?, ?, ?)", 
               (telegram_id, first_name, username))
-    conn.commit()
-    conn.close()
+    if c.rowcount:
+        on_commit(lambda: user_cache.put(telegram_id, UserState(telegram_id, first_name, username, None, None, None, None)))
 
-def update_user_subscription(telegram_id, subscription_type, days, payment_method_id=None):
-    end_date = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+# until — точная дата окончания (выдача по платежу, см. plan_settlement), иначе сейчас + days
+def update_user_subscription(telegram_id, subscription_type, days, payment_method_id=None, until=None):
+    end = until or datetime.now() + timedelta(days=days)
+    c = get_connection().cursor()
     c.execute("UPDATE users SET subscription_type = ?, subscription_end = ?, payment_method_id = ? WHERE telegram_id = ?", 
-              (subscription_type, end_date, payment_method_id, telegram_id))
-    conn.commit()
-    conn.close()
-    return end_date
+              (subscription_type, to_epoch(end), payment_method_id, telegram_id))
+    on_commit(lambda: user_cache.update(telegram_id, subscription_type=subscription_type, subscription_end=to_epoch(end),
+                                        payment_method_id=payment_method_id))
+    return end.strftime(DATE_FORMAT)
 
 def get_users():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+    c = get_connection().cursor()
     c.execute("SELECT * FROM users")
-    users = c.fetchall()
-    conn.close()
+    users = [_user_row(row) for row in c.fetchall()]
     return users
 
 def get_admin(username):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+    c = get_connection().cursor()
     c.execute("SELECT * FROM admins WHERE username = ?", (username,))
     admin = c.fetchone()
-    conn.close()
     return admin
 
 def log_transaction(telegram_id, status, message):
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+    timestamp = to_epoch(datetime.now())
+    c = get_connection().cursor()
     c.execute("INSERT INTO transactions (telegram_id, status, message, timestamp) VALUES (?, ?, ?, ?)", 
               (telegram_id, status, message, timestamp))
-    conn.commit()
-    conn.close()
 
 def get_transactions(limit=None):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+    c = get_connection().cursor()
     if limit:
         c.execute("SELECT * FROM transactions ORDER BY timestamp DESC LIMIT ?", (limit,))
     else:
         c.execute("SELECT * FROM transactions ORDER BY timestamp DESC")
-    transactions = c.fetchall()
-    conn.close()
+    transactions = [_transaction_row(row) for row in c.fetchall()]
     return transactions
 
+def _count(key):
+    row = get_connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else 0
+
+def count_transactions():
+    return _count('transactions_count')
+
+def count_users():
+    return _count('users_count')
+
+def _keyset_page(rows, per_page, cursor_of, backwards, has_cursor):
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    if not rows:
+        return Page([], None, None)
+    if backwards:
+        return Page(rows, cursor_of(rows[-1]), cursor_of(rows[0]) if has_more else None)
+    return Page(rows, cursor_of(rows[-1]) if has_more else None, cursor_of(rows[0]) if has_cursor else None)
+
+def _transaction_cursor(row):
+    return f"{row[4]}_{row[0]}"
+
+def _parse_transaction_cursor(cursor):
+    try:
+        timestamp, row_id = cursor.split('_')
+        return int(timestamp), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+# Журнал транзакций от новых к старым. after — курсор последней строки текущей страницы
+# (следующая, более старая страница), before — курсор первой строки (предыдущая страница).
+# Каждая страница — один проход по индексу idx_transactions_timestamp, независимо от размера таблицы
+def get_transactions_page(after=None, before=None, per_page=10):
+    c = get_connection().cursor()
+    before_key = _parse_transaction_cursor(before)
+    after_key = _parse_transaction_cursor(after)
+    if before_key:
+        c.execute("SELECT * FROM transactions WHERE (timestamp, id) > (?, ?) ORDER BY timestamp ASC, id ASC LIMIT ?",
+                  before_key + (per_page + 1,))
+    elif after_key:
+        c.execute("SELECT * FROM transactions WHERE (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?",
+                  after_key + (per_page + 1,))
+    else:
+        c.execute("SELECT * FROM transactions ORDER BY timestamp DESC, id DESC LIMIT ?", (per_page + 1,))
+    page = _keyset_page(c.fetchall(), per_page, _transaction_cursor, bool(before_key), bool(after_key))
+    return page._replace(items=[_transaction_row(row) for row in page.items])
+
+# Пользователи в порядке добавления, keyset по id
+def get_users_page(after=None, before=None, per_page=10):
+    c = get_connection().cursor()
+    conditions, params = [], []
+    backwards = before is not None
+    if backwards:
+        conditions.append("id < ?")
+        params.append(int(before))
+    elif after is not None:
+        conditions.append("id > ?")
+        params.append(int(after))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    order = "DESC" if backwards else "ASC"
+    c.execute(f"SELECT * FROM users {where} ORDER BY id {order} LIMIT ?", params + [per_page + 1])
+    page = _keyset_page(c.fetchall(), per_page, lambda row: row[0], backwards, after is not None)
+    return page._replace(items=[_user_row(row) for row in page.items])
+
+def _user_search_clause(search):
+    pattern = f"%{search}%"
+    return "(telegram_id LIKE ? OR first_name LIKE ? OR username LIKE ?)", (pattern, pattern, pattern)
+
+_search_index_available = None
+
+def _has_search_index():
+    global _search_index_available
+    if _search_index_available is None:
+        row = get_connection().execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_fts'").fetchone()
+        _search_index_available = row is not None
+    return _search_index_available
+
+# Префиксный запрос FTS5 по имени и username: "ив пет" -> {first_name username} : ("ив"* AND "пет"*)
+def _fts_query(search):
+    terms = re.findall(r'\w+', search.lstrip('@'))
+    if not terms:
+        return None
+    return "{first_name username} : (" + " AND ".join(f'"{term}"*' for term in terms) + ")"
+
+# Поиск для /users: точное совпадение telegram_id первым, затем префиксные совпадения
+# по имени и username в порядке релевантности (bm25). Возвращает (пользователи, всего найдено)
+def search_users(search, page=1, per_page=10):
+    search = (search or "").strip()
+    if not search:
+        return [], 0
+    offset = (max(1, page) - 1) * per_page
+    c = get_connection().cursor()
+    if not _has_search_index():
+        search_clause, search_params = _user_search_clause(search)
+        c.execute(f"SELECT * FROM users WHERE {search_clause} ORDER BY id LIMIT ? OFFSET ?",
+                  search_params + (per_page, offset))
+        items = [_user_row(row) for row in c.fetchall()]
+        total = c.execute(f"SELECT COUNT(*) FROM users WHERE {search_clause}", search_params).fetchone()[0]
+        return items, total
+
+    match = _fts_query(search)
+    telegram_id = search if search.isdigit() else None
+    if match:
+        c.execute('''SELECT * FROM (
+                         SELECT u.*, -1e18 AS score FROM users u WHERE u.telegram_id = :telegram_id
+                         UNION ALL
+                         SELECT u.*, f.rank AS score FROM users_fts f JOIN users u ON u.id = f.rowid
+                         WHERE users_fts MATCH :match AND u.telegram_id IS NOT :telegram_id
+                     ) ORDER BY score, id LIMIT :limit OFFSET :offset''',
+                  {"telegram_id": telegram_id, "match": match, "limit": per_page, "offset": offset})
+        items = [_user_row(row[:-1]) for row in c.fetchall()]
+        total = c.execute("SELECT COUNT(*) FROM users_fts WHERE users_fts MATCH ?", (match,)).fetchone()[0]
+        if telegram_id:
+            total += c.execute('''SELECT COUNT(*) FROM users WHERE telegram_id = ? AND id NOT IN
+                                  (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)''', (telegram_id, match)).fetchone()[0]
+        return items, total
+    return [], 0
+
+def _day_key(moment):
+    return moment.year * 10000 + moment.month * 100 + moment.day
+
+# Фиксация успешного платежа: строка в журнале и инкремент дневного агрегата в одной транзакции.
+# Повторная фиксация того же payment_id ничего не меняет
+def record_payment(payment_id, telegram_id, subscription_type, amount, source):
+    paid_at = datetime.now()
+    with transaction(immediate=True) as conn:
+        c = conn.cursor()
+        c.execute("INSERT OR IGNORE INTO payments_ledger (payment_id, telegram_id, subscription_type, amount, source, paid_at) VALUES (?, ?, ?, ?, ?, ?)",
+                  (payment_id, telegram_id, subscription_type, float(amount), source, to_epoch(paid_at)))
+        if not c.rowcount:
+            return False
+        c.execute("""INSERT INTO revenue_daily (day, revenue, payments) VALUES (?, ?, 1)
+                     ON CONFLICT (day) DO UPDATE SET revenue = revenue + excluded.revenue, payments = payments + 1""",
+                  (_day_key(paid_at), float(amount)))
+    return True
+
 def get_stats(period="all"):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+    c = get_connection().cursor()
     
     now = datetime.now()
-    now_str = now.strftime('%Y-%m-%d %H:%M:%S')
-    year_start = datetime(now.year, 1, 1).strftime('%Y-%m-%d %H:%M:%S')
-    month_start = datetime(now.year, now.month, 1).strftime('%Y-%m-%d %H:%M:%S')
-    week_start = (now - timedelta(days=now.weekday())).strftime('%Y-%m-%d %H:%M:%S')
-    day_start = datetime(now.year, now.month, now.day).strftime('%Y-%m-%d %H:%M:%S')
+    now_ts = to_epoch(now)
+    week_start = now - timedelta(days=now.weekday())
+    starts = {
+        "all": 0,
+        "year": _day_key(datetime(now.year, 1, 1)),
+        "month": _day_key(datetime(now.year, now.month, 1)),
+        "week": _day_key(week_start),
+        "day": _day_key(now)
+    }
+    if period not in starts:
+        period = "all"
 
-    c.execute("SELECT COUNT(*) FROM users")
-    total_users = c.fetchone()[0]
+    total_users = count_users()
 
-    c.execute("SELECT COUNT(*) FROM users WHERE subscription_end > ?", (now_str,))
+    c.execute("SELECT COUNT(*) FROM users WHERE subscription_end > ?", (now_ts,))
     active_subscriptions = c.fetchone()[0]
 
-    c.execute("SELECT COUNT(*) FROM users WHERE subscription_end < ? AND subscription_end IS NOT NULL", (now_str,))
+    c.execute("SELECT COUNT(*) FROM users WHERE subscription_end < ? AND subscription_end IS NOT NULL", (now_ts,))
     expired_subscriptions = c.fetchone()[0]
 
-    c.execute("SELECT subscription_type, subscription_end FROM users WHERE subscription_end IS NOT NULL")
-    subscriptions = c.fetchall()
-
-    total_revenue = 0
-    yearly_revenue = 0
-    monthly_revenue = 0
-    weekly_revenue = 0
-    daily_revenue = 0
-
-    month_price = get_tariff_price('month') or 300
-    year_price = get_tariff_price('year') or 3650
-
-    for sub_type, sub_end in subscriptions:
-        amount = month_price if sub_type == 'month' else year_price if sub_type == 'year' else 0
-        sub_end_date = datetime.strptime(sub_end, '%Y-%m-%d %H:%M:%S')
-        
-        total_revenue += amount
-        if sub_end_date >= datetime.strptime(year_start, '%Y-%m-%d %H:%M:%S'):
-            yearly_revenue += amount
-        if sub_end_date >= datetime.strptime(month_start, '%Y-%m-%d %H:%M:%S'):
-            monthly_revenue += amount
-        if sub_end_date >= datetime.strptime(week_start, '%Y-%m-%d %H:%M:%S'):
-            weekly_revenue += amount
-        if sub_end_date >= datetime.strptime(day_start, '%Y-%m-%d %H:%M:%S'):
-            daily_revenue += amount
-
-    conn.close()
+    # Выручка — по дневным агрегатам: не больше одной строки на день, независимо от числа платежей
+    c.execute("""SELECT COALESCE(SUM(revenue), 0),
+                        COALESCE(SUM(CASE WHEN day >= :year THEN revenue END), 0),
+                        COALESCE(SUM(CASE WHEN day >= :month THEN revenue END), 0),
+                        COALESCE(SUM(CASE WHEN day >= :week THEN revenue END), 0),
+                        COALESCE(SUM(CASE WHEN day >= :day THEN revenue END), 0),
+                        COALESCE(SUM(CASE WHEN day >= :period THEN payments END), 0)
+                 FROM revenue_daily""",
+              {**starts, "period": starts[period]})
+    total_revenue, yearly_revenue, monthly_revenue, weekly_revenue, daily_revenue, period_payments = c.fetchone()
+    period_revenue = {
+        "all": total_revenue,
+        "year": yearly_revenue,
+        "month": monthly_revenue,
+        "week": weekly_revenue,
+        "day": daily_revenue
+    }[period]
+
+    # С какого момента в журнале все платежи (раньше — только восстановленные из журнала операций)
+    ledger_since = _count('revenue_ledger_since')
+
     return {
         "total_users": total_users,
         "active_subscriptions": active_subscriptions,
@@ -148,70 +319,458 @@ def get_stats(period="all"):
         "yearly_revenue": yearly_revenue,
         "monthly_revenue": monthly_revenue,
         "weekly_revenue": weekly_revenue,
-        "daily_revenue": daily_revenue
+        "daily_revenue": daily_revenue,
+        "period_revenue": period_revenue,
+        "period_payments": period_payments,
+        "ledger_since": format_timestamp(ledger_since) if ledger_since else None
     }
 
 def check_expired_subscriptions():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+    c = get_connection().cursor()
     c.execute("SELECT telegram_id, subscription_type, payment_method_id FROM users WHERE subscription_end < ? AND payment_method_id IS NOT NULL", 
-              (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),))
+              (to_epoch(datetime.now()),))
     expired = c.fetchall()
-    conn.close()
     return expired
 
+RenewalJob = namedtuple('RenewalJob', 'id telegram_id subscription_type payment_method_id due_at attempts payment_id')
+
+# Ставит в очередь продления всех истёкших пользователей с сохранённым способом оплаты.
+# Завершённая задача перезапускается, только если это новый цикл (другой subscription_end)
+def enqueue_due_renewals():
+    now = to_epoch(datetime.now())
+    c = get_connection().cursor()
+    c.execute('''INSERT INTO renewal_jobs (telegram_id, subscription_type, payment_method_id, due_at, attempts, next_attempt_at, status, updated_at)
+                 SELECT telegram_id, subscription_type, payment_method_id, subscription_end, 0, :now, 'pending', :now
+                 FROM users WHERE subscription_end < :now AND payment_method_id IS NOT NULL
+                 ON CONFLICT (telegram_id) DO UPDATE SET
+                     subscription_type = excluded.subscription_type, payment_method_id = excluded.payment_method_id,
+                     due_at = excluded.due_at, attempts = 0, next_attempt_at = excluded.next_attempt_at,
+                     status = 'pending', payment_id = NULL, last_error = NULL, updated_at = excluded.updated_at
+                 WHERE renewal_jobs.status IN ('done', 'failed') AND renewal_jobs.due_at != excluded.due_at''',
+              {"now": now})
+    return c.rowcount
+
+# Атомарно забирает пачку готовых задач: выбор и пометка running под одной блокировкой записи,
+# поэтому два воркера (или два процесса) не получат одну задачу
+def claim_renewal_jobs(limit, lease_seconds):
+    now = to_epoch(datetime.now())
+    with transaction(immediate=True) as conn:
+        c = conn.cursor()
+        c.execute('''SELECT id, telegram_id, subscription_type, payment_method_id, due_at, attempts, payment_id
+                     FROM renewal_jobs WHERE status IN ('pending', 'running') AND next_attempt_at <= ?
+                     ORDER BY next_attempt_at LIMIT ?''', (now, limit))
+        jobs = [RenewalJob(*row) for row in c.fetchall()]
+        c.executemany("UPDATE renewal_jobs SET status = 'running', attempts = attempts + 1, next_attempt_at = ?, updated_at = ? WHERE id = ?",
+                      [(now + lease_seconds, now, job.id) for job in jobs])
+    return [job._replace(attempts=job.attempts + 1) for job in jobs]
+
+def set_renewal_payment(job_id, payment_id):
+    get_connection().execute("UPDATE renewal_jobs SET payment_id = ?, updated_at = ? WHERE id = ?",
+                             (payment_id, to_epoch(datetime.now()), job_id))
+
+def complete_renewal_job(job_id):
+    get_connection().execute("UPDATE renewal_jobs SET status = 'done', last_error = NULL, updated_at = ? WHERE id = ?",
+                             (to_epoch(datetime.now()), job_id))
+
+def retry_renewal_job(job_id, delay_seconds, error, keep_payment=False):
+    now = to_epoch(datetime.now())
+    get_connection().execute(f'''UPDATE renewal_jobs SET status = 'pending', next_attempt_at = ?, last_error = ?, updated_at = ?
+                                 {'' if keep_payment else ', payment_id = NULL'} WHERE id = ?''',
+                             (now + delay_seconds, error, now, job_id))
+
+def fail_renewal_job(job_id, error):
+    get_connection().execute("UPDATE renewal_jobs SET status = 'failed', last_error = ?, updated_at = ? WHERE id = ?",
+                             (error, to_epoch(datetime.now()), job_id))
+
+def count_due_renewals():
+    row = get_connection().execute("SELECT COUNT(*) FROM renewal_jobs WHERE status IN ('pending', 'running') AND next_attempt_at <= ?",
+                                   (to_epoch(datetime.now()),)).fetchone()
+    return row[0]
+
+def count_pending_payments():
+    return get_connection().execute("SELECT COUNT(*) FROM pending_payments").fetchone()[0]
+
 def reset_subscription(telegram_id):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+    c = get_connection().cursor()
     c.execute("UPDATE users SET subscription_type = NULL, subscription_end = NULL, payment_method_id = NULL WHERE telegram_id = ?", 
               (telegram_id,))
-    conn.commit()
-    conn.close()
+    on_commit(lambda: user_cache.update(telegram_id, subscription_type=None, subscription_end=None, payment_method_id=None))
 
-def get_marzban_username(telegram_id):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT username FROM users WHERE telegram_id = ?", (telegram_id,))
+# Строка пользователя через LRU-кэш: главное меню, личный кабинет и ссылка на подписку
+# в рамках одного нажатия читают её из памяти, а не тремя одинаковыми SELECT
+def get_user_state(telegram_id):
+    state = user_cache.get(telegram_id)
+    if state is not _MISSING:
+        return state
+    generation = user_cache.generation()
+    c = get_connection().cursor()
+    c.execute("SELECT telegram_id, first_name, username, subscription_type, subscription_end, payment_method_id, subscription_url FROM users WHERE telegram_id = ?",
+              (telegram_id,))
     row = c.fetchone()
-    conn.close()
-    return row[0] if row and row[0] else telegram_id
+    state = UserState(*row) if row else None
+    user_cache.put(telegram_id, state, generation)
+    return state
 
-def get_tariff_price(tariff_type):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT price FROM tariffs WHERE type = ?", (tariff_type,))
-    row = c.fetchone()
-    conn.close()
+def has_active_subscription(telegram_id):
+    state = get_user_state(telegram_id)
+    return bool(state and state.subscription_end and state.subscription_end > to_epoch(datetime.now()))
+
+def get_user_subscription(telegram_id):
+    state = get_user_state(telegram_id)
+    return (state.subscription_type, format_timestamp(state.subscription_end)) if state else None  # (subscription_type, subscription_end) или None
+
+def get_expired_users(before):
+    c = get_connection().cursor()
+    c.execute("SELECT telegram_id, subscription_end FROM users WHERE subscription_end < ? AND subscription_end IS NOT NULL",
+              (to_epoch(before),))
+    return [(telegram_id, format_timestamp(end)) for telegram_id, end in c.fetchall()]
+
+def delete_user(telegram_id):
+    c = get_connection().cursor()
+    c.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
+    on_commit(lambda: user_cache.put(telegram_id, None))
+
+PurgeCandidate = namedtuple('PurgeCandidate', 'id telegram_id marzban_username subscription_end')
+
+# Кандидаты на удаление по индексу subscription_end, порциями по ключу (subscription_end, id).
+# after — ключ последней строки предыдущей порции: оставшиеся после ошибки строки не выбираются повторно
+def get_purge_candidates(before, limit, after=None):
+    query = '''SELECT id, telegram_id, COALESCE(NULLIF(username, ''), telegram_id), subscription_end
+               FROM users WHERE subscription_end < ?'''
+    params = [to_epoch(before)]
+    if after:
+        query += " AND (subscription_end, id) > (?, ?)"
+        params += list(after)
+    query += " ORDER BY subscription_end, id LIMIT ?"
+    c = get_connection().cursor()
+    c.execute(query, params + [limit])
+    return [PurgeCandidate(*row) for row in c.fetchall()]
+
+# Удаляет порцию пользователей и пишет их записи в журнал одной транзакцией.
+# errors — пары (telegram_id, сообщение) для тех, кого удалить не удалось
+def purge_users(telegram_ids, message, errors=()):
+    now = to_epoch(datetime.now())
+    with transaction(immediate=True) as conn:
+        c = conn.cursor()
+        c.executemany("DELETE FROM users WHERE telegram_id = ?", [(telegram_id,) for telegram_id in telegram_ids])
+        c.executemany("DELETE FROM renewal_jobs WHERE telegram_id = ?", [(telegram_id,) for telegram_id in telegram_ids])
+        c.executemany("INSERT INTO transactions (telegram_id, status, message, timestamp) VALUES (?, ?, ?, ?)",
+                      [(telegram_id, "success", message, now) for telegram_id in telegram_ids] +
+                      [(telegram_id, "error", error, now) for telegram_id, error in errors])
+        for telegram_id in telegram_ids:
+            on_commit(lambda telegram_id=telegram_id: user_cache.put(telegram_id, None))
+
+def get_subscription_url(telegram_id):
+    state = get_user_state(telegram_id)
+    return state.subscription_url if state else None
+
+# Имя в Marzban — username пользователя, а если его нет, telegram_id (см. get_marzban_username)
+_MARZBAN_USER_CLAUSE = "(username = ? OR ((username IS NULL OR username = '') AND telegram_id = ?))"
+
+def set_subscription_url(marzban_username, subscription_url):
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT telegram_id FROM users WHERE {_MARZBAN_USER_CLAUSE}", (marzban_username, marzban_username))
+        telegram_ids = [row[0] for row in c.fetchall()]
+        c.executemany("UPDATE users SET subscription_url = ? WHERE telegram_id = ?",
+                      [(subscription_url, telegram_id) for telegram_id in telegram_ids])
+        for telegram_id in telegram_ids:
+            on_commit(lambda telegram_id=telegram_id: user_cache.update(telegram_id, subscription_url=subscription_url))
+
+def get_marzban_username(telegram_id):
+    state = get_user_state(telegram_id)
+    return state.username if state and state.username else telegram_id
+
+# Панель пользователя по имени в Marzban; None — пользователь ещё ни на одной панели не создавался
+def get_marzban_panel(marzban_username):
+    row = get_connection().execute(f"SELECT marzban_panel FROM users WHERE {_MARZBAN_USER_CLAUSE} LIMIT 1",
+                                   (marzban_username, marzban_username)).fetchone()
     return row[0] if row else None
 
+# Размещение пользователя: панель и ссылка меняются вместе (создание, перенос; None, None — удаление)
+def set_marzban_placement(marzban_username, panel, subscription_url):
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT telegram_id FROM users WHERE {_MARZBAN_USER_CLAUSE}", (marzban_username, marzban_username))
+        telegram_ids = [row[0] for row in c.fetchall()]
+        c.executemany("UPDATE users SET marzban_panel = ?, subscription_url = ? WHERE telegram_id = ?",
+                      [(panel, subscription_url, telegram_id) for telegram_id in telegram_ids])
+        for telegram_id in telegram_ids:
+            on_commit(lambda telegram_id=telegram_id: user_cache.update(telegram_id, subscription_url=subscription_url))
+
+def count_users_by_panel():
+    rows = get_connection().execute(
+        "SELECT marzban_panel, COUNT(*) FROM users WHERE marzban_panel IS NOT NULL GROUP BY marzban_panel").fetchall()
+    return dict(rows)
+
+PanelUser = namedtuple('PanelUser', 'id telegram_id marzban_username')
+
+# Пользователи панели порциями по id (перенос между панелями); after — id последнего из прошлой порции
+def get_panel_users(panel, limit, after=0):
+    c = get_connection().cursor()
+    c.execute('''SELECT id, telegram_id, COALESCE(NULLIF(username, ''), telegram_id) FROM users
+                 WHERE marzban_panel = ? AND id > ? ORDER BY id LIMIT ?''', (panel, after, limit))
+    return [PanelUser(*row) for row in c.fetchall()]
+
+def get_tariff_price(tariff_type):
+    return tariff_cache.get(tariff_type)
+
+def get_tariffs_version():
+    return tariff_cache.version()
+
 def update_tariff_price(tariff_type, price):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+    c = get_connection().cursor()
     c.execute("INSERT OR REPLACE INTO tariffs (type, price) VALUES (?, ?)", (tariff_type, price))
-    conn.commit()
-    conn.close()
-
-def add_pending_payment(telegram_id, payment_id, subscription_type, amount, confirmation_url):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    c.execute("INSERT OR IGNORE INTO pending_payments (telegram_id, payment_id, subscription_type, amount, confirmation_url, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-              (telegram_id, payment_id, subscription_type, amount, confirmation_url, created_at))
-    conn.commit()
-    conn.close()
+    on_commit(tariff_cache.invalidate)
+
+def add_pending_payment(telegram_id, payment_id, subscription_type, amount, confirmation_url, first_check_delay=0):
+    c = get_connection().cursor()
+    created_at = to_epoch(datetime.now())
+    c.execute("INSERT OR IGNORE INTO pending_payments (telegram_id, payment_id, subscription_type, amount, confirmation_url, created_at, next_check_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+              (telegram_id, payment_id, subscription_type, amount, confirmation_url, created_at, created_at + first_check_delay))
 
 def get_pending_payment(telegram_id):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT payment_id, subscription_type, amount, confirmation_url FROM pending_payments WHERE telegram_id = ? ORDER BY created_at DESC LIMIT 1",
-              (telegram_id,))
+    c = get_connection().cursor()
+    c.execute("SELECT payment_id, subscription_type, amount, confirmation_url FROM pending_payments WHERE telegram_id = ? AND created_at >= ? ORDER BY created_at DESC LIMIT 1",
+              (telegram_id, to_epoch(datetime.now()) - PENDING_PAYMENT_TTL))
     payment = c.fetchone()
-    conn.close()
     return payment  # (payment_id, subscription_type, amount, confirmation_url) или None
 
 def remove_pending_payment(telegram_id, payment_id):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+    c = get_connection().cursor()
     c.execute("DELETE FROM pending_payments WHERE telegram_id = ? AND payment_id = ?", (telegram_id, payment_id))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+
+PendingCheck = namedtuple('PendingCheck', 'telegram_id payment_id created_at checks')
+
+# Неоплаченные платежи, которые пора проверить, — по индексу next_check_at, самые просроченные первыми
+def get_due_pending_payments(limit):
+    c = get_connection().cursor()
+    c.execute("SELECT telegram_id, payment_id, created_at, checks FROM pending_payments WHERE next_check_at <= ? ORDER BY next_check_at LIMIT ?",
+              (to_epoch(datetime.now()), limit))
+    return [PendingCheck(*row) for row in c.fetchall()]
+
+def reschedule_pending_payment(telegram_id, payment_id, delay_seconds):
+    get_connection().execute("UPDATE pending_payments SET next_check_at = ?, checks = checks + 1 WHERE telegram_id = ? AND payment_id = ?",
+                             (to_epoch(datetime.now()) + delay_seconds, telegram_id, payment_id))
+
+def is_payment_recorded(payment_id):
+    return get_connection().execute("SELECT 1 FROM payments_ledger WHERE payment_id = ?", (payment_id,)).fetchone() is not None
+
+Settlement = namedtuple('Settlement', 'payment_id state subscription_type end_date')
+
+def get_settlement(payment_id):
+    row = get_connection().execute("SELECT payment_id, state, subscription_type, end_date FROM settlements WHERE payment_id = ?",
+                                   (payment_id,)).fetchone()
+    if row is None:
+        return None
+    return Settlement(row[0], row[1], row[2], format_timestamp(row[3]))
+
+# Платёж виден, но ещё не оплачен: заводим запись в состоянии pending, если её нет
+def note_pending_settlement(payment_id, telegram_id, source):
+    get_connection().execute('''INSERT OR IGNORE INTO settlements (payment_id, telegram_id, source, state, updated_at)
+                                VALUES (?, ?, ?, 'pending', ?)''', (payment_id, telegram_id, source, to_epoch(datetime.now())))
+
+# Атомарный захват выдачи: переводит платёж в settling, если он ещё не выдан и не выдаётся
+# другим процессом прямо сейчас. Возвращает (захвачен ли, текущее состояние)
+def claim_settlement(payment_id, telegram_id, source, lease_seconds):
+    now = to_epoch(datetime.now())
+    with transaction(immediate=True) as conn:
+        c = conn.cursor()
+        c.execute('''INSERT INTO settlements (payment_id, telegram_id, source, state, attempts, claimed_until, updated_at)
+                     VALUES (:payment_id, :telegram_id, :source, 'settling', 1, :until, :now)
+                     ON CONFLICT (payment_id) DO UPDATE SET
+                         state = 'settling', source = excluded.source, attempts = attempts + 1,
+                         claimed_until = excluded.claimed_until, error = NULL, updated_at = excluded.updated_at
+                     WHERE state IN ('pending', 'failed') OR (state = 'settling' AND claimed_until <= :now)''',
+                  {"payment_id": payment_id, "telegram_id": telegram_id, "source": source,
+                   "until": now + lease_seconds, "now": now})
+        claimed = c.rowcount == 1
+        return claimed, get_settlement(payment_id)
+
+# Дата окончания подписки по платежу фиксируется до вызова Marzban: повторная выдача после сбоя
+# получает ту же дату, а не прибавляет дни ещё раз. Возвращает сохранённую дату (epoch)
+def plan_settlement(payment_id, target_end):
+    with transaction(immediate=True) as conn:
+        conn.execute("UPDATE settlements SET target_end = COALESCE(target_end, ?) WHERE payment_id = ?", (target_end, payment_id))
+        return conn.execute("SELECT target_end FROM settlements WHERE payment_id = ?", (payment_id,)).fetchone()[0]
+
+# Платёж без user_id в metadata (создан не ботом): выдавать некому. Запись закрывается в состоянии
+# skipped, и webhook, поллер и повторные проверки к нему больше не возвращаются
+def skip_settlement(payment_id, source, error):
+    now = to_epoch(datetime.now())
+    get_connection().execute('''INSERT INTO settlements (payment_id, source, state, error, updated_at)
+                                VALUES (?, ?, 'skipped', ?, ?)
+                                ON CONFLICT (payment_id) DO UPDATE SET
+                                    state = 'skipped', source = excluded.source, error = excluded.error, updated_at = excluded.updated_at
+                                WHERE state IN ('pending', 'failed')''', (payment_id, source, error, now))
+
+def finish_settlement(payment_id, state, subscription_type=None, end_date=None, error=None):
+    get_connection().execute('''UPDATE settlements SET state = ?, subscription_type = ?, end_date = ?, error = ?,
+                                claimed_until = NULL, updated_at = ? WHERE payment_id = ?''',
+                             (state, subscription_type, to_epoch(datetime.strptime(end_date, DATE_FORMAT)) if end_date else None,
+                              error, to_epoch(datetime.now()), payment_id))
+
+WebhookEvent = namedtuple('WebhookEvent', 'id payment_id event payload received_at attempts')
+
+# Сохраняет уведомление ЮKassa; False — этот платёж уже в очереди (повторная доставка)
+def add_webhook_event(payment_id, event, payload):
+    now = to_epoch(datetime.now())
+    c = get_connection().cursor()
+    c.execute("INSERT OR IGNORE INTO webhook_inbox (payment_id, event, payload, received_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+              (payment_id, event, payload, now, now))
+    return c.rowcount == 1
+
+# Та же схема аренды, что и у claim_renewal_jobs: упавший воркер не теряет событие
+def claim_webhook_events(limit, lease_seconds):
+    now = to_epoch(datetime.now())
+    with transaction(immediate=True) as conn:
+        c = conn.cursor()
+        c.execute('''SELECT id, payment_id, event, payload, received_at, attempts
+                     FROM webhook_inbox WHERE status IN ('pending', 'processing') AND next_attempt_at <= ?
+                     ORDER BY next_attempt_at LIMIT ?''', (now, limit))
+        events = [WebhookEvent(*row) for row in c.fetchall()]
+        c.executemany("UPDATE webhook_inbox SET status = 'processing', attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+                      [(now + lease_seconds, event.id) for event in events])
+    return [event._replace(attempts=event.attempts + 1) for event in events]
+
+def complete_webhook_event(event_id, note=None):
+    get_connection().execute("UPDATE webhook_inbox SET status = 'done', processed_at = ?, last_error = ? WHERE id = ?",
+                             (to_epoch(datetime.now()), note, event_id))
+
+def retry_webhook_event(event_id, delay_seconds, error):
+    get_connection().execute("UPDATE webhook_inbox SET status = 'pending', next_attempt_at = ?, last_error = ? WHERE id = ?",
+                             (to_epoch(datetime.now()) + delay_seconds, error, event_id))
+
+def fail_webhook_event(event_id, error):
+    get_connection().execute("UPDATE webhook_inbox SET status = 'failed', processed_at = ?, last_error = ? WHERE id = ?",
+                             (to_epoch(datetime.now()), error, event_id))
+
+# Возвращает упавшие события в очередь: все или только указанные платежи
+def replay_webhook_events(payment_ids=None):
+    now = to_epoch(datetime.now())
+    query = "UPDATE webhook_inbox SET status = 'pending', attempts = 0, next_attempt_at = ?, last_error = NULL WHERE status = 'failed'"
+    params = [now]
+    if payment_ids:
+        query += f" AND payment_id IN ({', '.join('?' * len(payment_ids))})"
+        params += list(payment_ids)
+    c = get_connection().cursor()
+    c.execute(query, params)
+    return c.rowcount
+
+def get_webhook_inbox_stats():
+    c = get_connection().cursor()
+    c.execute("SELECT status, COUNT(*) FROM webhook_inbox GROUP BY status")
+    counts = dict(c.fetchall())
+    c.execute("SELECT MIN(received_at) FROM webhook_inbox WHERE status IN ('pending', 'processing')")
+    oldest = c.fetchone()[0]
+    return {
+        "counts": counts,
+        "oldest_pending_age": to_epoch(datetime.now()) - oldest if oldest else 0
+    }
+
+def get_failed_webhook_events(limit=50):
+    c = get_connection().cursor()
+    c.execute('''SELECT payment_id, event, received_at, attempts, last_error FROM webhook_inbox
+                 WHERE status = 'failed' ORDER BY processed_at DESC LIMIT ?''', (limit,))
+    return [(payment_id, event, format_timestamp(received_at), attempts, last_error)
+            for payment_id, event, received_at, attempts, last_error in c.fetchall()]
+
+OutboxMessage = namedtuple('OutboxMessage', 'id telegram_id text reply_markup broadcast_id attempts')
+
+def enqueue_message(telegram_id, text, reply_markup=None):
+    now = to_epoch(datetime.now())
+    c = get_connection().cursor()
+    c.execute("INSERT INTO outbox (telegram_id, text, reply_markup, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+              (str(telegram_id), text, reply_markup, now, now))
+    return c.lastrowid
+
+BROADCAST_AUDIENCES = {
+    "all": "1",
+    "active": "subscription_end > :now",
+    "expired": "subscription_end <= :now",
+}
+
+# Рассылка: получатели копируются из users в outbox одним INSERT ... SELECT внутри SQLite,
+# без загрузки списка пользователей в память. Возвращает (id рассылки, число получателей)
+def enqueue_broadcast(audience, text):
+    now = to_epoch(datetime.now())
+    with transaction(immediate=True) as conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO broadcasts (audience, text, created_at) VALUES (?, ?, ?)", (audience, text, now))
+        broadcast_id = c.lastrowid
+        c.execute(f'''INSERT INTO outbox (telegram_id, text, broadcast_id, created_at, next_attempt_at)
+                      SELECT telegram_id, :text, :broadcast_id, :now, :now FROM users
+                      WHERE {BROADCAST_AUDIENCES[audience]} ORDER BY id''',
+                  {"text": text, "broadcast_id": broadcast_id, "now": now})
+        recipients = c.rowcount
+        c.execute("UPDATE broadcasts SET recipients = ? WHERE id = ?", (recipients, broadcast_id))
+    return broadcast_id, recipients
+
+# Та же схема аренды, что и у claim_webhook_events
+def claim_outbox_messages(limit, lease_seconds):
+    now = to_epoch(datetime.now())
+    with transaction(immediate=True) as conn:
+        c = conn.cursor()
+        c.execute('''SELECT id, telegram_id, text, reply_markup, broadcast_id, attempts
+                     FROM outbox WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+                     ORDER BY next_attempt_at LIMIT ?''', (now, limit))
+        messages = [OutboxMessage(*row) for row in c.fetchall()]
+        c.executemany("UPDATE outbox SET status = 'sending', attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+                      [(now + lease_seconds, message.id) for message in messages])
+    return [message._replace(attempts=message.attempts + 1) for message in messages]
+
+# Итоги отправки пачки одной транзакцией: sent — id, retries — (id, задержка, ошибка, считать ли попытку),
+# failed — (id, ошибка). Повтор после flood wait попыткой не считается
+def finish_outbox_messages(sent=(), retries=(), failed=()):
+    now = to_epoch(datetime.now())
+    with transaction() as conn:
+        conn.executemany("UPDATE outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?",
+                         [(now, message_id) for message_id in sent])
+        conn.executemany('''UPDATE outbox SET status = 'pending', next_attempt_at = ?, last_error = ?,
+                            attempts = attempts - ? WHERE id = ?''',
+                         [(now + delay, error, 0 if counted else 1, message_id)
+                          for message_id, delay, error, counted in retries])
+        conn.executemany("UPDATE outbox SET status = 'failed', sent_at = ?, last_error = ? WHERE id = ?",
+                         [(now, error, message_id) for message_id, error in failed])
+
+def get_outbox_stats():
+    c = get_connection().cursor()
+    c.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+    counts = dict(c.fetchall())
+    c.execute("SELECT MIN(created_at) FROM outbox WHERE status IN ('pending', 'sending')")
+    oldest = c.fetchone()[0]
+    return {
+        "counts": counts,
+        "oldest_pending_age": to_epoch(datetime.now()) - oldest if oldest else 0
+    }
+
+# Последние рассылки с прогрессом: счётчики по индексу idx_outbox_broadcast
+def get_broadcasts(limit=10):
+    c = get_connection().cursor()
+    c.execute("SELECT id, audience, text, created_at, recipients FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,))
+    broadcasts = []
+    for broadcast_id, audience, text, created_at, recipients in c.fetchall():
+        c.execute("SELECT status, COUNT(*) FROM outbox WHERE broadcast_id = ? GROUP BY status", (broadcast_id,))
+        counts = dict(c.fetchall())
+        broadcasts.append((broadcast_id, audience, text, format_timestamp(created_at), recipients,
+                           counts.get('sent', 0), counts.get('failed', 0)))
+    return broadcasts
+
+def get_last_message(chat_id):
+    return get_connection().execute("SELECT message_id, sent_at FROM last_messages WHERE chat_id = ?", (chat_id,)).fetchone()
+
+# entries — (chat_id, message_id, sent_at); пишутся пачкой в одной транзакции
+def save_last_messages(entries):
+    with transaction() as conn:
+        conn.executemany('''INSERT INTO last_messages (chat_id, message_id, sent_at) VALUES (?, ?, ?)
+                            ON CONFLICT (chat_id) DO UPDATE SET message_id = excluded.message_id, sent_at = excluded.sent_at''',
+                         entries)
+
+# Сообщения старше окна редактирования больше не понадобятся
+def prune_last_messages(before):
+    c = get_connection().cursor()
+    c.execute("DELETE FROM last_messages WHERE sent_at < ?", (before,))
+    return c.rowcount
+
+# Время каждой функции модуля в метрике vpnbot_db_seconds; чистые преобразования дат не оборачиваются
+instrument_module(globals(), db_seconds, "function", exclude=("to_epoch", "format_timestamp"))
@@ -0,0 +1,317 @@
+import re
+import sqlite3
+import time
+from datetime import datetime
+from database.connection import get_connection, transaction
+from monitoring.log import get_logger
+
+logger = get_logger(__name__)
+
+LEGACY_DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+# Перевод старых строковых дат (локальное время) в epoch-секунды
+def legacy_to_epoch(value):
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value)
+    value = str(value).strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    for date_format in LEGACY_DATE_FORMATS:
+        try:
+            return int(datetime.strptime(value, date_format).timestamp())
+        except ValueError:
+            continue
+    return None
+
+def _initial_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (id INTEGER PRIMARY KEY, telegram_id TEXT UNIQUE, first_name TEXT, username TEXT,
+                  subscription_type TEXT, subscription_end TEXT, payment_method_id TEXT)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS admins
+                 (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS transactions
+                 (id INTEGER PRIMARY KEY, telegram_id TEXT, status TEXT, message TEXT, timestamp TEXT)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS tariffs
+                 (type TEXT PRIMARY KEY, price REAL NOT NULL)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS pending_payments
+                 (id INTEGER PRIMARY KEY, telegram_id TEXT, payment_id TEXT, subscription_type TEXT,
+                  amount REAL, confirmation_url TEXT, created_at TEXT, UNIQUE(telegram_id, payment_id))''')
+
+# Колонки с TEXT-аффинностью превращают числа обратно в строки,
+# поэтому таблицы пересоздаются с INTEGER-колонками для дат
+def _epoch_timestamps(c):
+    c.execute('''CREATE TABLE users_new
+                 (id INTEGER PRIMARY KEY, telegram_id TEXT UNIQUE, first_name TEXT, username TEXT,
+                  subscription_type TEXT, subscription_end INTEGER, payment_method_id TEXT)''')
+    c.execute('''INSERT INTO users_new (id, telegram_id, first_name, username, subscription_type, subscription_end, payment_method_id)
+                 SELECT id, telegram_id, first_name, username, subscription_type, legacy_to_epoch(subscription_end), payment_method_id
+                 FROM users''')
+    c.execute("DROP TABLE users")
+    c.execute("ALTER TABLE users_new RENAME TO users")
+
+    c.execute('''CREATE TABLE transactions_new
+                 (id INTEGER PRIMARY KEY, telegram_id TEXT, status TEXT, message TEXT, timestamp INTEGER)''')
+    c.execute('''INSERT INTO transactions_new (id, telegram_id, status, message, timestamp)
+                 SELECT id, telegram_id, status, message, legacy_to_epoch(timestamp) FROM transactions''')
+    c.execute("DROP TABLE transactions")
+    c.execute("ALTER TABLE transactions_new RENAME TO transactions")
+
+    c.execute('''CREATE TABLE pending_payments_new
+                 (id INTEGER PRIMARY KEY, telegram_id TEXT, payment_id TEXT, subscription_type TEXT,
+                  amount REAL, confirmation_url TEXT, created_at INTEGER, UNIQUE(telegram_id, payment_id))''')
+    c.execute('''INSERT INTO pending_payments_new (id, telegram_id, payment_id, subscription_type, amount, confirmation_url, created_at)
+                 SELECT id, telegram_id, payment_id, subscription_type, amount, confirmation_url, legacy_to_epoch(created_at)
+                 FROM pending_payments''')
+    c.execute("DROP TABLE pending_payments")
+    c.execute("ALTER TABLE pending_payments_new RENAME TO pending_payments")
+
+def _hot_path_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_subscription_end ON users (subscription_end)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_payment_method_end ON users (payment_method_id, subscription_end)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_timestamp ON transactions (timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_telegram_id ON transactions (telegram_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_user_created ON pending_payments (telegram_id, created_at)")
+
+def _subscription_url(c):
+    c.execute("ALTER TABLE users ADD COLUMN subscription_url TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)")
+
+def _tariffs_version(c):
+    c.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('tariffs_version', 1)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS tariffs_version_{event.lower()} AFTER {event} ON tariffs
+                      BEGIN UPDATE meta SET value = value + 1 WHERE key = 'tariffs_version'; END''')
+
+# Счётчики строк для пагинации: COUNT(*) по большой таблице заменяется чтением одной строки meta
+def _row_counters(c):
+    for table in ("users", "transactions"):
+        c.execute(f"INSERT OR REPLACE INTO meta (key, value) VALUES ('{table}_count', (SELECT COUNT(*) FROM {table}))")
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_count_insert AFTER INSERT ON {table}
+                      BEGIN UPDATE meta SET value = value + 1 WHERE key = '{table}_count'; END''')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_count_delete AFTER DELETE ON {table}
+                      BEGIN UPDATE meta SET value = value - 1 WHERE key = '{table}_count'; END''')
+
+# Полнотекстовый индекс для поиска в админке, синхронизируется с users триггерами.
+# Триггер на UPDATE срабатывает только при смене индексируемых колонок, а не при продлении подписки.
+# Если SQLite собран без FTS5, индекс не создаётся и поиск работает через LIKE
+def _users_search_index(c):
+    try:
+        c.execute('''CREATE VIRTUAL TABLE users_fts USING fts5
+                     (telegram_id, first_name, username, content='users', content_rowid='id', prefix='2 3')''')
+    except sqlite3.OperationalError as e:
+        logger.warning(f"FTS5 недоступен, поиск пользователей будет работать без индекса: {e}")
+        return
+    c.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+    c.execute('''CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN
+                     INSERT INTO users_fts (rowid, telegram_id, first_name, username)
+                     VALUES (new.id, new.telegram_id, new.first_name, new.username);
+                 END''')
+    c.execute('''CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN
+                     INSERT INTO users_fts (users_fts, rowid, telegram_id, first_name, username)
+                     VALUES ('delete', old.id, old.telegram_id, old.first_name, old.username);
+                 END''')
+    c.execute('''CREATE TRIGGER users_fts_update AFTER UPDATE OF telegram_id, first_name, username ON users BEGIN
+                     INSERT INTO users_fts (users_fts, rowid, telegram_id, first_name, username)
+                     VALUES ('delete', old.id, old.telegram_id, old.first_name, old.username);
+                     INSERT INTO users_fts (rowid, telegram_id, first_name, username)
+                     VALUES (new.id, new.telegram_id, new.first_name, new.username);
+                 END''')
+
+# Журнал фактически оплаченных платежей и дневные агрегаты выручки (day = YYYYMMDD по местному времени)
+def _revenue_ledger(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS payments_ledger
+                 (id INTEGER PRIMARY KEY, payment_id TEXT UNIQUE, telegram_id TEXT, subscription_type TEXT,
+                  amount REAL NOT NULL, source TEXT, paid_at INTEGER NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payments_ledger_paid_at ON payments_ledger (paid_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payments_ledger_telegram_id ON payments_ledger (telegram_id)")
+    c.execute('''CREATE TABLE IF NOT EXISTS revenue_daily
+                 (day INTEGER PRIMARY KEY, revenue REAL NOT NULL DEFAULT 0, payments INTEGER NOT NULL DEFAULT 0)''')
+
+# Очередь автопродлений: одна строка на пользователя, повторные попытки планируются через next_attempt_at.
+# У взятой в работу задачи next_attempt_at — конец аренды: если воркер упал, задача снова станет доступной
+def _renewal_jobs(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS renewal_jobs
+                 (id INTEGER PRIMARY KEY, telegram_id TEXT NOT NULL UNIQUE, subscription_type TEXT,
+                  payment_method_id TEXT, due_at INTEGER NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,
+                  next_attempt_at INTEGER NOT NULL, status TEXT NOT NULL DEFAULT 'pending',
+                  payment_id TEXT, last_error TEXT, updated_at INTEGER)''')
+    # Частичный индекс: в нём только незавершённые задачи, и выборка по сроку идёт без сортировки
+    c.execute("CREATE INDEX IF NOT EXISTS idx_renewal_jobs_due ON renewal_jobs (next_attempt_at) WHERE status IN ('pending', 'running')")
+
+# Входящие уведомления ЮKassa: сырое тело сохраняется до ответа 200, повторная доставка того же
+# платежа упирается в UNIQUE(payment_id). Обработка — фоновым воркером (worker/inbox.py)
+def _webhook_inbox(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS webhook_inbox
+                 (id INTEGER PRIMARY KEY, payment_id TEXT NOT NULL UNIQUE, event TEXT NOT NULL, payload TEXT NOT NULL,
+                  received_at INTEGER NOT NULL, status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,
+                  next_attempt_at INTEGER NOT NULL, processed_at INTEGER, last_error TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_webhook_inbox_due ON webhook_inbox (next_attempt_at) WHERE status IN ('pending', 'processing')")
+
+# Состояние выдачи подписки по платежу: pending -> settling -> settled/failed.
+# claimed_until — конец аренды settling: после падения процесса платёж можно захватить снова
+def _settlements(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS settlements
+                 (payment_id TEXT PRIMARY KEY, telegram_id TEXT, source TEXT, state TEXT NOT NULL,
+                  subscription_type TEXT, end_date INTEGER, attempts INTEGER NOT NULL DEFAULT 0,
+                  claimed_until INTEGER, error TEXT, updated_at INTEGER)''')
+
+# Расписание фоновой проверки неоплаченных платежей (worker/poller.py): когда проверять в следующий раз
+# и сколько проверок уже было — от этого зависит интервал
+def _pending_payment_checks(c):
+    c.execute("ALTER TABLE pending_payments ADD COLUMN next_check_at INTEGER")
+    c.execute("ALTER TABLE pending_payments ADD COLUMN checks INTEGER NOT NULL DEFAULT 0")
+    c.execute("UPDATE pending_payments SET next_check_at = created_at")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_next_check ON pending_payments (next_check_at)")
+
+# settings — общие для всех процессов значения (ключ подписи сессий админки),
+# leases — именованные аренды: фоновый планировщик работает только в процессе-владельце
+def _settings_and_leases(c):
+    c.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    c.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at INTEGER NOT NULL)")
+
+# Очередь исходящих сообщений Telegram (bot/outbox.py): неотправленное переживает перезапуск.
+# broadcasts — рассылки из админки, их получатели ссылаются на рассылку через broadcast_id
+def _outbox(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcasts
+                 (id INTEGER PRIMARY KEY, audience TEXT NOT NULL, text TEXT NOT NULL, created_at INTEGER NOT NULL,
+                  recipients INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox
+                 (id INTEGER PRIMARY KEY, telegram_id TEXT NOT NULL, text TEXT NOT NULL, reply_markup TEXT,
+                  broadcast_id INTEGER, created_at INTEGER NOT NULL, status TEXT NOT NULL DEFAULT 'pending',
+                  attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at INTEGER NOT NULL, sent_at INTEGER, last_error TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at) WHERE status IN ('pending', 'sending')")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_broadcast ON outbox (broadcast_id, status) WHERE broadcast_id IS NOT NULL")
+
+# Последнее сообщение бота в каждом чате (bot/message_store.py): после перезапуска меню
+# редактируется, а не присылается заново. WITHOUT ROWID — строка хранится прямо в ключе
+def _last_messages(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS last_messages
+                 (chat_id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL, sent_at INTEGER NOT NULL) WITHOUT ROWID''')
+
+# Панель Marzban, на которой создан пользователь (bot/marzban.py, MARZBAN_PANELS). Все, у кого
+# уже была подписка, живут на единственной прежней панели — она называется default
+def _marzban_panels(c):
+    c.execute("ALTER TABLE users ADD COLUMN marzban_panel TEXT")
+    c.execute("UPDATE users SET marzban_panel = 'default' WHERE subscription_end IS NOT NULL OR subscription_url IS NOT NULL")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_marzban_panel ON users (marzban_panel)")
+
+# Журнал изменений users для кэшей строк пользователей в других процессах (database/cache.py):
+# хранятся последние 10000 изменений, отстающий дальше процесс очищает кэш целиком
+def _user_changes(c):
+    c.execute("CREATE TABLE IF NOT EXISTS user_changes (seq INTEGER PRIMARY KEY, telegram_id TEXT NOT NULL)")
+    for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS user_changes_{event.lower()} AFTER {event} ON users
+                      BEGIN INSERT INTO user_changes (telegram_id) VALUES ({row}.telegram_id); END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS user_changes_prune AFTER INSERT ON user_changes
+                 BEGIN DELETE FROM user_changes WHERE seq <= new.seq - 10000; END''')
+
+# Выручка до журнала платежей (миграция 8 создала его пустым) восстанавливается из журнала операций:
+# активации по webhook ЮKassa — с суммой из предшествующей строки «Обработка платежа на N руб.»,
+# автоплатежи — по текущей цене тарифа. Оплаты кнопкой «Проверить платеж» прежний код в журнал
+# не писал, их восстановить нельзя: начало полного учёта хранится в meta.revenue_ledger_since
+def _revenue_backfill(c):
+    since = c.execute("SELECT MIN(paid_at) FROM payments_ledger").fetchone()[0] or int(time.time())
+    prices = dict(c.execute("SELECT type, price FROM tariffs").fetchall())
+    processing = {}
+    payments = []
+    rows = c.execute("SELECT id, telegram_id, status, message, timestamp FROM transactions WHERE timestamp < ? ORDER BY id",
+                     (since,)).fetchall()
+    for transaction_id, telegram_id, status, message, timestamp in rows:
+        message = message or ""
+        if status == "processing":
+            match = re.match(r"Обработка платежа на ([\d.]+) руб\.", message)
+            if match:
+                processing[telegram_id] = float(match.group(1))
+            continue
+        if status != "success":
+            continue
+        match = re.match(r"Подписка (\w+) активирована до .* с автоплатежом$", message)
+        if match:
+            amount = processing.pop(telegram_id, None) or prices.get(match.group(1))
+        else:
+            match = re.match(r"Автоплатеж: подписка (\w+) продлена до ", message)
+            amount = prices.get(match.group(1)) if match else None
+        if amount:
+            payments.append((f"legacy-{transaction_id}", telegram_id, match.group(1), float(amount), "legacy", timestamp))
+    c.executemany("INSERT OR IGNORE INTO payments_ledger (payment_id, telegram_id, subscription_type, amount, source, paid_at) VALUES (?, ?, ?, ?, ?, ?)",
+                  payments)
+    daily = {}
+    for *_, amount, _, paid_at in payments:
+        moment = datetime.fromtimestamp(paid_at)
+        day = daily.setdefault(moment.year * 10000 + moment.month * 100 + moment.day, [0.0, 0])
+        day[0] += amount
+        day[1] += 1
+    c.executemany('''INSERT INTO revenue_daily (day, revenue, payments) VALUES (?, ?, ?)
+                     ON CONFLICT (day) DO UPDATE SET revenue = revenue + excluded.revenue, payments = payments + excluded.payments''',
+                  [(day, revenue, count) for day, (revenue, count) in daily.items()])
+    if rows:
+        c.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('revenue_ledger_since', ?)", (since,))
+    logger.info(f"Выручка восстановлена из журнала операций: {len(payments)} платежей")
+
+# Дата окончания, которую выдача по платежу ставит в Marzban и в базе (database/db.py, plan_settlement)
+def _settlement_target_end(c):
+    c.execute("ALTER TABLE settlements ADD COLUMN target_end INTEGER")
+
+# Поиск истёкших подписок с картой (enqueue_due_renewals, check_expired_subscriptions): по составному
+# индексу (payment_method_id, subscription_end) условие IS NOT NULL не даёт диапазона по дате, и SQLite
+# выбирал idx_users_subscription_end с проверкой карты в каждой строке. Частичный индекс содержит
+# только пользователей с картой и отдаёт истёкших диапазоном
+def _renewal_lookup_index(c):
+    c.execute("DROP INDEX IF EXISTS idx_users_payment_method_end")
+    c.execute("CREATE INDEX idx_users_payment_method_end ON users (subscription_end) WHERE payment_method_id IS NOT NULL")
+
+# Список миграций только дополняется: применённые версии никогда не меняются
+MIGRATIONS = [
+    (1, "initial schema", _initial_schema),
+    (2, "epoch timestamps", _epoch_timestamps),
+    (3, "hot path indexes", _hot_path_indexes),
+    (4, "cached subscription url", _subscription_url),
+    (5, "tariffs version", _tariffs_version),
+    (6, "row counters", _row_counters),
+    (7, "users search index", _users_search_index),
+    (8, "revenue ledger", _revenue_ledger),
+    (9, "renewal jobs", _renewal_jobs),
+    (10, "webhook inbox", _webhook_inbox),
+    (11, "payment settlements", _settlements),
+    (12, "pending payment checks", _pending_payment_checks),
+    (13, "settings and leases", _settings_and_leases),
+    (14, "telegram outbox", _outbox),
+    (15, "last messages", _last_messages),
+    (16, "marzban panels", _marzban_panels),
+    (17, "user changes", _user_changes),
+    (18, "revenue backfill", _revenue_backfill),
+    (19, "settlement target end", _settlement_target_end),
+    (20, "renewal lookup index", _renewal_lookup_index),
+]
+
+def get_schema_version():
+    conn = get_connection()
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, name TEXT, applied_at INTEGER)")
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate():
+    conn = get_connection()
+    conn.create_function("legacy_to_epoch", 1, legacy_to_epoch, deterministic=True)
+    applied = []
+    for version, name, apply in MIGRATIONS:
+        # Каждая миграция в своей транзакции; версия перечитывается под блокировкой,
+        # чтобы два процесса не применили одну миграцию дважды
+        with transaction(immediate=True) as conn:
+            if version <= get_schema_version():
+                continue
+            apply(conn.cursor())
+            conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                         (version, name, int(time.time())))
+            applied.append(version)
+    for version in applied:
+        logger.info(f"Применена миграция базы данных {version}")
+    return get_schema_version()
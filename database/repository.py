@@ -0,0 +1,313 @@
+import asyncio
+import os
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from database import db
+from database.connection import close_connection, transaction, savepoint
+from monitoring.log import get_logger
+from monitoring.metrics import db_write_batch
+
+DATABASE_READERS = int(os.getenv('DATABASE_READERS', 4))
+DATABASE_WRITE_BATCH_SIZE = int(os.getenv('DATABASE_WRITE_BATCH_SIZE', 256))
+
+logger = get_logger(__name__)
+
+_STOP = object()
+
+# Единственный пишущий поток процесса. Записи из цикла aiogram и потоков Flask встают в очередь,
+# поток забирает всё накопившееся (не больше batch_size) и фиксирует одной транзакцией: один
+# BEGIN IMMEDIATE и один COMMIT на пачку вместо блокировки базы на каждый вызов, а пишущие
+# потоки процесса не спорят за блокировку. Пачка собирается сама, пока идёт предыдущий COMMIT, —
+# одиночная запись не ждёт попутчиков. Каждая операция выполняется в своей точке сохранения:
+# исключение откатывает только её и возвращается её вызывающему. Результат отдаётся только
+# после COMMIT; если не удался сам COMMIT, ошибку получают все операции пачки
+class BatchWriter:
+    def __init__(self, batch_size=DATABASE_WRITE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    # Поток запускается при первой записи; после fork (gunicorn с preload) — заново в дочернем процессе.
+    # Вызывается под self._lock, чтобы запись не попала в очередь уже остановленного потока
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._queue = queue.SimpleQueue()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def in_writer(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        # Запись изнутри другой записи уже идёт в транзакции пачки — выполняем сразу, иначе взаимоблокировка
+        if self.in_writer():
+            future.set_result(func(*args, **kwargs))
+            return future
+        with self._lock:
+            self._ensure_started()
+            self._queue.put((func, args, kwargs, future))
+        return future
+
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+                batch = [item for item in batch if item is not _STOP]
+            # Отменённые до начала записи операции не выполняются
+            batch = [item for item in batch if item[3].set_running_or_notify_cancel()]
+            if batch:
+                self._commit(batch)
+        close_connection()
+
+    def _commit(self, batch):
+        outcomes = []
+        try:
+            with transaction(immediate=True):
+                for func, args, kwargs, future in batch:
+                    # Кэши в памяти операции обновят только после COMMIT (on_commit), откат
+                    # её точки сохранения или всей пачки отбрасывает и их
+                    try:
+                        with savepoint("batch_write"):
+                            result = func(*args, **kwargs)
+                    except Exception as e:
+                        outcomes.append((future, None, e))
+                    else:
+                        outcomes.append((future, result, None))
+        except Exception as e:
+            self.counters["failed_batches"] += 1
+            logger.exception(f"Не удалось зафиксировать пачку из {len(batch)} записей")
+            for _, _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.counters["batches"] += 1
+        self.counters["writes"] += len(batch)
+        db_write_batch.observe(len(batch))
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                self.counters["errors"] += 1
+                future.set_exception(error)
+
+    # Дописывает всё, что уже в очереди, и останавливает поток; следующая запись запустит его заново
+    def close(self):
+        with self._lock:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._queue.put(_STOP)
+            self._thread = None
+        thread.join()
+
+    def stats(self):
+        return {"pending": self.pending(), **self.counters}
+
+# Асинхронный доступ к пользователям, платежам, журналу и тарифам для хендлеров бота:
+# чтения — в небольшом пуле потоков со своими соединениями, записи — через BatchWriter,
+# цикл событий не ждёт ни диска, ни блокировки базы
+class Repository:
+    def __init__(self, readers=DATABASE_READERS, writer=None):
+        self.readers = readers
+        self.writer = writer or BatchWriter()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _reader_pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="db-reader")
+            return self._executor
+
+    async def read(self, func, *args):
+        return await asyncio.wrap_future(self._reader_pool().submit(func, *args))
+
+    async def write(self, func, *args, **kwargs):
+        return await asyncio.wrap_future(self.writer.submit(func, *args, **kwargs))
+
+    # Пользователи
+    async def add_user(self, telegram_id, first_name, username):
+        return await self.write(db.add_user, telegram_id, first_name, username)
+
+    async def update_user_subscription(self, telegram_id, subscription_type, days, payment_method_id=None):
+        return await self.write(db.update_user_subscription, telegram_id, subscription_type, days, payment_method_id)
+
+    async def reset_subscription(self, telegram_id):
+        return await self.write(db.reset_subscription, telegram_id)
+
+    async def delete_user(self, telegram_id):
+        return await self.write(db.delete_user, telegram_id)
+
+    async def get_user_subscription(self, telegram_id):
+        return await self.read(db.get_user_subscription, telegram_id)
+
+    async def has_active_subscription(self, telegram_id):
+        return await self.read(db.has_active_subscription, telegram_id)
+
+    async def get_subscription_url(self, telegram_id):
+        return await self.read(db.get_subscription_url, telegram_id)
+
+    async def get_marzban_username(self, telegram_id):
+        return await self.read(db.get_marzban_username, telegram_id)
+
+    # Размещение в Marzban
+    async def get_marzban_panel(self, username):
+        return await self.read(db.get_marzban_panel, username)
+
+    async def set_subscription_url(self, username, subscription_url):
+        return await self.write(db.set_subscription_url, username, subscription_url)
+
+    async def set_marzban_placement(self, username, panel, subscription_url):
+        return await self.write(db.set_marzban_placement, username, panel, subscription_url)
+
+    # Платежи
+    async def add_pending_payment(self, telegram_id, payment_id, subscription_type, amount, confirmation_url, first_check_delay=0):
+        return await self.write(db.add_pending_payment, telegram_id, payment_id, subscription_type, amount,
+                                confirmation_url, first_check_delay)
+
+    async def get_pending_payment(self, telegram_id):
+        return await self.read(db.get_pending_payment, telegram_id)
+
+    async def remove_pending_payment(self, telegram_id, payment_id):
+        return await self.write(db.remove_pending_payment, telegram_id, payment_id)
+
+    async def is_payment_recorded(self, payment_id):
+        return await self.read(db.is_payment_recorded, payment_id)
+
+    # Журнал операций
+    async def log_transaction(self, telegram_id, status, message):
+        return await self.write(db.log_transaction, telegram_id, status, message)
+
+    async def get_transactions_page(self, after=None, before=None, per_page=10):
+        return await self.read(db.get_transactions_page, after, before, per_page)
+
+    async def count_transactions(self):
+        return await self.read(db.count_transactions)
+
+    # Тарифы
+    async def get_tariff_price(self, tariff_type):
+        return await self.read(db.get_tariff_price, tariff_type)
+
+    async def get_tariffs_version(self):
+        return await self.read(db.get_tariffs_version)
+
+    async def update_tariff_price(self, tariff_type, price):
+        return await self.write(db.update_tariff_price, tariff_type, price)
+
+    # Последние сообщения бота
+    async def get_last_message(self, chat_id):
+        return await self.read(db.get_last_message, chat_id)
+
+    async def save_last_messages(self, entries):
+        return await self.write(db.save_last_messages, entries)
+
+    async def prune_last_messages(self, before):
+        return await self.write(db.prune_last_messages, before)
+
+    def stats(self):
+        return {"readers": self.readers, "writer": self.writer.stats()}
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        self.writer.close()
+
+# Тот же API для Flask и фоновых потоков: чтения идут прямо в вызывающем потоке (у него своё
+# соединение), записи — в общую очередь BatchWriter с ожиданием COMMIT
+class SyncRepository:
+    def __init__(self, repository):
+        self.repository = repository
+
+    def write(self, func, *args, **kwargs):
+        return self.repository.writer.submit(func, *args, **kwargs).result()
+
+    # Пользователи
+    def add_user(self, telegram_id, first_name, username):
+        return self.write(db.add_user, telegram_id, first_name, username)
+
+    def update_user_subscription(self, telegram_id, subscription_type, days, payment_method_id=None):
+        return self.write(db.update_user_subscription, telegram_id, subscription_type, days, payment_method_id)
+
+    def reset_subscription(self, telegram_id):
+        return self.write(db.reset_subscription, telegram_id)
+
+    def delete_user(self, telegram_id):
+        return self.write(db.delete_user, telegram_id)
+
+    def get_user_subscription(self, telegram_id):
+        return db.get_user_subscription(telegram_id)
+
+    def has_active_subscription(self, telegram_id):
+        return db.has_active_subscription(telegram_id)
+
+    def get_subscription_url(self, telegram_id):
+        return db.get_subscription_url(telegram_id)
+
+    def get_marzban_username(self, telegram_id):
+        return db.get_marzban_username(telegram_id)
+
+    # Размещение в Marzban
+    def get_marzban_panel(self, username):
+        return db.get_marzban_panel(username)
+
+    def set_subscription_url(self, username, subscription_url):
+        return self.write(db.set_subscription_url, username, subscription_url)
+
+    def set_marzban_placement(self, username, panel, subscription_url):
+        return self.write(db.set_marzban_placement, username, panel, subscription_url)
+
+    # Платежи
+    def add_pending_payment(self, telegram_id, payment_id, subscription_type, amount, confirmation_url, first_check_delay=0):
+        return self.write(db.add_pending_payment, telegram_id, payment_id, subscription_type, amount,
+                          confirmation_url, first_check_delay)
+
+    def get_pending_payment(self, telegram_id):
+        return db.get_pending_payment(telegram_id)
+
+    def remove_pending_payment(self, telegram_id, payment_id):
+        return self.write(db.remove_pending_payment, telegram_id, payment_id)
+
+    def is_payment_recorded(self, payment_id):
+        return db.is_payment_recorded(payment_id)
+
+    # Журнал операций
+    def log_transaction(self, telegram_id, status, message):
+        return self.write(db.log_transaction, telegram_id, status, message)
+
+    def get_transactions_page(self, after=None, before=None, per_page=10):
+        return db.get_transactions_page(after, before, per_page)
+
+    def count_transactions(self):
+        return db.count_transactions()
+
+    # Тарифы
+    def get_tariff_price(self, tariff_type):
+        return db.get_tariff_price(tariff_type)
+
+    def get_tariffs_version(self):
+        return db.get_tariffs_version()
+
+    def update_tariff_price(self, tariff_type, price):
+        return self.write(db.update_tariff_price, tariff_type, price)
+
+repository = Repository()
+sync_repository = SyncRepository(repository)
@@ -0,0 +1,12 @@
+# Продакшен-запуск админки: gunicorn -c gunicorn.conf.py "web.app:create_app()"
+# Фоновые задачи в воркерах gunicorn не запускаются — для них отдельный процесс python -m worker.scheduler
+import multiprocessing
+import os
+
+bind = f"{os.getenv('WEB_HOST', '127.0.0.1')}:{os.getenv('WEB_PORT', 5000)}"
+workers = int(os.getenv('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('WEB_THREADS', 4))
+# Приложение (и миграции в init_db) создаётся один раз в мастере, воркеры получают его форком
+preload_app = True
+timeout = 60
+accesslog = '-'
@@ -1,19 +1,57 @@
-from bot.bot import dp, bot
-from web.app import app
+from bot.bot import dp, bot, on_shutdown
+from bot.marzban import marzban
+from bot.webhook import TelegramWebhook, create_server, register_webhook
+from web.app import create_app
+from worker.scheduler import Scheduler
+from web.wsgi import WSGIHandler
 from database.db import init_db
+from monitoring.log import get_logger
+from aiohttp import web
 import asyncio
 from aiogram.utils import executor
 import threading
+import os
+
+# polling — для разработки (бот опрашивает Telegram, админка на Flask-сервере в потоке),
+# webhook — для продакшена: один aiohttp-сервер принимает обновления Telegram, админку и уведомления ЮKassa
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('SERVER_PORT', 8080))
+
+logger = get_logger(__name__)
 
 async def on_startup(_):
     init_db()
-    print("Бот и база данных запущены")
+    marzban.start_probes()
+    logger.info("Бот и база данных запущены")
 
-def run_flask():
+def run_flask(app):
     app.run(port=5000)
 
+def run_webhook(app):
+    server = create_server(TelegramWebhook(dp), WSGIHandler(app))
+
+    async def startup(_):
+        await register_webhook(bot)
+        marzban.start_probes()
+        logger.info(f"Бот запущен в режиме webhook на {SERVER_HOST}:{SERVER_PORT}")
+
+    async def shutdown(_):
+        await on_shutdown(dp)
+        await (await bot.get_session()).close()
+
+    server.on_startup.append(startup)
+    server.on_shutdown.append(shutdown)
+    web.run_app(server, host=SERVER_HOST, port=SERVER_PORT)
+
 if __name__ == '__main__':
-    init_db()
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    app = create_app()
+    # Фоновые задачи выполняет только владелец аренды: если отдельно запущен python -m worker.scheduler,
+    # этот экземпляр остаётся в резерве
+    Scheduler().start()
+    if BOT_MODE == 'webhook':
+        run_webhook(app)
+    else:
+        flask_thread = threading.Thread(target=run_flask, args=(app,), daemon=True)
+        flask_thread.start()
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,32 @@
+from aiogram.dispatcher.handler import CancelHandler, SkipHandler
+import functools
+import time
+from monitoring.metrics import handler_seconds
+
+def _timed_handler(handler):
+    name = getattr(handler, "__name__", "unknown")
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await handler(*args, **kwargs)
+        except (CancelHandler, SkipHandler):
+            outcome = "skipped"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, handler=name, outcome=outcome)
+    return wrapper
+
+# Оборачивает уже зарегистрированные хендлеры сообщений и callback-запросов: время каждого вызова
+# с меткой по имени функции и исходом ok/error. Вызывается после регистрации всех хендлеров.
+# Фильтры и разбор аргументов aiogram работают по сохранённой сигнатуре исходной функции
+def instrument_handlers(dispatcher):
+    for handlers in (dispatcher.message_handlers, dispatcher.callback_query_handlers):
+        for handler_obj in handlers.handlers:
+            if not getattr(handler_obj.handler, "__wrapped__", None):
+                handler_obj.handler = _timed_handler(handler_obj.handler)
@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+import random
+import threading
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# text — строка «сообщение ключ=значение» для консоли, json — одна JSON-строка на запись для сборщика логов
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+# Доля ответов внешних API, тело которых пишется в лог на уровне DEBUG, и предел длины тела
+LOG_BODY_SAMPLE_RATE = float(os.getenv('LOG_BODY_SAMPLE_RATE', 0))
+LOG_BODY_LIMIT = int(os.getenv('LOG_BODY_LIMIT', 1000))
+
+# Поля extra, которые передаёт код бота. Остальные атрибуты записи не выводятся: библиотеки кладут
+# туда свои объекты (aiohttp.access — заголовки запроса и ответа на каждый запрос)
+LOG_FIELDS = ("panel", "method", "endpoint", "path", "status", "seconds", "username", "days",
+              "source", "target", "error", "body")
+
+def _fields(record):
+    return {key: getattr(record, key) for key in LOG_FIELDS if hasattr(record, key)}
+
+# Дополнительные поля записи передаются через extra: logger.info("...", extra={"status": 200});
+# новое поле нужно добавить в LOG_FIELDS
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, json_format=False):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.json_format = json_format
+
+    def format(self, record):
+        fields = _fields(record)
+        if self.json_format:
+            entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                     "message": record.getMessage(), **fields}
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        line = super().format(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+_configured = False
+_configure_lock = threading.Lock()
+
+# Настраивает корневой логгер один раз на процесс; если приложение (gunicorn) уже повесило
+# свои обработчики, только выставляет уровень
+def setup_logging(level=LOG_LEVEL, json_format=LOG_FORMAT == 'json'):
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        root = logging.getLogger()
+        if not root.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(StructuredFormatter(json_format))
+            root.addHandler(handler)
+        root.setLevel(level)
+        _configured = True
+
+def get_logger(name):
+    setup_logging()
+    return logging.getLogger(name)
+
+# Тело ответа в лог только для выборки LOG_BODY_SAMPLE_RATE и только при включённом DEBUG:
+# полные ответы Marzban содержат ссылки подписок и ключи пользователей
+def log_body_sample(logger, message, body, **fields):
+    if LOG_BODY_SAMPLE_RATE <= 0 or not logger.isEnabledFor(logging.DEBUG) or random.random() >= LOG_BODY_SAMPLE_RATE:
+        return
+    logger.debug(message, extra={**fields, "body": body[:LOG_BODY_LIMIT]})
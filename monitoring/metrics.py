@@ -0,0 +1,189 @@
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# Границы корзин гистограмм задержек, секунды: от быстрых запросов SQLite до таймаутов внешних API
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _format_value(value):
+    return repr(float(value)) if value != float('inf') else "+Inf"
+
+# Метрики в памяти процесса в текстовом формате Prometheus. Значения меток — короткие и из
+# ограниченного набора (имя функции, эндпоинт, статус), а не идентификаторы пользователей
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, _format_labels(self.labels, key), value) for key, value in sorted(values)]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # ключ меток -> [счётчики корзин (не накопительные)..., сумма, количество]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def key(self, **labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def observe(self, seconds, **labels):
+        self.observe_key(self.key(**labels), seconds)
+
+    # Горячий путь (обёртки timed): ключ меток посчитан заранее
+    def observe_key(self, key, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(series)) for key, series in self._values.items()]
+        samples = []
+        for key, series in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", _format_labels(self.labels, key, [("le", _format_value(bound))]),
+                                cumulative))
+            samples.append((f"{self.name}_bucket", _format_labels(self.labels, key, [("le", "+Inf")]), series[-1]))
+            samples.append((f"{self.name}_sum", _format_labels(self.labels, key), series[-2]))
+            samples.append((f"{self.name}_count", _format_labels(self.labels, key), series[-1]))
+        return samples
+
+# Значение считается в момент запроса /metrics (размер очередей в базе и т.п.)
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        return [(self.name, "", self.read())]
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, read):
+        return self._register(Gauge(name, help, read))
+
+    # Ошибка одного gauge (например, база занята) не должна ломать весь ответ /metrics
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    "vpnbot_handler_seconds", "Время обработки обновления хендлером aiogram", ("handler", "outcome"))
+db_seconds = registry.histogram(
+    "vpnbot_db_seconds", "Время вызова функции database/db.py", ("function",))
+marzban_seconds = registry.histogram(
+    "vpnbot_marzban_request_seconds", "Время запроса к API Marzban", ("panel", "method", "endpoint", "status"))
+yookassa_seconds = registry.histogram(
+    "vpnbot_yookassa_request_seconds", "Время вызова API ЮKassa", ("operation", "outcome"))
+db_write_batch = registry.histogram(
+    "vpnbot_db_write_batch_size", "Число записей в одной транзакции пишущего потока", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+
+# Декоратор для синхронных и асинхронных функций: время каждого вызова в histogram с метками labels
+def timed(histogram, **labels):
+    key = histogram.key(**labels)
+    perf_counter = time.perf_counter
+
+    def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe_key(key, perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe_key(key, perf_counter() - started)
+        return wrapper
+    return decorate
+
+# Оборачивает все публичные функции модуля (namespace — его globals()), кроме exclude;
+# импортированные из других модулей функции не трогаются
+def instrument_module(namespace, histogram, label, exclude=()):
+    module = namespace['__name__']
+    for name, value in list(namespace.items()):
+        if name.startswith('_') or name in exclude or not callable(value) or isinstance(value, type):
+            continue
+        if getattr(value, '__module__', None) != module:
+            continue
+        namespace[name] = timed(histogram, **{label: name})(value)
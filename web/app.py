@@ -1,103 +1,43 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-from database.db import get_users, update_user_subscription, get_admin, log_transaction, get_transactions, get_stats, check_expired_subscriptions, reset_subscription, get_marzban_username, get_tariff_price, update_tariff_price, remove_pending_payment, get_pending_payment
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, session
+from database.db import init_db, get_or_create_setting, get_admin, get_stats, get_users_page, count_users, search_users, add_webhook_event, BROADCAST_AUDIENCES, enqueue_broadcast, get_broadcasts, get_outbox_stats, count_due_renewals, count_pending_payments, get_webhook_inbox_stats
+from database.connection import close_connection
+from database.repository import repository, sync_repository
 from dotenv import load_dotenv
 import os
 import hashlib
-from bot.bot import bot
+import hmac
+import secrets
 from bot.marzban import create_marzban_subscription, update_marzban_subscription, delete_marzban_user
-from yookassa import Configuration, Payment
-import asyncio
-import threading
-import time
-import sqlite3
-from datetime import datetime, timedelta
+from bot.outbox import notify_user
+from worker.inbox import parse_notification
+from worker.scheduler import Scheduler, wake_inbox
+from monitoring.metrics import registry
+from datetime import datetime
 
 load_dotenv()
 
-app = Flask(__name__, template_folder='templates', static_folder='templates/static')
-app.secret_key = os.urandom(24)
-
-Configuration.account_id = os.getenv('SHOP_ID')
-Configuration.secret_key = os.getenv('SECRET_KEY')
-
-loop = asyncio.get_event_loop()
-
-def run_async(coro):
-    asyncio.ensure_future(coro, loop=loop)
-
-async def send_telegram_message(telegram_id, message, reply_markup=None):
-    try:
-        sent_message = await bot.send_message(telegram_id, message, reply_markup=reply_markup)
-        return sent_message.message_id
-    except Exception as e:
-        print(f"Ошибка отправки сообщения в Telegram: {e}")
-        log_transaction(telegram_id, "error", f"Ошибка отправки сообщения: {str(e)}")
-        return None
-
-def auto_renew_subscriptions():
-    while True:
-        expired_users = check_expired_subscriptions()
-        for telegram_id, subscription_type, payment_method_id in expired_users:
-            days = 30 if subscription_type == "month" else 365
-            amount = get_tariff_price(subscription_type)
-            attempts = 0
-            max_attempts = 3
-
-            while attempts < max_attempts:
-                payment = Payment.create({
-                    "amount": {"value": str(amount), "currency": "RUB"},
-                    "payment_method_id": payment_method_id,
-                    "description": f"Автопродление подписки ({subscription_type}) для {telegram_id}",
-                    "metadata": {"user_id": telegram_id}
-                })
-                
-                if payment.status == "succeeded":
-                    username = get_marzban_username(telegram_id)
-                    subscription_url = update_marzban_subscription(username, days)
-                    end_date = update_user_subscription(telegram_id, subscription_type, days, payment_method_id)
-                    log_transaction(telegram_id, "success", f"Автоплатеж: подписка {subscription_type} продлена до {end_date}")
-                    run_async(send_telegram_message(telegram_id, f"Ваша подписка автоматически продлена!"))
-                    break
-                else:
-                    attempts += 1
-                    log_transaction(telegram_id, "error", f"Ошибка автоплатежа (попытка {attempts}/{max_attempts}): {payment.status}")
-                    time.sleep(300)
-
-            if attempts == max_attempts:
-                reset_subscription(telegram_id)
-                log_transaction(telegram_id, "error", "Автоплатеж не удался после 3 попыток, подписка обнулена")
-                run_async(send_telegram_message(telegram_id, "Ваша подписка закончилась, автоплатеж не удался. Продлите её вручную в личном кабинете!"))
-
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute("SELECT telegram_id, subscription_end FROM users WHERE subscription_end < ? AND subscription_end IS NOT NULL", 
-                  ((datetime.now() - timedelta(days=3)).strftime('%Y-%m-%d %H:%M:%S'),))
-        expired_long = c.fetchall()
-        conn.close()
-
-        for telegram_id, subscription_end in expired_long:
-            try:
-                username = get_marzban_username(telegram_id)
-                delete_marzban_user(username)
-                conn = sqlite3.connect('users.db')
-                c = conn.cursor()
-                c.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
-                conn.commit()
-                conn.close()
-                log_transaction(telegram_id, "success", "Пользователь удален из системы и Marzban через 3 дня после окончания подписки")
-                run_async(send_telegram_message(telegram_id, "Ваша подписка удалена из-за неудачных попыток автоплатежа."))
-            except Exception as e:
-                log_transaction(telegram_id, "error", f"Ошибка удаления пользователя: {str(e)}")
+# Общий для всех воркеров gunicorn ключ сессий: из .env, иначе создаётся один раз и хранится в базе,
+# чтобы вход в админку не сбрасывался при перезапуске и не зависел от того, какой воркер ответил
+FLASK_SECRET_KEY = os.getenv('FLASK_SECRET_KEY')
+# Если задан, /metrics отдаётся только с заголовком Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+def _queue_size(stats):
+    return stats["counts"].get("pending", 0) + stats["counts"].get("processing", 0) + stats["counts"].get("sending", 0)
 
-        time.sleep(3600)
+# Размеры очередей читаются из базы при каждом запросе /metrics и одинаковы во всех процессах
+registry.gauge("vpnbot_renewal_backlog", "Задачи автопродления, ожидающие выполнения", count_due_renewals)
+registry.gauge("vpnbot_pending_payments", "Неоплаченные платежи в ожидании", count_pending_payments)
+registry.gauge("vpnbot_webhook_inbox_pending", "Необработанные уведомления ЮKassa", lambda: _queue_size(get_webhook_inbox_stats()))
+registry.gauge("vpnbot_outbox_pending", "Неотправленные сообщения Telegram", lambda: _queue_size(get_outbox_stats()))
+# Очередь пишущего потока — своя у каждого процесса
+registry.gauge("vpnbot_db_write_queue", "Записи, ожидающие пишущего потока базы", repository.writer.pending)
 
-@app.route('/')
 def index():
     if 'admin' not in session:
         return redirect(url_for('login'))
     return redirect(url_for('dashboard'))
 
-@app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -110,13 +50,11 @@ def login():
         flash('Неверный логин или пароль', 'error')
     return render_template('login.html')
 
-@app.route('/logout')
 def logout():
     session.pop('admin', None)
     flash('Вы вышли из системы', 'success')
     return redirect(url_for('login'))
 
-@app.route('/dashboard', methods=['GET'])
 def dashboard():
     if 'admin' not in session:
         return redirect(url_for('login'))
@@ -124,49 +62,38 @@ def dashboard():
     period = request.args.get('period', 'all')
     stats = get_stats(period)
     
-    all_transactions = get_transactions(limit=None)
-    page = request.args.get('page', 1, type=int)
+    # Keyset-пагинация: страница читается по индексу курсором, номер страницы только для отображения
+    page = max(1, request.args.get('page', 1, type=int))
     per_page = 10
-    total_transactions = len(all_transactions)
-    total_pages = (total_transactions + per_page - 1) // per_page
-    page = max(1, min(page, total_pages))
-    start = (page - 1) * per_page
-    end = start + per_page
-    paginated_transactions = all_transactions[start:end]
-
-    all_users = get_users()
+    transactions_page = sync_repository.get_transactions_page(
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        per_page=per_page
+    )
+    total_transactions = sync_repository.count_transactions()
 
     return render_template(
         'dashboard.html', 
         stats=stats, 
-        transactions=paginated_transactions, 
-        users=all_users, 
+        transactions=transactions_page.items, 
+        next_cursor=transactions_page.next_cursor,
+        prev_cursor=transactions_page.prev_cursor,
         period=period, 
         page=page, 
         per_page=per_page, 
         total_transactions=total_transactions
     )
 
-@app.route('/users', methods=['GET', 'POST'])
 def users():
     if 'admin' not in session:
         return redirect(url_for('login'))
     
-    all_users = get_users()
-    search_query = request.args.get('search', '').lower()
-    page = request.args.get('page', 1, type=int)
+    search_query = request.args.get('search', '').strip()
+    page = max(1, request.args.get('page', 1, type=int))
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
     per_page = 10
 
-    if search_query:
-        all_users = [u for u in all_users if search_query in (u[1].lower() + (u[2] or '').lower() + (u[3] or '').lower())]
-
-    total_users = len(all_users)
-    total_pages = (total_users + per_page - 1) // per_page
-    page = max(1, min(page, total_pages))
-    start = (page - 1) * per_page
-    end = start + per_page
-    paginated_users = all_users[start:end]
-
     if request.method == 'POST':
         telegram_id = request.form.get('telegram_id')
         action = request.form.get('action')
@@ -176,24 +103,20 @@ def users():
             if telegram_id and subscription_type:
                 days = 30 if subscription_type == "month" else 365
                 try:
-                    conn = sqlite3.connect('users.db')
-                    c = conn.cursor()
-                    c.execute("SELECT subscription_end FROM users WHERE telegram_id = ?", (telegram_id,))
-                    existing = c.fetchone()
-                    conn.close()
-
-                    username = get_marzban_username(telegram_id)
-                    if existing and existing[0] and existing[0] > datetime.now().strftime('%Y-%m-%d %H:%M:%S'):
+                    existing = sync_repository.get_user_subscription(telegram_id)
+
+                    username = sync_repository.get_marzban_username(telegram_id)
+                    if existing and existing[1] and existing[1] > datetime.now().strftime('%Y-%m-%d %H:%M:%S'):
                         subscription_url = update_marzban_subscription(username, days)
                     else:
                         subscription_url = create_marzban_subscription(username, days)
                     
-                    end_date = update_user_subscription(telegram_id, subscription_type, days)
-                    log_transaction(telegram_id, "success", f"Подписка {subscription_type} создана вручную до {end_date}")
+                    end_date = sync_repository.update_user_subscription(telegram_id, subscription_type, days)
+                    sync_repository.log_transaction(telegram_id, "success", f"Подписка {subscription_type} создана вручную до {end_date}")
                     flash(f'Подписка для {telegram_id} создана: {subscription_type}', 'success')
-                    run_async(send_telegram_message(telegram_id, f"Ваша подписка ({subscription_type}) активирована!\nСсылка на подписку: {subscription_url}"))
+                    notify_user(telegram_id, f"Ваша подписка ({subscription_type}) активирована!\nСсылка на подписку: {subscription_url}")
                 except Exception as e:
-                    log_transaction(telegram_id, "error", f"Ошибка создания подписки: {str(e)}")
+                    sync_repository.log_transaction(telegram_id, "error", f"Ошибка создания подписки: {str(e)}")
                     flash(f'Ошибка при создании подписки: {str(e)}', 'error')
             else:
                 flash('Выберите пользователя и тип подписки', 'error')
@@ -201,41 +124,46 @@ def users():
         elif action == 'extend':
             days = request.form.get('days', type=int)
             if telegram_id and days:
-                conn = sqlite3.connect('users.db')
-                c = conn.cursor()
-                c.execute("SELECT subscription_end FROM users WHERE telegram_id = ?", (telegram_id,))
-                existing = c.fetchone()
-                username = get_marzban_username(telegram_id)
-                if existing and existing[0] and existing[0] > datetime.now().strftime('%Y-%m-%d %H:%M:%S'):
+                existing = sync_repository.get_user_subscription(telegram_id)
+                username = sync_repository.get_marzban_username(telegram_id)
+                if existing and existing[1] and existing[1] > datetime.now().strftime('%Y-%m-%d %H:%M:%S'):
                     subscription_url = update_marzban_subscription(username, days)
                 else:
                     subscription_url = create_marzban_subscription(username, days)
-                end_date = update_user_subscription(telegram_id, "manual", days)
-                log_transaction(telegram_id, "success", f"Подписка продлена вручную на {days} дней до {end_date}")
+                end_date = sync_repository.update_user_subscription(telegram_id, "manual", days)
+                sync_repository.log_transaction(telegram_id, "success", f"Подписка продлена вручную на {days} дней до {end_date}")
                 flash(f'Подписка для {telegram_id} продлена на {days} дней', 'success')
-                conn.close()
 
         elif action == 'delete':
             try:
-                username = get_marzban_username(telegram_id)
+                username = sync_repository.get_marzban_username(telegram_id)
                 delete_marzban_user(username)
-                conn = sqlite3.connect('users.db')
-                c = conn.cursor()
-                c.execute("DELETE FROM users WHERE telegram_id = ?", (telegram_id,))
-                conn.commit()
-                conn.close()
-                log_transaction(telegram_id, "success", "Пользователь полностью удален")
+                sync_repository.delete_user(telegram_id)
+                sync_repository.log_transaction(telegram_id, "success", "Пользователь полностью удален")
                 flash(f'Пользователь {telegram_id} удален', 'success')
             except Exception as e:
-                log_transaction(telegram_id, "error", f"Ошибка удаления пользователя: {str(e)}")
+                sync_repository.log_transaction(telegram_id, "error", f"Ошибка удаления пользователя: {str(e)}")
                 flash(f'Ошибка при удалении пользователя: {str(e)}', 'error')
 
-        return redirect(url_for('users', page=page, search=search_query))
+        return redirect(url_for('users', page=page, search=search_query, after=after, before=before))
+
+    # Поиск идёт по FTS-индексу с ранжированием (страницы по номеру), обычный список — keyset по id
+    if search_query:
+        found_users, total_users = search_users(search_query, page=page, per_page=per_page)
+        prev_url = url_for('users', search=search_query, page=page - 1) if page > 1 else None
+        next_url = url_for('users', search=search_query, page=page + 1) if page * per_page < total_users else None
+    else:
+        users_page = get_users_page(after=after, before=before, per_page=per_page)
+        found_users, total_users = users_page.items, count_users()
+        prev_url = url_for('users', before=users_page.prev_cursor, page=page - 1) if users_page.prev_cursor else None
+        next_url = url_for('users', after=users_page.next_cursor, page=page + 1) if users_page.next_cursor else None
 
     current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     return render_template(
         'users.html',
-        users=paginated_users,
+        users=found_users,
+        prev_url=prev_url,
+        next_url=next_url,
         search_query=search_query,
         page=page,
         per_page=per_page,
@@ -243,7 +171,6 @@ def users():
         current_time=current_time
     )
 
-@app.route('/edit_tariffs', methods=['GET', 'POST'])
 def edit_tariffs():
     if 'admin' not in session:
         return redirect(url_for('login'))
@@ -253,55 +180,82 @@ def edit_tariffs():
         yearly_price = float(request.form['yearly_price'])
 
         try:
-            update_tariff_price('month', monthly_price)
-            update_tariff_price('year', yearly_price)
+            sync_repository.update_tariff_price('month', monthly_price)
+            sync_repository.update_tariff_price('year', yearly_price)
             flash('Цены тарифов успешно обновлены!', 'success')
         except Exception as e:
             flash(f'Ошибка обновления цен тарифов: {str(e)}', 'error')
 
         return redirect(url_for('dashboard'))
 
-    monthly_price = get_tariff_price('month') or 300
-    yearly_price = get_tariff_price('year') or 3650
+    monthly_price = sync_repository.get_tariff_price('month') or 300
+    yearly_price = sync_repository.get_tariff_price('year') or 3650
 
     return render_template('edit_tariffs.html', monthly_price=monthly_price, yearly_price=yearly_price)
 
-@app.route('/webhook', methods=['POST'])
-async def webhook():
-    data = request.json
-    if data['event'] == 'payment.succeeded':
-        user_id = data['object']['metadata']['user_id']
-        payment_id = data['object']['id']
-        payment_method_id = data['object']['payment_method']['id']
-
-        # Проверяем, есть ли информация о платеже в pending_payments
-        pending_payment = get_pending_payment(user_id)
-        if pending_payment and pending_payment[0] == payment_id:
-            payment_id, subscription_type, amount, confirmation_url = pending_payment
-            days = 30 if subscription_type == "month" else 365
-        else:
-            # Если записи нет, используем сумму для определения типа подписки (запасной вариант)
-            amount = float(data['object']['amount']['value'])
-            days = 30 if amount == get_tariff_price('month') else 365
-            subscription_type = "month" if amount == get_tariff_price('month') else "year"
+# Рассылка только ставит получателей в outbox, отправляет её планировщик с лимитами Telegram
+def broadcast():
+    if 'admin' not in session:
+        return redirect(url_for('login'))
 
-        log_transaction(user_id, "processing", f"Обработка платежа на {amount} руб.")
-        try:
-            username = get_marzban_username(user_id)
-            subscription_url = create_marzban_subscription(username, days)
-            end_date = update_user_subscription(user_id, subscription_type, days, payment_method_id)
-            remove_pending_payment(user_id, payment_id)
-            log_transaction(user_id, "success", f"Подписка {subscription_type} активирована до {end_date} с автоплатежом")
-            # Уведомление убрано, пользователь проверит вручную
-        except Exception as e:
-            log_transaction(user_id, "error", f"Ошибка активации подписки: {str(e)}")
+    if request.method == 'POST':
+        audience = request.form.get('audience')
+        text = request.form.get('text', '').strip()
+        if audience not in BROADCAST_AUDIENCES or not text:
+            flash('Выберите получателей и введите текст рассылки', 'error')
+        else:
+            try:
+                broadcast_id, recipients = sync_repository.write(enqueue_broadcast, audience, text)
+                flash(f'Рассылка #{broadcast_id} поставлена в очередь: {recipients} получателей', 'success')
+            except Exception as e:
+                flash(f'Ошибка создания рассылки: {str(e)}', 'error')
+        return redirect(url_for('broadcast'))
+
+    return render_template('broadcast.html', broadcasts=get_broadcasts(), outbox=get_outbox_stats())
+
+def webhook():
+    # Только сохраняем уведомление и сразу отвечаем 200: активация подписки идёт в InboxWorker,
+    # поэтому медленный Marzban не вызывает таймаутов и повторных доставок от ЮKassa
+    notification = parse_notification(request.get_json(silent=True))
+    if notification is None:
+        return '', 400
+    event, payment_id = notification
+    if event == 'payment.succeeded' and sync_repository.write(add_webhook_event, payment_id, event, request.get_data(as_text=True)):
+        wake_inbox()
     return '', 200
 
-@app.errorhandler(404)
+# Метрики в формате Prometheus. Гистограммы задержек — по процессу, который отвечает на запрос
+def metrics():
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return '', 401
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
 def page_not_found(e):
     return render_template('404.html'), 404
 
+# Фабрика приложения для gunicorn ("web.app:create_app()"), main.py и отладочного запуска.
+# Фоновые задачи здесь не стартуют: их выполняет планировщик (worker/scheduler.py)
+def create_app():
+    app = Flask(__name__, template_folder='templates', static_folder='templates/static')
+    init_db()
+    app.secret_key = FLASK_SECRET_KEY or get_or_create_setting('flask_secret_key', lambda: secrets.token_hex(32))
+
+    app.add_url_rule('/', 'index', index)
+    app.add_url_rule('/login', 'login', login, methods=['GET', 'POST'])
+    app.add_url_rule('/logout', 'logout', logout)
+    app.add_url_rule('/dashboard', 'dashboard', dashboard, methods=['GET'])
+    app.add_url_rule('/users', 'users', users, methods=['GET', 'POST'])
+    app.add_url_rule('/edit_tariffs', 'edit_tariffs', edit_tariffs, methods=['GET', 'POST'])
+    app.add_url_rule('/broadcast', 'broadcast', broadcast, methods=['GET', 'POST'])
+    app.add_url_rule('/webhook', 'webhook', webhook, methods=['POST'])
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    app.register_error_handler(404, page_not_found)
+
+    # С preload_app gunicorn форкает воркеры после фабрики: соединение SQLite не должно переходить в дочерний процесс
+    close_connection()
+    return app
+
 if __name__ == '__main__':
-    threading.Thread(target=lambda: loop.run_forever(), daemon=True).start()
-    threading.Thread(target=auto_renew_subscriptions, daemon=True).start()
-    app.run(port=5000)
\ No newline at end of file
+    app = create_app()
+    Scheduler().start()
+    app.run(port=5000)
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+import asyncio
+import io
+import os
+import sys
+from urllib.parse import unquote_to_bytes
+
+WSGI_THREADS = int(os.getenv('WSGI_THREADS', 8))
+
+# Запуск Flask-админки внутри aiohttp-сервера: каждый запрос выполняется синхронным
+# WSGI-приложением в отдельном пуле потоков, чтобы не блокировать цикл событий бота
+class WSGIHandler:
+    def __init__(self, wsgi_app, threads=WSGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+
+    def _environ(self, request, body):
+        host, _, port = (request.host or "localhost").partition(":")
+        # Как у сервера werkzeug и по PEP 3333: путь из исходной строки запроса раскодируется в байты
+        # и передаётся строкой latin-1 (UTF-8 из неё восстанавливает Flask), строка запроса — как есть
+        raw_path, _, raw_query = request.raw_path.partition("?")
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote_to_bytes(raw_path).decode("latin-1"),
+            "QUERY_STRING": raw_query,
+            "CONTENT_TYPE": request.headers.get("Content-Type", ""),
+            "CONTENT_LENGTH": str(len(body)),
+            "SERVER_NAME": host,
+            "SERVER_PORT": port or ("443" if request.secure else "80"),
+            "SERVER_PROTOCOL": f"HTTP/{request.version.major}.{request.version.minor}",
+            "REMOTE_ADDR": request.remote or "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": request.scheme,
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in request.headers.items():
+            key = "HTTP_" + name.upper().replace("-", "_")
+            if key in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+                continue
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def _call(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = headers
+
+        chunks = self.wsgi_app(environ, start_response)
+        try:
+            body = b"".join(chunks)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+        return response["status"], response["headers"], body
+
+    async def __call__(self, request):
+        body = await request.read()
+        status, headers, payload = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._call, self._environ(request, body))
+        response = web.Response(status=status, body=payload)
+        for name, value in headers:
+            if name.lower() in ("content-length", "transfer-encoding"):
+                continue
+            response.headers.add(name, value)
+        return response
@@ -0,0 +1,135 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import Counter
+import argparse
+import json
+import os
+import threading
+import time
+from bot.payments import LatencyStats
+from monitoring.log import get_logger
+from database.repository import sync_repository
+from database.db import (claim_webhook_events, complete_webhook_event, retry_webhook_event, fail_webhook_event,
+                         replay_webhook_events, get_webhook_inbox_stats, get_failed_webhook_events, log_transaction)
+
+INBOX_WORKERS = int(os.getenv('INBOX_WORKERS', 8))
+INBOX_MAX_ATTEMPTS = int(os.getenv('INBOX_MAX_ATTEMPTS', 5))
+INBOX_RETRY_DELAY = int(os.getenv('INBOX_RETRY_DELAY', 60))
+INBOX_LEASE_SECONDS = int(os.getenv('INBOX_LEASE_SECONDS', 300))
+INBOX_POLL_INTERVAL = float(os.getenv('INBOX_POLL_INTERVAL', 5))
+
+logger = get_logger(__name__)
+
+# Минимальная проверка уведомления до записи в очередь. Подлинность платежа проверяет воркер:
+# статус, сумма и metadata берутся из API ЮKassa, а не из тела запроса
+def parse_notification(data):
+    if not isinstance(data, dict) or not isinstance(data.get('object'), dict):
+        return None
+    event, payment_id = data.get('event'), data['object'].get('id')
+    if not isinstance(event, str) or not isinstance(payment_id, str) or not payment_id:
+        return None
+    return event, payment_id
+
+# Событие исчерпало попытки: закрывается вместе с записью в журнал одной записью в очереди BatchWriter
+def _fail(event_id, user_id, message, error):
+    fail_webhook_event(event_id, error)
+    log_transaction(user_id, "error", message)
+
+# Разбор очереди webhook_inbox. Событие забирается с арендой, выдачу подписки делает
+# SettlementService, поэтому платёж, уже выданный через «Проверить платёж» или автопродление,
+# повторно не активируется. lag — время от получения уведомления до активации подписки
+class InboxWorker:
+    def __init__(self, settlement, workers=INBOX_WORKERS, max_attempts=INBOX_MAX_ATTEMPTS,
+                 retry_delay=INBOX_RETRY_DELAY, lease_seconds=INBOX_LEASE_SECONDS, poll_interval=INBOX_POLL_INTERVAL):
+        self.settlement = settlement
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.lag = LatencyStats()
+        self.outcomes = Counter()
+        self._outcomes_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inbox")
+
+    def wake(self):
+        self._wake.set()
+
+    def settle(self, event):
+        result = self.settlement.settle(event.payment_id, "webhook")
+        if result.state == "settling":
+            raise RuntimeError("платёж выдаётся другим процессом")
+        # pending: по данным API платёж не оплачен — уведомлению не доверяем
+        return "settled" if result.state == "settled" else "rejected"
+
+    def process(self, event):
+        try:
+            outcome = self.settle(event)
+        except Exception as e:
+            if event.attempts < self.max_attempts:
+                sync_repository.write(retry_webhook_event, event.id, self.retry_delay * event.attempts, str(e))
+                return "retry"
+            user_id = (json.loads(event.payload).get('object', {}).get('metadata') or {}).get('user_id')
+            sync_repository.write(_fail, event.id, user_id, f"Ошибка активации подписки по платежу {event.payment_id}: {str(e)}", str(e))
+            return "failed"
+        sync_repository.write(complete_webhook_event, event.id, None if outcome == "settled" else outcome)
+        self.lag.observe(max(time.time() - event.received_at, 0))
+        return outcome
+
+    def _safe_process(self, event):
+        try:
+            return self.process(event)
+        except Exception as e:
+            logger.exception(f"Ошибка обработки уведомления {event.payment_id}: {e}")
+            return "error"
+
+    def run_once(self):
+        processed = 0
+        in_flight = set()
+        while True:
+            free = self.workers * 2 - len(in_flight)
+            if free > 0:
+                for event in sync_repository.write(claim_webhook_events, free, self.lease_seconds):
+                    in_flight.add(self._executor.submit(self._safe_process, event))
+            if not in_flight:
+                return processed
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            with self._outcomes_lock:
+                for future in finished:
+                    self.outcomes[future.result()] += 1
+            processed += len(finished)
+
+    # Пауза между проходами: новое уведомление будит воркер сразу (wake),
+    # по таймеру подбираются отложенные повторы
+    def wait(self):
+        self._wake.wait(self.poll_interval)
+        self._wake.clear()
+
+    def stats(self):
+        with self._outcomes_lock:
+            outcomes = dict(self.outcomes)
+        return {"lag": self.lag.snapshot(), "outcomes": outcomes, "inbox": get_webhook_inbox_stats()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Очередь уведомлений ЮKassa")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('stats', help="состояние очереди и последние ошибки")
+    replay = commands.add_parser('replay', help="вернуть упавшие события в очередь")
+    replay.add_argument('payment_ids', nargs='*', help="только эти платежи (по умолчанию все упавшие)")
+    commands.add_parser('drain', help="обработать очередь один раз и выйти")
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        print(json.dumps(get_webhook_inbox_stats(), ensure_ascii=False))
+        for payment_id, event, received_at, attempts, last_error in get_failed_webhook_events():
+            print(f"{payment_id}  {event}  {received_at}  попыток: {attempts}  {last_error}")
+    elif args.command == 'replay':
+        print(f"Возвращено в очередь: {sync_repository.write(replay_webhook_events, args.payment_ids)}")
+    else:
+        from bot.settlement import settlement
+        worker = InboxWorker(settlement)
+        print(f"Обработано: {worker.run_once()}")
+        print(json.dumps(worker.stats(), ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from datetime import datetime
+import os
+from bot.ratelimit import TokenBucket
+from monitoring.log import get_logger
+from database.repository import sync_repository
+from database.db import (PENDING_PAYMENT_TTL, get_due_pending_payments, reschedule_pending_payment,
+                         remove_pending_payment, to_epoch)
+
+POLLER_BATCH_SIZE = int(os.getenv('POLLER_BATCH_SIZE', 100))
+POLLER_WORKERS = int(os.getenv('POLLER_WORKERS', 4))
+POLLER_RATE = float(os.getenv('POLLER_RATE', 5))
+POLLER_FIRST_DELAY = int(os.getenv('POLLER_FIRST_DELAY', 15))
+POLLER_MAX_DELAY = int(os.getenv('POLLER_MAX_DELAY', 600))
+POLLER_INTERVAL = float(os.getenv('POLLER_INTERVAL', 5))
+
+logger = get_logger(__name__)
+
+# Платёж ещё может быть оплачен
+OPEN_STATUSES = ("pending", "waiting_for_capture")
+
+# Фоновая проверка неоплаченных платежей: подписка активируется без нажатия «Проверить платёж»,
+# даже если webhook не дошёл. Интервал между проверками одного платежа растёт вдвое
+# (POLLER_FIRST_DELAY, x2, ... до POLLER_MAX_DELAY), общее число запросов к ЮKassa ограничено
+# POLLER_RATE в секунду. Отменённые и брошенные (старше PENDING_PAYMENT_TTL) платежи удаляются
+class PendingPaymentPoller:
+    def __init__(self, gateway, settlement, batch_size=POLLER_BATCH_SIZE, workers=POLLER_WORKERS, rate=POLLER_RATE,
+                 first_delay=POLLER_FIRST_DELAY, max_delay=POLLER_MAX_DELAY, ttl=PENDING_PAYMENT_TTL):
+        self.gateway = gateway
+        self.settlement = settlement
+        self.batch_size = batch_size
+        self.first_delay = first_delay
+        self.max_delay = max_delay
+        self.ttl = ttl
+        self.budget = TokenBucket(rate)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="poller")
+
+    def backoff(self, checks):
+        return min(self.first_delay * 2 ** checks, self.max_delay)
+
+    def check(self, pending):
+        self.budget.acquire()
+        payment = self.gateway.find_payment_sync(pending.payment_id)
+        if payment.status == "succeeded":
+            result = self.settlement.settle(pending.payment_id, "poller", payment)
+            if result.state == "settled":
+                return "settled"
+            if result.state == "skipped":
+                sync_repository.write(remove_pending_payment, pending.telegram_id, pending.payment_id)
+                return "skipped"
+            sync_repository.write(reschedule_pending_payment, pending.telegram_id, pending.payment_id, self.first_delay)
+            return "settling"
+        if payment.status not in OPEN_STATUSES:
+            sync_repository.write(remove_pending_payment, pending.telegram_id, pending.payment_id)
+            return "canceled"
+        if to_epoch(datetime.now()) - pending.created_at >= self.ttl:
+            sync_repository.write(remove_pending_payment, pending.telegram_id, pending.payment_id)
+            return "expired"
+        sync_repository.write(reschedule_pending_payment, pending.telegram_id, pending.payment_id, self.backoff(pending.checks))
+        return "pending"
+
+    def _safe_check(self, pending):
+        try:
+            return self.check(pending)
+        except Exception as e:
+            # Ошибка сети или выдачи: следующая попытка по обычному расписанию
+            sync_repository.write(reschedule_pending_payment, pending.telegram_id, pending.payment_id, self.backoff(pending.checks))
+            logger.exception(f"Ошибка проверки платежа {pending.payment_id}: {e}")
+            return "error"
+
+    def run_once(self):
+        outcomes = Counter()
+        while True:
+            due = get_due_pending_payments(self.batch_size)
+            if not due:
+                return dict(outcomes)
+            outcomes.update(self._executor.map(self._safe_check, due))
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+from collections import Counter
+import argparse
+import os
+import time
+from database.db import get_purge_candidates, purge_users
+from database.repository import sync_repository
+from monitoring.log import get_logger
+
+PURGE_AFTER_DAYS = int(os.getenv('PURGE_AFTER_DAYS', 3))
+PURGE_CHUNK_SIZE = int(os.getenv('PURGE_CHUNK_SIZE', 500))
+PURGE_CONCURRENCY = int(os.getenv('PURGE_CONCURRENCY', 10))
+
+PURGED_MESSAGE = "Пользователь удален из системы и Marzban через 3 дня после окончания подписки"
+PURGED_NOTICE = "Ваша подписка удалена из-за неудачных попыток автоплатежа."
+
+logger = get_logger(__name__)
+
+# Удаление давно истёкших пользователей порциями: кандидаты читаются по индексу subscription_end,
+# порция удаляется в Marzban параллельно (не больше concurrency запросов), затем строки users
+# и записи журнала фиксируются одной транзакцией. Прерванный проход можно просто запустить снова:
+# удалённые строки в выборку уже не попадут, а 404 от Marzban считается успешным удалением
+def purge_expired_users(delete_remote, notify=None, before=None, chunk_size=PURGE_CHUNK_SIZE,
+                        concurrency=PURGE_CONCURRENCY):
+    before = before or datetime.now() - timedelta(days=PURGE_AFTER_DAYS)
+    totals = Counter(purged=0, errors=0, chunks=0)
+    after = None
+    while True:
+        started = time.monotonic()
+        chunk = get_purge_candidates(before, chunk_size, after)
+        if not chunk:
+            break
+        after = (chunk[-1].subscription_end, chunk[-1].id)
+
+        errors = delete_remote([candidate.marzban_username for candidate in chunk], concurrency)
+        remote_done = time.monotonic()
+        purged = [candidate.telegram_id for candidate in chunk if candidate.marzban_username not in errors]
+        failed = [(candidate.telegram_id, f"Ошибка удаления пользователя: {errors[candidate.marzban_username]}")
+                  for candidate in chunk if candidate.marzban_username in errors]
+        sync_repository.write(purge_users, purged, PURGED_MESSAGE, failed)
+        finished = time.monotonic()
+
+        totals.update(purged=len(purged), errors=len(failed), chunks=1)
+        logger.info(f"Чистка, порция {totals['chunks']}: удалено {len(purged)}, ошибок {len(failed)}, "
+                    f"Marzban {remote_done - started:.2f} с, база {finished - remote_done:.2f} с")
+        if notify:
+            for telegram_id in purged:
+                notify(telegram_id, PURGED_NOTICE)
+    return dict(totals)
+
+def main():
+    from bot.marzban import delete_marzban_users
+
+    parser = argparse.ArgumentParser(description="Удаление пользователей, чья подписка истекла давно")
+    parser.add_argument('--days', type=int, default=PURGE_AFTER_DAYS)
+    parser.add_argument('--chunk-size', type=int, default=PURGE_CHUNK_SIZE)
+    parser.add_argument('--concurrency', type=int, default=PURGE_CONCURRENCY)
+    args = parser.parse_args()
+    totals = purge_expired_users(delete_marzban_users, before=datetime.now() - timedelta(days=args.days),
+                                 chunk_size=args.chunk_size, concurrency=args.concurrency)
+    print(f"Итого: {totals}")
+
+if __name__ == '__main__':
+    main()
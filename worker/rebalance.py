@@ -0,0 +1,117 @@
+from collections import Counter
+import argparse
+import math
+from database.db import count_users_by_panel, get_panel_users
+from database.repository import sync_repository
+from monitoring.log import get_logger
+
+MOVED_NOTICE = "Ваша подписка перенесена на другой сервер. Обновите ссылку на подписку в приложении — она есть в личном кабинете."
+
+logger = get_logger(__name__)
+
+# Перенос пользователей с одной панели Marzban на другую порциями по id. Ошибка по одному пользователю
+# пишется в журнал и не останавливает перенос остальных; повторный запуск продолжает с тех, кто остался
+def move_users(move, source, target, limit, notify=None, chunk_size=100):
+    totals = Counter(moved=0, errors=0)
+    after = 0
+    while totals["moved"] + totals["errors"] < limit:
+        chunk = get_panel_users(source, min(chunk_size, limit - totals["moved"] - totals["errors"]), after)
+        if not chunk:
+            break
+        after = chunk[-1].id
+        for user in chunk:
+            try:
+                move(user.marzban_username, source, target)
+            except Exception as e:
+                totals["errors"] += 1
+                sync_repository.log_transaction(user.telegram_id, "error", f"Ошибка переноса с панели {source} на {target}: {str(e)}")
+                continue
+            totals["moved"] += 1
+            sync_repository.log_transaction(user.telegram_id, "success", f"Подписка перенесена с панели {source} на {target}")
+            if notify:
+                notify(user.telegram_id, MOVED_NOTICE)
+        logger.info(f"Перенос {source} → {target}: перенесено {totals['moved']}, ошибок {totals['errors']}")
+    return dict(totals)
+
+# План выравнивания: целевое число пользователей панели пропорционально её весу среди здоровых панелей;
+# с перегруженных переносится избыток на недогруженные. Панели с весом 0 освобождаются полностью
+def balance_plan(counts, panels, healthy, limit=None):
+    targets_pool = [name for name, panel in panels.items() if panel.weight > 0 and healthy.get(name)]
+    total = sum(counts.get(name, 0) for name in panels)
+    weight = sum(panels[name].weight for name in targets_pool)
+    if not targets_pool or not total:
+        return []
+    target = {name: math.floor(total * panels[name].weight / weight) if name in targets_pool else 0 for name in panels}
+    surplus = [[name, counts.get(name, 0) - target[name]] for name in panels if counts.get(name, 0) > target[name]]
+    deficit = [[name, target[name] - counts.get(name, 0)] for name in targets_pool if counts.get(name, 0) < target[name]]
+    plan = []
+    budget = limit if limit is not None else total
+    for source in surplus:
+        for destination in deficit:
+            amount = min(source[1], destination[1], budget)
+            if amount <= 0:
+                continue
+            plan.append((source[0], destination[0], amount))
+            source[1] -= amount
+            destination[1] -= amount
+            budget -= amount
+    return plan
+
+def main():
+    from bot.marzban import PANELS, move_marzban_user, probe_marzban_panels
+    from bot.outbox import notify_user
+
+    parser = argparse.ArgumentParser(description="Панели Marzban: состояние, перенос и выравнивание пользователей")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="здоровье и число пользователей по панелям")
+    move = commands.add_parser("move", help="перенести пользователей с одной панели на другую")
+    move.add_argument("source")
+    move.add_argument("target")
+    move.add_argument("--limit", type=int, default=1000)
+    move.add_argument("--notify", action="store_true", help="сообщить пользователям о новой ссылке")
+    balance = commands.add_parser("balance", help="выровнять число пользователей по весам панелей")
+    balance.add_argument("--limit", type=int, help="перенести не больше стольких пользователей")
+    balance.add_argument("--notify", action="store_true", help="сообщить пользователям о новой ссылке")
+    balance.add_argument("--dry-run", action="store_true", help="только показать план")
+    args = parser.parse_args()
+
+    panels = {panel.name: panel for panel in PANELS}
+    health = probe_marzban_panels()
+    counts = count_users_by_panel()
+    notify = notify_user if getattr(args, "notify", False) else None
+
+    if args.command == "stats":
+        for name, state in health.items():
+            print(f"{name}: {state['url']}, вес {state['weight']}, {'доступна' if state['healthy'] else 'НЕДОСТУПНА'}, "
+                  f"в базе {counts.get(name, 0)}, на панели {state['load']}" + (f", ошибка {state['error']}" if state['error'] else ""))
+        unknown = set(counts) - set(panels)
+        if unknown:
+            print(f"В базе есть пользователи на ненастроенных панелях: {', '.join(sorted(unknown))}")
+        return
+
+    if args.command == "move":
+        for name in (args.source, args.target):
+            if name not in panels:
+                parser.error(f"панель {name} не настроена в MARZBAN_PANELS")
+        if not health[args.target]["healthy"]:
+            parser.error(f"панель {args.target} недоступна")
+        print(f"Итого: {move_users(move_marzban_user, args.source, args.target, args.limit, notify)}")
+        return
+
+    healthy = {name: state["healthy"] for name, state in health.items()}
+    if not any(healthy[name] and panel.weight > 0 for name, panel in panels.items()):
+        print("Нет доступных панелей с ненулевым весом")
+        return
+    plan = balance_plan(counts, panels, healthy, args.limit)
+    if not plan:
+        print("Панели уже выровнены")
+        return
+    for source, target, amount in plan:
+        print(f"{source} → {target}: {amount}")
+    if args.dry_run:
+        return
+    for source, target, amount in plan:
+        print(f"{source} → {target}: {move_users(move_marzban_user, source, target, amount, notify)}")
+
+if __name__ == '__main__':
+    main()
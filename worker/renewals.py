@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import Counter
+import os
+import time
+from monitoring.log import get_logger
+from database.repository import sync_repository
+from database.db import (enqueue_due_renewals, claim_renewal_jobs, set_renewal_payment, complete_renewal_job,
+                         retry_renewal_job, fail_renewal_job, get_tariff_price, reset_subscription, log_transaction)
+
+RENEWAL_WORKERS = int(os.getenv('RENEWAL_WORKERS', 16))
+RENEWAL_MAX_ATTEMPTS = int(os.getenv('RENEWAL_MAX_ATTEMPTS', 3))
+RENEWAL_RETRY_DELAY = int(os.getenv('RENEWAL_RETRY_DELAY', 300))
+RENEWAL_LEASE_SECONDS = int(os.getenv('RENEWAL_LEASE_SECONDS', 600))
+RENEWAL_POLL_INTERVAL = int(os.getenv('RENEWAL_POLL_INTERVAL', 60))
+
+logger = get_logger(__name__)
+
+# Платёж ещё обрабатывается ЮKassa — проверяем его же при следующей попытке, а не создаём новый
+IN_PROGRESS_STATUSES = ("pending", "waiting_for_capture")
+
+# Последняя неудачная попытка: подписка обнуляется, задача закрывается — одной записью в очереди BatchWriter
+def _give_up(job, reason, message):
+    reset_subscription(job.telegram_id)
+    fail_renewal_job(job.id, reason)
+    log_transaction(job.telegram_id, "error", message)
+
+# Автопродление на очереди renewal_jobs: пул воркеров забирает задачи атомарно,
+# неудачная попытка не усыпляет поток, а переносит задачу на RENEWAL_RETRY_DELAY секунд,
+# прогресс хранится в базе и переживает перезапуск
+class RenewalEngine:
+    def __init__(self, gateway, settlement, notify, workers=RENEWAL_WORKERS,
+                 max_attempts=RENEWAL_MAX_ATTEMPTS, retry_delay=RENEWAL_RETRY_DELAY,
+                 lease_seconds=RENEWAL_LEASE_SECONDS):
+        self.gateway = gateway
+        self.settlement = settlement
+        self.notify = notify
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease_seconds = lease_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="renewal")
+
+    # Ключ идемпотентности один на задачу и дату окончания: если ЮKassa создала платёж, а ответ
+    # до нас не дошёл (таймаут, обрыв), следующая попытка получит тот же платёж, а не спишет снова
+    def _charge(self, job):
+        if job.payment_id:
+            return self.gateway.find_payment_sync(job.payment_id)
+        amount = get_tariff_price(job.subscription_type)
+        payment = self.gateway.create_payment_sync({
+            "amount": {"value": str(amount), "currency": "RUB"},
+            "payment_method_id": job.payment_method_id,
+            "description": f"Автопродление подписки ({job.subscription_type}) для {job.telegram_id}",
+            "metadata": {"user_id": job.telegram_id, "subscription_type": job.subscription_type, "renewal_job": job.id}
+        }, idempotency_key=f"renewal-{job.id}-{job.due_at}")
+        sync_repository.write(set_renewal_payment, job.id, payment.id)
+        return payment
+
+    def _failed_attempt(self, job, reason, keep_payment=False):
+        sync_repository.write(log_transaction, job.telegram_id, "error", f"Ошибка автоплатежа (попытка {job.attempts}/{self.max_attempts}): {reason}")
+        if job.attempts < self.max_attempts:
+            sync_repository.write(retry_renewal_job, job.id, self.retry_delay, reason, keep_payment)
+            return "retry"
+        sync_repository.write(_give_up, job, reason, f"Автоплатеж не удался после {self.max_attempts} попыток, подписка обнулена")
+        self.notify(job.telegram_id, "Ваша подписка закончилась, автоплатеж не удался. Продлите её вручную в личном кабинете!")
+        return "failed"
+
+    def process(self, job):
+        try:
+            payment = self._charge(job)
+        except Exception as e:
+            # Ошибка ЮKassa или сети ничего не говорит о судьбе платежа — ссылка на него сохраняется
+            return self._failed_attempt(job, str(e), keep_payment=True)
+
+        if payment.status in IN_PROGRESS_STATUSES:
+            return self._failed_attempt(job, payment.status, keep_payment=True)
+        if payment.status != "succeeded":
+            return self._failed_attempt(job, payment.status)
+
+        try:
+            result = self.settlement.settle(payment.id, "renewal", payment)
+        except Exception as e:
+            # Деньги уже списаны: повторяем только выдачу подписки по тому же платежу
+            sync_repository.write(retry_renewal_job, job.id, self.retry_delay, str(e), keep_payment=True)
+            return "retry"
+        if result.state != "settled":
+            # Этот платёж прямо сейчас выдаёт другой процесс (webhook) — проверим позже
+            sync_repository.write(retry_renewal_job, job.id, self.retry_delay, result.state, keep_payment=True)
+            return "retry"
+
+        sync_repository.write(complete_renewal_job, job.id)
+        self.notify(job.telegram_id, "Ваша подписка автоматически продлена!")
+        return "done"
+
+    def _safe_process(self, job):
+        try:
+            return self.process(job)
+        except Exception as e:
+            logger.exception(f"Ошибка обработки задачи продления {job.id}: {e}")
+            return "error"
+
+    # Один проход: ставит в очередь истёкшие подписки и обрабатывает всё, что уже пора продлевать.
+    # Новые задачи забираются по мере освобождения воркеров, без ожидания всей пачки
+    def run_once(self):
+        started = time.monotonic()
+        outcomes = Counter(enqueued=sync_repository.write(enqueue_due_renewals), processed=0)
+        in_flight = set()
+        while True:
+            free = self.workers * 2 - len(in_flight)
+            if free > 0:
+                for job in sync_repository.write(claim_renewal_jobs, free, self.lease_seconds):
+                    in_flight.add(self._executor.submit(self._safe_process, job))
+            if not in_flight:
+                break
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                outcomes[future.result()] += 1
+                outcomes["processed"] += 1
+        outcomes["seconds"] = round(time.monotonic() - started, 3)
+        return dict(outcomes)
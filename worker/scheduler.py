@@ -0,0 +1,111 @@
+import os
+import socket
+import threading
+import time
+from bot.marzban import delete_marzban_users
+from bot.outbox import OutboxSender, notify_user
+from bot.payments import gateway
+from bot.settlement import settlement
+from database.db import init_db, acquire_lease, release_lease
+from worker.inbox import InboxWorker
+from worker.poller import PendingPaymentPoller, POLLER_INTERVAL
+from worker.purge import purge_expired_users
+from worker.renewals import RenewalEngine, RENEWAL_POLL_INTERVAL
+from monitoring.log import get_logger
+
+SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', 60))
+PURGE_INTERVAL = int(os.getenv('PURGE_INTERVAL', 3600))
+
+logger = get_logger(__name__)
+
+# Планировщик текущего процесса, если он запущен (см. wake_inbox)
+_current = None
+
+# Фоновые задачи: автопродления и чистка, очередь уведомлений ЮKassa, проверка неоплаченных платежей,
+# отправка сообщений пользователям из outbox
+# Работают только в процессе, который держит аренду "scheduler" в базе: можно запустить
+# планировщик отдельно (python -m worker.scheduler) или внутри сервера webhook — второй экземпляр
+# будет ждать и подхватит работу, если первый перестанет продлевать аренду
+class Scheduler:
+    def __init__(self, notify=notify_user, lease_name="scheduler", lease_seconds=SCHEDULER_LEASE_SECONDS):
+        self.notify = notify
+        self.lease_name = lease_name
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.leader = threading.Event()
+        self.renewals = RenewalEngine(gateway, settlement, notify)
+        self.inbox = InboxWorker(settlement)
+        self.poller = PendingPaymentPoller(gateway, settlement)
+        self.outbox = OutboxSender()
+        self._last_purge = 0
+
+    # Аренда продлевается напрямую, мимо очереди BatchWriter: это сигнал живости, и он не должен
+    # ждать за накопившимися записями — иначе аренду заберёт второй экземпляр при живом первом
+    def _hold_lease(self):
+        while True:
+            try:
+                held = acquire_lease(self.lease_name, self.owner, self.lease_seconds)
+            except Exception as e:
+                logger.error(f"Планировщик: ошибка продления аренды: {e}")
+                held = False
+            if held != self.leader.is_set():
+                logger.info(f"Планировщик {self.owner}: {'аренда получена' if held else 'аренда потеряна'}")
+            if held:
+                self.leader.set()
+            else:
+                self.leader.clear()
+            time.sleep(self.lease_seconds / 3)
+
+    def _loop(self, name, step, pause):
+        while True:
+            self.leader.wait()
+            try:
+                step()
+            except Exception as e:
+                logger.exception(f"Планировщик, {name}: {e}")
+            pause()
+
+    def _renew_and_purge(self):
+        outcome = self.renewals.run_once()
+        if outcome["processed"]:
+            logger.info(f"Автопродление: {outcome}")
+        if time.monotonic() - self._last_purge >= PURGE_INTERVAL:
+            self._last_purge = time.monotonic()
+            purge_expired_users(delete_marzban_users, self.notify)
+
+    def _poll_payments(self):
+        outcome = self.poller.run_once()
+        if outcome:
+            logger.info(f"Проверка платежей: {outcome}")
+
+    def start(self):
+        global _current
+        _current = self
+        loops = [
+            ("lease", self._hold_lease),
+            ("renewals", lambda: self._loop("автопродление", self._renew_and_purge, lambda: time.sleep(RENEWAL_POLL_INTERVAL))),
+            ("inbox", lambda: self._loop("уведомления ЮKassa", self.inbox.run_once, self.inbox.wait)),
+            ("poller", lambda: self._loop("проверка платежей", self._poll_payments, lambda: time.sleep(POLLER_INTERVAL))),
+            ("outbox", lambda: self._loop("отправка сообщений", self.outbox.run_once, self.outbox.wait)),
+        ]
+        for name, target in loops:
+            threading.Thread(target=target, name=f"scheduler-{name}", daemon=True).start()
+        return self
+
+    def run_forever(self):
+        self.start()
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            release_lease(self.lease_name, self.owner)
+
+# Будит разбор очереди сразу после сохранения уведомления, если планировщик работает в этом процессе;
+# иначе событие подберёт отдельный планировщик по таймеру INBOX_POLL_INTERVAL
+def wake_inbox():
+    if _current is not None:
+        _current.inbox.wake()
+
+if __name__ == '__main__':
+    init_db()
+    logger.info("Планировщик запущен")
+    Scheduler().run_forever()